@@ -0,0 +1,70 @@
+"""
+Сравнение движков расчета отчета: чистый Python (агрегат по URL) и numpy
+(bincount/lexsort по колонкам id URL и request_time).
+
+Запуск:
+    python benchmarks/bench_engines.py [--rows 10000000] [--urls 100000]
+
+Данные синтетические: URL с распределением, близким к Zipf, и request_time
+с точностью до миллисекунд, как в логе nginx. Оба движка получают одни и те же
+разобранные записи и замеряются целиком через process_entries: для numpy в
+замер входит сборка колонок (collect_columns), как при запуске с --engine numpy.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from typing import List, NamedTuple
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+import structlog
+
+from ru.otus.loganalyser.log_analyser import (ENGINE_NUMPY, ENGINE_PYTHON,
+                                              process_entries)
+
+
+class Entry(NamedTuple):
+    url: str
+    request_time: float
+
+
+def generate(rows: int, url_count: int, seed: int) -> List[Entry]:
+    rnd = random.Random(seed)
+    urls = [f"/api/v2/banner/{i}" for i in range(url_count)]
+    weights = [1 / (i + 1) for i in range(url_count)]
+    sampled = rnd.choices(urls, weights=weights, k=rows)
+    return [Entry(url, round(rnd.expovariate(5), 3)) for url in sampled]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--urls", type=int, default=100_000)
+    parser.add_argument("--report-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logger = structlog.get_logger()
+    config = {"REPORT_SIZE": args.report_size}
+    entries = generate(args.rows, args.urls, args.seed)
+
+    reports, elapsed = {}, {}
+    for engine in (ENGINE_PYTHON, ENGINE_NUMPY):
+        started = time.perf_counter()
+        reports[engine] = process_entries(
+            iter(entries), {**config, "ENGINE": engine}, logger
+        )
+        elapsed[engine] = time.perf_counter() - started
+
+    if reports[ENGINE_NUMPY] != reports[ENGINE_PYTHON]:
+        raise SystemExit("numpy engine report differs from python engine")
+    for name, seconds in elapsed.items():
+        print(f"{name:>8}: {seconds:8.3f} s  {args.rows / seconds / 1e6:8.2f} M rows/s")
+    print(f" speedup: {elapsed[ENGINE_PYTHON] / elapsed[ENGINE_NUMPY]:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Сравнение скорости чтения gz-логов разными способами распаковки open_log.
+
+Запуск:
+    python benchmarks/bench_gzip.py [nginx-access-ui.log-YYYYMMDD.gz ...]
+
+Без аргументов собирается временный gz-лог из тестовой фикстуры.
+"""
+
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Iterator, List
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from ru.otus.loganalyser.log_analyser import (ENCODING_UTF8, find_gzip_command,
+                                              read_gzip_external,
+                                              read_gzip_stdlib)
+
+FIXTURE = (
+    Path(__file__).resolve().parents[1]
+    / "tests/rus/otus/loganalyser/nginx_log.positive.txt"
+)
+
+
+def build_sample(target_mb: int, directory: Path) -> Path:
+    sample = FIXTURE.read_bytes()
+    if not sample.endswith(b"\n"):
+        sample += b"\n"
+    path = directory / "nginx-access-ui.log-20170630.gz"
+    repeats = target_mb * (1 << 20) // len(sample) + 1
+    with gzip.open(path, "wb", compresslevel=6) as f:
+        for _ in range(repeats):
+            f.write(sample)
+    return path
+
+
+def read_gzip_text(path: Path) -> Iterator[str]:
+    """
+    Исходный способ чтения: gzip.open в текстовом режиме
+    """
+    with gzip.open(path, "rt", encoding=ENCODING_UTF8) as f:
+        yield from f
+
+
+def measure(path: Path, name: str, reader: Callable[[Path], Iterator[str]]) -> None:
+    started = time.perf_counter()
+    size = 0
+    lines = 0
+    for line in reader(path):
+        size += len(line)
+        lines += 1
+    elapsed = time.perf_counter() - started
+    compressed_mb = path.stat().st_size / (1 << 20)
+    print(
+        f"{path.name:40} {name:10} lines={lines:>10} "
+        f"{size / (1 << 20) / elapsed:8.1f} MB/s (decompressed), "
+        f"{compressed_mb / elapsed:8.1f} MB/s (compressed), {elapsed:6.2f} s"
+    )
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*", type=Path)
+    parser.add_argument("--size-mb", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    readers = {"gzip-text": read_gzip_text, "stdlib": read_gzip_stdlib}
+    command = find_gzip_command()
+    if command is not None:
+        readers[Path(command[0]).name] = lambda path: read_gzip_external(path, command)
+    print(f"CPU count: {os.cpu_count()}, external decompressor: {command}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.paths or [build_sample(args.size_mb, Path(tmp))]
+        for path in paths:
+            for name, reader in readers.items():
+                measure(path, name, reader)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,178 @@
+"""
+Пропускная способность анализатора по стадиям: open (чтение строк), parse (разбор),
+aggregate (агрегация по URL) и render (расчет и запись отчета).
+
+Запуск:
+    python benchmarks/bench_pipeline.py [nginx-access-ui.log-YYYYMMDD[.gz] ...]
+        [--size-mb 100] [--urls 10000] [--gz] [--config '{"PARSE_MODE": "bytes"}']
+
+Без путей лог генерируется generate_log.py во временной директории. Конфиг -
+config.json анализатора, дополненный --config. Каждая стадия запускается
+в отдельном процессе вместе с предыдущими (--repeat раз, берется лучшее время),
+поэтому пиковый RSS процесса относится к этой стадии, а время стадии - разница
+с предыдущей (render выполняется после агрегации и замеряется отдельно).
+Строки/с и МБ/с стадии считаются по ее собственному времени.
+Стадия render пишет отчет по шаблону TEMPLATE конфига (reports/report.html,
+как у анализатора) или по --template во временную директорию.
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+import structlog
+from generate_log import generate
+
+from ru.otus.loganalyser import log_analyser
+from ru.otus.loganalyser.log_analyser import (aggregate_entries, build_report,
+                                              create_aggregate,
+                                              log_file_from_path,
+                                              open_log_lines, parse_log,
+                                              stream_report)
+
+STAGES = ("open", "parse", "aggregate", "render")
+
+
+def run_stage(path: Path, stage: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Выполняет стадии до stage включительно в текущем процессе
+    """
+    logger = structlog.get_logger()
+    logfile = log_file_from_path(path)
+    if logfile is None:
+        raise ValueError(f"Not a log file name: {path}")
+    lines_read = 0
+
+    def counted(lines):
+        nonlocal lines_read
+        for line in lines:
+            lines_read += 1
+            yield line
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    stage_seconds = None
+    lines = counted(open_log_lines(logfile, logger, config))
+    if stage == "open":
+        for _ in lines:
+            pass
+    elif stage == "parse":
+        for _ in parse_log(lines, config, logger):
+            pass
+    else:
+        aggregate = aggregate_entries(
+            parse_log(lines, config, logger), create_aggregate(config)
+        )
+        if stage == "render":
+            render_started = time.perf_counter()
+            with tempfile.TemporaryDirectory() as tmp:
+                report_config = dict(config, REPORT_DIR=tmp)
+                report_data = build_report(aggregate, report_config, logger)
+                stream_report(report_data, "report.html", report_config, logger)
+            stage_seconds = time.perf_counter() - render_started
+    elapsed = time.perf_counter() - started
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "seconds": elapsed,
+        "stage_seconds": stage_seconds,
+        "cpu": usage.ru_utime + usage.ru_stime - before.ru_utime - before.ru_stime,
+        "lines": lines_read,
+        # ru_maxrss в Linux - КБ, в macOS - байты
+        "max_rss_mb": usage.ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1024),
+    }
+
+
+def run_stage_process(path: Path, stage: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    output = subprocess.run(
+        [
+            sys.executable,
+            __file__,
+            "--run-stage",
+            stage,
+            "--config",
+            json.dumps(config),
+            str(path),
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def measure(path: Path, config: Dict[str, Any], repeat: int) -> None:
+    size_mb = path.stat().st_size / (1 << 20)
+    print(f"{path.name} ({size_mb:.1f} MB)")
+    previous = 0.0
+    for stage in STAGES:
+        results = [run_stage_process(path, stage, config) for _ in range(repeat)]
+        result = min(results, key=lambda item: item["seconds"])
+        seconds = result["seconds"]
+        stage_seconds = result["stage_seconds"]
+        if stage_seconds is None:
+            stage_seconds = seconds - previous
+        if stage_seconds > 0:
+            throughput = (
+                f"{result['lines'] / stage_seconds:10.0f} lines/s "
+                f"{size_mb / stage_seconds:7.1f} MB/s"
+            )
+        else:
+            # Лучшие времена соседних стадий измерены в разных запусках,
+            # разница оказалась в пределах шума
+            throughput = f"{'n/a':>10} lines/s {'n/a':>7} MB/s"
+        print(
+            f"{stage:>10}: {stage_seconds:7.2f} s (total {seconds:7.2f} s) "
+            f"{throughput} "
+            f"CPU {result['cpu']:7.2f} s peak RSS {result['max_rss_mb']:7.1f} MB"
+        )
+        previous = seconds
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("paths", nargs="*", type=Path)
+    parser.add_argument("--size-mb", type=float, default=100)
+    parser.add_argument("--urls", type=int, default=10000)
+    parser.add_argument("--gz", action="store_true")
+    parser.add_argument("--config", default="{}", help="JSON с ключами конфига")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--template", help="Шаблон отчета для стадии render вместо TEMPLATE конфига"
+    )
+    parser.add_argument("--run-stage", choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    config_path = Path(log_analyser.__file__).with_name("config.json")
+    config = json.loads(config_path.read_text(encoding="utf-8"))
+    config.update(json.loads(args.config))
+    if args.template:
+        config["TEMPLATE"] = os.path.abspath(args.template)
+    template = log_analyser.BASE_DIR / config["TEMPLATE"]
+    if not template.is_file():
+        parser.error(f"Report template not found: {template}, use --template")
+
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+    )
+    if args.run_stage:
+        print(json.dumps(run_stage(args.paths[0], args.run_stage, config)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.paths or [generate(Path(tmp), args.size_mb, args.urls, args.gz)]
+        print(f"config: {json.dumps(config)}")
+        for path in paths:
+            measure(path, config, args.repeat)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,138 @@
+"""
+Генератор синтетических логов nginx-access-ui в формате, который разбирает LOG_LINE_RE.
+
+Запуск:
+    python benchmarks/generate_log.py OUTPUT_DIR [--size-mb 100] [--urls 10000] [--gz]
+
+Имя файла - nginx-access-ui.log-YYYYMMDD[.gz] по --date. Популярность URL
+распределена по закону Ципфа, request_time - логнормально, время запросов
+равномерно покрывает сутки.
+"""
+
+import argparse
+import gzip
+import math
+import random
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import IO, List
+
+URL_TEMPLATES = (
+    "/api/v2/banner/{id}",
+    "/api/1/campaigns/?id={id}",
+    "/api/1/banners/?campaign={id}",
+    "/api/v2/group/{id}/statistic/sites/?date_type=day&date_from=2017-06-28",
+    "/export/appinstall_raw/2017-06-{day:02d}/",
+    "/api/v2/slot/{id}/groups",
+)
+AGENTS = (
+    "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5",
+    "Configovod",
+    "python-requests/2.13.0",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko)",
+    "-",
+)
+STATUSES = (200, 200, 200, 200, 200, 200, 404, 302, 499, 500)
+# Строк в одной записи в файл
+BATCH_LINES = 10000
+# Средняя длина строки, для оценки числа строк по размеру
+AVERAGE_LINE_BYTES = 190
+TZ = timezone(timedelta(hours=3))
+
+
+def make_urls(count: int, rnd: random.Random) -> List[str]:
+    urls = []
+    seen = set()
+    while len(urls) < count:
+        template = rnd.choice(URL_TEMPLATES)
+        url = template.format(id=rnd.randrange(10**7, 10**8), day=rnd.randrange(1, 31))
+        if url not in seen:
+            seen.add(url)
+            urls.append(url)
+    return urls
+
+
+def log_filename(date: datetime, gz: bool) -> str:
+    return f"nginx-access-ui.log-{date.strftime('%Y%m%d')}" + (".gz" if gz else "")
+
+
+def generate(
+    directory: Path,
+    size_mb: float = 100,
+    url_count: int = 10000,
+    gz: bool = False,
+    date: datetime = datetime(2017, 6, 30),
+    error_rate: float = 0.0,
+    seed: int = 1,
+) -> Path:
+    """
+    Пишет синтетический лог размером около size_mb (до сжатия)
+    :param error_rate: доля строк, которые не разбираются
+    :return: путь к логу
+    """
+    rnd = random.Random(seed)
+    urls = make_urls(url_count, rnd)
+    weights = [1 / (rank + 1) for rank in range(url_count)]
+    target = int(size_mb * (1 << 20))
+    # Оценка числа строк, чтобы время запросов покрыло сутки
+    estimated_lines = max(target // AVERAGE_LINE_BYTES, 1)
+    start = datetime(date.year, date.month, date.day, tzinfo=TZ) - timedelta(days=1)
+    step = 86400 / estimated_lines
+
+    path = directory / log_filename(date, gz)
+    opener = gzip.open if gz else open
+    written = 0
+    index = 0
+    with opener(path, "wb") as f:  # type: ignore[operator]
+        out: IO[bytes] = f
+        while written < target:
+            batch_urls = rnd.choices(urls, weights=weights, k=BATCH_LINES)
+            lines = []
+            for url in batch_urls:
+                if error_rate and rnd.random() < error_rate:
+                    lines.append(f"broken line {index}\n")
+                    index += 1
+                    continue
+                moment = start + timedelta(seconds=min(int(index * step), 86399))
+                request_time = min(math.exp(rnd.gauss(-2.0, 1.2)), 60.0)
+                lines.append(
+                    f"1.{rnd.randrange(256)}.{rnd.randrange(256)}.{rnd.randrange(256)} "
+                    f"-  - [{moment.strftime('%d/%b/%Y:%H:%M:%S %z')}] "
+                    f'"GET {url} HTTP/1.1" {rnd.choice(STATUSES)} '
+                    f'{rnd.randrange(100, 30000)} "-" "{rnd.choice(AGENTS)}" "-" '
+                    f'"{1498600000 + index}-{rnd.randrange(10**9)}-4708-9752903" "-" '
+                    f"{request_time:.3f}\n"
+                )
+                index += 1
+            data = "".join(lines).encode("utf-8")
+            out.write(data)
+            written += len(data)
+    return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--size-mb", type=float, default=100)
+    parser.add_argument("--urls", type=int, default=10000)
+    parser.add_argument("--gz", action="store_true")
+    parser.add_argument("--date", default="20170630")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    args.directory.mkdir(parents=True, exist_ok=True)
+    path = generate(
+        args.directory,
+        args.size_mb,
+        args.urls,
+        args.gz,
+        datetime.strptime(args.date, "%Y%m%d"),
+        args.error_rate,
+        args.seed,
+    )
+    print(path)
+
+
+if __name__ == "__main__":
+    main()
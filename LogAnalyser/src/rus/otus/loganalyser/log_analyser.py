@@ -1,26 +1,110 @@
 #!/usr/bin/env python3
 
 import argparse
+import base64
+import cProfile
+import ctypes
+import ctypes.util
 import gzip
+import heapq
+import io
 import json
 import logging
+import math
+import mmap
+import os
+import random
 import re
+import select
+import shutil
+import signal
+import socket
 import statistics
+import struct
+import subprocess
 import sys
-from collections import defaultdict
-from datetime import datetime
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache, partial
+from itertools import chain
+from operator import itemgetter
 from os import times
 from pathlib import Path
 from string import Template
-from typing import (IO, Any, Callable, Dict, Iterator, List, NamedTuple,
-                    Optional, Tuple, cast)
+from typing import (IO, Any, Callable, Dict, Iterable, Iterator, List,
+                    NamedTuple, Optional, Tuple, cast)
 
 import structlog
 from packaging.tags import logger
 
 ENCODING_UTF8 = "utf-8"
 REPORT_DIR_KEY = "REPORT_DIR"
+AGGREGATOR_EXACT = "exact"
+AGGREGATOR_SKETCH = "sketch"
+DEFAULT_MEDIAN_RELATIVE_ERROR = 0.01
+PARSE_MODE_FULL = "full"
+PARSE_MODE_REPORT = "report"
+PARSE_MODE_BYTES = "bytes"
+PARSE_MODE_MMAP = "mmap"
+CHECKPOINT_FILENAME = ".log-analyser-checkpoint.json"
+LOG_INDEX_FILENAME = ".log-analyser-index.json"
+LOG_INDEX_VERSION = 1
+# mtime директории, изменившийся позже этого числа секунд до сканирования, не
+# сохраняется: файл, созданный в тот же квант mtime, не будет пропущен
+LOG_INDEX_MTIME_GRANULARITY = 2
+ENGINE_PYTHON = "python"
+ENGINE_NUMPY = "numpy"
+URL_QUERY_KEEP = "keep"
+URL_QUERY_STRIP = "strip"
+URL_QUERY_TEMPLATE = "template"
+# Группа для URL сверх MAX_URLS. Места занимают URL в порядке первого
+# появления: URL, ставший тяжелым позже, остается в этой группе
+URL_OTHER = "(other)"
+URL_NORMALIZE_CACHE_SIZE = 1 << 20
+# Досрочная проверка доли ошибок разбора: число строк до первой проверки,
+# z-значение доверительного интервала и размер выборки нераспарсенных строк
+PARSE_ERROR_WARMUP = 10000
+PARSE_ERROR_Z = 3.0
+PARSE_ERROR_SAMPLE_SIZE = 20
+PARSE_ERROR_SAMPLE_LINE_LENGTH = 300
+# Размер временной корзины отчета по времени (TIME_BUCKET), секунд
+TIME_BUCKETS = {"minute": 60, "hour": 3600}
+TIME_REPORT_QUANTILES = (0.5, 0.95, 0.99)
+DEFAULT_TIME_REPORT_URLS = 10
+# Ячейки сетки по URL хранятся для TIME_GRID_URLS_FACTOR × TIME_REPORT_URLS
+# самых тяжелых URL, остальные сливаются в группу URL_OTHER
+TIME_GRID_URLS_FACTOR = 4
+DEFAULT_TIME_GRID_URLS = DEFAULT_TIME_REPORT_URLS * TIME_GRID_URLS_FACTOR
+# Строк отчета в одном JSON-фрагменте при потоковой записи
+REPORT_CHUNK_ROWS = 1000
+COLUMNAR_FORMAT_VERSION = 1
+AGGREGATE_FORMAT_VERSION = 1
+# Колонки кэша: имя файла и typecode array
+COLUMNAR_COLUMNS = {"url_id": "I", "request_time": "d", "time": "q"}
+COLUMNAR_FLUSH_ROWS = 1 << 16
+DAEMON_WATCHER_AUTO = "auto"
+DAEMON_WATCHER_INOTIFY = "inotify"
+DAEMON_WATCHER_POLL = "poll"
+DEFAULT_DAEMON_POLL_INTERVAL = 10.0
+DEFAULT_DAEMON_SETTLE_SECONDS = 5.0
+# Флаги inotify(7): файл дописан и закрыт, перемещен в директорию, создан
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+GZIP_BACKEND_STDLIB = "stdlib"
+GZIP_BACKEND_AUTO = "auto"
+# Внешние распаковщики в порядке предпочтения
+GZIP_COMMANDS = (("pigz", "-dc"), ("gzip", "-dc"))
+READ_BUFFER_SIZE = 1 << 20
+LOG_TIME_FORMAT = "%d/%b/%Y:%H:%M:%S %z"
 BASE_DIR = Path(__file__).resolve().parents[4]
+# Ключи с путями, которые можно задать в командной строке
+CLI_PATH_KEYS = ("PROFILE_OUTPUT", "EMIT_AGGREGATE", "MERGE_AGGREGATES")
+LOG_NAME_RE = re.compile(r"nginx-access-ui\.log-(?P<date>\d{8})(?:\.gz)?$")
 
 LOG_LINE_RE = re.compile(
     r"""
@@ -39,6 +123,25 @@ LOG_LINE_RE = re.compile(
     """,
     re.VERBOSE,
 )
+# Та же регулярка для строк, прочитанных в бинарном режиме
+LOG_LINE_RE_BYTES = re.compile(LOG_LINE_RE.pattern.encode(ENCODING_UTF8), re.VERBOSE)
+# Разбор url и request_time для строк-memoryview (PARSE_MODE=mmap): тот же
+# формат, что у LOG_LINE_RE, но с тремя группами; регулярка работает прямо
+# по буферу, копируются только группы
+LOG_REPORT_RE_BYTES = re.compile(
+    rb"""
+    ^\d{1,3}(?:\.\d{1,3}){3}\s+\S+\s+-\s+\[[^\]]+\]\s+
+    "(GET|POST)\s+(\S+)\s+HTTP/\d\.\d"\s+\d{3}\s+\d+\s+
+    "[^"]*"\s+"[^"]*"\s+"[^"]*"\s*"[^"]*"\s*"[^"]*"\s+
+    (\d+\.\d+)\r?\n?\Z
+    """,
+    re.VERBOSE,
+)
+# Числовой сегмент пути и значение параметра запроса (для str и bytes URL)
+URL_ID_SEGMENT_RE = re.compile(r"(?<=/)\d+(?=/|$)")
+URL_ID_SEGMENT_RE_BYTES = re.compile(rb"(?<=/)\d+(?=/|$)")
+URL_QUERY_VALUE_RE = re.compile(r"=[^&;]*")
+URL_QUERY_VALUE_RE_BYTES = re.compile(rb"=[^&;]*")
 
 
 class LogFile(NamedTuple):
@@ -55,6 +158,69 @@ class LogEntry(NamedTuple):
     size: int
     request_time: float
 
+    @property
+    def timestamp(self) -> int:
+        return int(self.time.timestamp()) if self.time.tzinfo else 0
+
+
+class ReportLogEntry:
+    """
+    Строка лога, у которой сразу разобраны только поля для отчета (url, request_time).
+    host, time и size декодируются из исходной строки только при обращении.
+    В режиме bytes строка и url остаются байтами.
+    """
+
+    __slots__ = ("url", "request_time", "method", "line")
+
+    def __init__(self, url: Any, request_time: float, method: str, line: Any):
+        self.url = url
+        self.request_time = request_time
+        self.method = method
+        self.line = line
+
+    @property
+    def text(self) -> str:
+        line = self.line
+        if isinstance(line, (bytes, memoryview)):
+            return str(line, ENCODING_UTF8)
+        return line
+
+    @property
+    def host(self) -> str:
+        return self.text.split(None, 1)[0]
+
+    @property
+    def raw_time(self) -> Any:
+        line = self.line
+        if isinstance(line, memoryview):
+            line = line.tobytes()
+        if isinstance(line, bytes):
+            return line[line.index(b"[") + 1 : line.index(b"]")]
+        return line[line.index("[") + 1 : line.index("]")]
+
+    @property
+    def time(self) -> datetime:
+        # Время разбирается лениво, строка уже посчитана разобранной:
+        # некорректное время не прерывает обработку, а считается неуказанным
+        try:
+            raw_time = self.raw_time
+            if isinstance(raw_time, bytes):
+                raw_time = raw_time.decode(ENCODING_UTF8)
+            return parse_log_time(raw_time)
+        except ValueError:
+            return datetime.min
+
+    @property
+    def timestamp(self) -> int:
+        return log_timestamp(self.raw_time)
+
+    @property
+    def size(self) -> int:
+        # После закрывающей кавычки запроса идут статус и размер ответа
+        tail = self.text.split('"', 2)[2]
+        size = tail.split(None, 2)[1]
+        return int(size) if size.isdigit() else 0
+
 
 def load_config_or_get_default() -> Dict[str, Any]:
     """
@@ -62,6 +228,25 @@ def load_config_or_get_default() -> Dict[str, Any]:
     """
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", default="config.json")
+    parser.add_argument("--workers", type=int, dest="WORKERS")
+    parser.add_argument(
+        "--incremental", action="store_const", const=True, dest="INCREMENTAL"
+    )
+    parser.add_argument("--backfill", action="store_const", const=True, dest="BACKFILL")
+    parser.add_argument(
+        "--engine", choices=(ENGINE_PYTHON, ENGINE_NUMPY), dest="ENGINE"
+    )
+    parser.add_argument("--backfill-concurrency", type=int, dest="BACKFILL_CONCURRENCY")
+    parser.add_argument(
+        "--time-bucket", choices=tuple(TIME_BUCKETS), dest="TIME_BUCKET"
+    )
+    parser.add_argument(
+        "--metrics", action="store_const", const=True, dest="STAGE_METRICS"
+    )
+    parser.add_argument("--profile", dest="PROFILE_OUTPUT")
+    parser.add_argument("--daemon", action="store_const", const=True, dest="DAEMON")
+    parser.add_argument("--emit-aggregate", dest="EMIT_AGGREGATE")
+    parser.add_argument("--merge", nargs="+", dest="MERGE_AGGREGATES")
     args, _ = parser.parse_known_args()
 
     default_config_path = Path("config.json")
@@ -81,6 +266,21 @@ def load_config_or_get_default() -> Dict[str, Any]:
             user_cfg = json.load(f)
         merged.update(user_cfg)
 
+    # Аргументы командной строки имеют наивысший приоритет
+    cli_config = {
+        key: value
+        for key, value in vars(args).items()
+        if key.isupper() and value is not None
+    }
+    # Пути из командной строки задаются относительно текущей директории,
+    # пути из конфига - относительно BASE_DIR
+    for key in CLI_PATH_KEYS:
+        value = cli_config.get(key)
+        if isinstance(value, list):
+            cli_config[key] = [os.path.abspath(path) for path in value]
+        elif value is not None:
+            cli_config[key] = os.path.abspath(value)
+    merged.update(cli_config)
     return merged
 
 
@@ -105,7 +305,12 @@ def setup_logging(config: Dict[str, Any]):
 
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
-    logger.handlers = [handler]
+    # Повторная настройка (смена файла лога демоном) закрывает прежние
+    # обработчики, иначе их файлы остаются открытыми
+    for old_handler in logger.handlers[:]:
+        logger.removeHandler(old_handler)
+        old_handler.close()
+    logger.addHandler(handler)
 
     structlog.configure(
         processors=[
@@ -121,54 +326,194 @@ def setup_logging(config: Dict[str, Any]):
     return init_logger
 
 
-def find_last_log(config: Dict[str, Any], logger) -> Optional[LogFile]:
+def iter_log_files(log_dir: Path) -> Iterator[LogFile]:
     """
-    Ищем последний файл соответствующий шаблону
+    Все логи интерфейса в директории (файлы, имя которых соответствует шаблону)
+    """
+    for entry in log_dir.iterdir():
+        if not entry.is_file():
+            continue
+        logfile = log_file_from_path(entry)
+        if logfile is not None:
+            yield logfile
+
+
+def log_index_path(config: Dict[str, Any]) -> Path:
+    return BASE_DIR / config[REPORT_DIR_KEY] / LOG_INDEX_FILENAME
+
+
+def load_log_index(config: Dict[str, Any], log_dir: Path, logger) -> Dict[str, Any]:
+    """
+    Загрузка индекса логов: mtime директории на момент сканирования и даты
+    логов по именам файлов. Индекс другой директории или битый индекс
+    игнорируется, тогда директория сканируется заново.
+    """
+    path = log_index_path(config)
+    empty: Dict[str, Any] = {"mtime_ns": None, "files": {}}
+    if not path.exists():
+        return empty
+    try:
+        with path.open(encoding=ENCODING_UTF8) as f:
+            index = json.load(f)
+        if index["version"] != LOG_INDEX_VERSION or index["log_dir"] != str(log_dir):
+            return empty
+        return {"mtime_ns": index["mtime_ns"], "files": dict(index["files"])}
+    except (OSError, ValueError, KeyError, TypeError):
+        logger.exception(f"Failed to load log index {path}, rescan {log_dir}")
+        return empty
+
+
+def save_log_index(
+    index: Dict[str, Any], config: Dict[str, Any], log_dir: Path, logger
+):
+    """
+    Атомарно сохраняет индекс логов рядом с отчетами
+    """
+    path = log_index_path(config)
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        with tmp_path.open("w", encoding=ENCODING_UTF8) as f:
+            json.dump(
+                {
+                    "version": LOG_INDEX_VERSION,
+                    "log_dir": str(log_dir),
+                    "mtime_ns": index["mtime_ns"],
+                    "files": index["files"],
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
+    except OSError:
+        logger.exception(f"Failed to save log index {path}")
+
+
+def list_log_files(config: Dict[str, Any], logger) -> List[LogFile]:
+    """
+    Логи интерфейса в LOG_DIR. При LOG_INDEX список берется из индекса
+    (LOG_INDEX_FILENAME в директории отчетов): пока mtime директории не
+    изменился, она не читается; после изменения читаются только имена,
+    а разбор имени и проверка, что это файл, делаются только для новых логов.
     """
     log_dir: Path = BASE_DIR / config["LOG_DIR"]
+    if not config.get("LOG_INDEX"):
+        return list(iter_log_files(log_dir))
+
+    index = load_log_index(config, log_dir, logger)
+    files: Dict[str, str] = index["files"]
+    scanned_at = time.time_ns()
+    mtime_ns = log_dir.stat().st_mtime_ns
+    if mtime_ns != index["mtime_ns"]:
+        names = os.listdir(log_dir)
+        known = {name: files[name] for name in names if name in files}
+        added = 0
+        for name in names:
+            if name in known or not LOG_NAME_RE.match(name):
+                continue
+            logfile = log_file_from_path(log_dir / name)
+            if logfile is not None and logfile.path.is_file():
+                known[name] = logfile.date.strftime("%Y%m%d")
+                added += 1
+        logger.info(
+            f"Log index of {log_dir} refreshed",
+            added=added,
+            removed=len(files) - (len(known) - added),
+        )
+        files = known
+        recent = scanned_at - mtime_ns < LOG_INDEX_MTIME_GRANULARITY * 10**9
+        save_log_index(
+            {"mtime_ns": None if recent else mtime_ns, "files": files},
+            config,
+            log_dir,
+            logger,
+        )
+
+    logfiles = []
+    for name, date in files.items():
+        path = log_dir / name
+        day = datetime(int(date[:4]), int(date[4:6]), int(date[6:]))
+        logfiles.append(LogFile(path=path, date=day, ext=path.suffix))
+    return logfiles
+
+
+def find_last_log(
+    config: Dict[str, Any], logger, skip_reported: bool = True
+) -> Optional[LogFile]:
+    """
+    Ищем последний файл соответствующий шаблону
+    :param skip_reported: не возвращать лог, для которого уже есть отчет
+    """
     report_dir: Path = BASE_DIR / config[REPORT_DIR_KEY]
-    pattern = re.compile(r"nginx-access-ui\.log-(?P<date>\d{8})(?:\.gz)?$")
     logger.info("Try to find last log file.")
 
     latest: Optional[LogFile] = None
-    for entry in log_dir.iterdir():
-        if not entry.is_file():
-            continue
-        m = pattern.match(entry.name)
-        if not m:
-            continue
-        date = datetime.strptime(m.group("date"), "%Y%m%d")
-        ext = ".gz" if entry.suffix == ".gz" else entry.suffix
-        candidate = LogFile(path=entry, date=date, ext=ext)
+    for candidate in list_log_files(config, logger):
         if latest is None or candidate.date > latest.date:
             latest = candidate
     if latest is None:
         return None
 
+    if not skip_reported:
+        return latest
+
     logger.info("File found successfully. Try to check report already exists.")
-    report_filename = f"report-{latest.date.strftime('%Y.%m.%d')}.html"
-    report_path = report_dir / report_filename
+    report_path = report_dir / report_filename(latest)
     if not report_path.exists():
         return latest
 
     return None
 
 
-def open_log(logfile: LogFile, logger) -> Iterator[str]:
+def find_unreported_logs(config: Dict[str, Any], logger) -> List[LogFile]:
+    """
+    Все логи, для которых еще нет отчета, по возрастанию даты.
+    Если за день есть и сжатый, и несжатый лог, берется один из них.
+    """
+    report_dir: Path = BASE_DIR / config[REPORT_DIR_KEY]
+    logger.info("Try to find unreported log files.")
+
+    # Одно чтение директории отчетов вместо проверки отчета для каждого лога
+    reports = set(os.listdir(report_dir)) if report_dir.is_dir() else set()
+    by_date: Dict[datetime, LogFile] = {}
+    for logfile in list_log_files(config, logger):
+        if report_filename(logfile) not in reports:
+            by_date.setdefault(logfile.date, logfile)
+    return [by_date[date] for date in sorted(by_date)]
+
+
+def log_file_from_path(path: Path) -> Optional[LogFile]:
+    """
+    LogFile по пути до лога, None если имя файла не соответствует шаблону
+    """
+    m = LOG_NAME_RE.match(path.name)
+    if not m:
+        return None
+    date = datetime.strptime(m.group("date"), "%Y%m%d")
+    ext = ".gz" if path.suffix == ".gz" else path.suffix
+    return LogFile(path=path, date=date, ext=ext)
+
+
+def report_filename(logfile: LogFile) -> str:
+    return f"report-{logfile.date.strftime('%Y.%m.%d')}.html"
+
+
+def open_log(
+    logfile: LogFile, logger, config: Optional[Dict[str, Any]] = None
+) -> Iterator[str]:
     """
-    Открытие файла как gz, так и тектосового
+    Открытие файла как gz, так и тектосового.
+    Для gz способ распаковки выбирается параметром GZIP_BACKEND.
     """
-    opener = cast(Callable[..., IO[Any]], gzip.open if logfile.ext == ".gz" else open)
     logger.info(f"Try to open file {logfile.path}")
+    if logfile.ext == ".gz":
+        backend = (config or {}).get("GZIP_BACKEND") or GZIP_BACKEND_STDLIB
+        yield from _open_gzip_log(logfile, backend, logger)
+        return
 
     try:
-        f = opener(logfile.path.as_posix(), "rt", encoding=ENCODING_UTF8)
+        f = open(logfile.path.as_posix(), "rt", encoding=ENCODING_UTF8)
     except OSError:
         logger.exception(f"Failed to open file {logfile.path}")
         return
-    except UnicodeDecodeError:
-        logger.exception(f"Failed to decode file {logfile.path}")
-        return
 
     try:
         with f:
@@ -179,138 +524,2652 @@ def open_log(logfile: LogFile, logger) -> Iterator[str]:
         return
 
 
+def open_log_bytes(
+    logfile: LogFile, logger, config: Optional[Dict[str, Any]] = None
+) -> Iterator[bytes]:
+    """
+    Открытие лога в бинарном режиме: строки не декодируются (PARSE_MODE=bytes)
+    """
+    logger.info(f"Try to open file {logfile.path} in binary mode")
+    if logfile.ext == ".gz":
+        backend = (config or {}).get("GZIP_BACKEND") or GZIP_BACKEND_STDLIB
+        yield from _open_gzip_log(logfile, backend, logger, binary=True)
+        return
+
+    try:
+        with open(logfile.path, "rb", buffering=READ_BUFFER_SIZE) as f:
+            yield from f
+    except OSError:
+        logger.exception(f"Error while file is reading {logfile.path}")
+        return
+
+
+def open_log_mmap(logfile: LogFile, logger, config: Dict[str, Any]) -> Iterator[Any]:
+    """
+    Открытие лога для PARSE_MODE=mmap: несжатый лог отображается в память
+    и читается memoryview-срезами, сжатый читается как в режиме bytes
+    """
+    if logfile.ext == ".gz":
+        yield from open_log_bytes(logfile, logger, config)
+        return
+
+    logger.info(f"Try to open file {logfile.path} via mmap")
+    try:
+        yield from iter_mmap_lines(logfile.path)
+    except OSError:
+        logger.exception(f"Error while file is reading {logfile.path}")
+        return
+
+
+def open_log_lines(logfile: LogFile, logger, config: Dict[str, Any]) -> Iterator[Any]:
+    """
+    Строки лога в представлении, нужном парсеру выбранного PARSE_MODE
+    """
+    if config.get("PARSE_MODE") == PARSE_MODE_MMAP:
+        return open_log_mmap(logfile, logger, config)
+    if is_bytes_mode(config):
+        return open_log_bytes(logfile, logger, config)
+    return open_log(logfile, logger, config)
+
+
+def find_gzip_command() -> Optional[List[str]]:
+    """
+    Команда внешнего распаковщика (pigz или gzip), если он установлен
+    """
+    for name, flag in GZIP_COMMANDS:
+        executable = shutil.which(name)
+        if executable:
+            return [executable, flag]
+    return None
+
+
+def read_gzip_stdlib(path: Path, binary: bool = False) -> Iterator[Any]:
+    """
+    Распаковка модулем gzip: бинарное чтение с большим буфером,
+    строки декодируются блоками по мере чтения (binary=True - не декодируются)
+    """
+    with gzip.open(path, "rb") as gz:
+        reader = io.BufferedReader(cast(Any, gz), READ_BUFFER_SIZE)
+        if binary:
+            yield from reader
+        else:
+            yield from io.TextIOWrapper(reader, encoding=ENCODING_UTF8)
+
+
+def read_gzip_external(
+    path: Path, command: List[str], binary: bool = False
+) -> Iterator[Any]:
+    """
+    Распаковка внешним процессом (pigz/gzip -dc), строки читаются из его stdout.
+    Распаковка идет на другом ядре параллельно с разбором в текущем процессе.
+    """
+    proc = subprocess.Popen(
+        [*command, str(path)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        bufsize=READ_BUFFER_SIZE,
+    )
+    stdout: IO[Any] = cast(IO[bytes], proc.stdout)
+    if not binary:
+        stdout = io.TextIOWrapper(stdout, encoding=ENCODING_UTF8)
+    stderr = cast(IO[bytes], proc.stderr)
+    completed = False
+    try:
+        yield from stdout
+        completed = True
+    finally:
+        if not completed:
+            proc.kill()
+        stdout.close()
+        error_output = stderr.read()
+        stderr.close()
+        returncode = proc.wait()
+    if returncode:
+        raise OSError(
+            f"{command[0]} exited with code {returncode}: "
+            f"{error_output.decode(ENCODING_UTF8, 'replace').strip()}"
+        )
+
+
+def decode_line(raw: bytes) -> str:
+    """
+    Декодирование строки, прочитанной в бинарном режиме.
+    Текстовый режим open приводит \r\n к \n, повторяем это поведение.
+    """
+    line = raw.decode(ENCODING_UTF8)
+    if line.endswith("\r\n"):
+        line = line[:-2] + "\n"
+    return line
+
+
+def _open_gzip_log(
+    logfile: LogFile, backend: str, logger, binary: bool = False
+) -> Iterator[Any]:
+    """
+    Строки gz-лога. В режиме auto используется внешний распаковщик, если он есть
+    и есть свободное ядро для распаковки, иначе модуль gzip.
+    """
+    if backend not in (GZIP_BACKEND_STDLIB, GZIP_BACKEND_AUTO):
+        raise ValueError(f"Unknown gzip backend: {backend}")
+    command = None
+    if backend == GZIP_BACKEND_AUTO and (os.cpu_count() or 1) > 1:
+        command = find_gzip_command()
+    if command is not None:
+        logger.info(f"Decompress {logfile.path} with {command[0]}")
+        lines = read_gzip_external(logfile.path, command, binary)
+    else:
+        lines = read_gzip_stdlib(logfile.path, binary)
+
+    try:
+        yield from lines
+    except (OSError, EOFError, UnicodeDecodeError):
+        logger.exception(f"Error while file is reading {logfile.path}")
+        return
+
+
 def check_actual_date():
     pass
 
 
-def parse_log(
-    lines: Iterator[str], config: Dict[str, Any], logger
-) -> Iterator[LogEntry]:
+def read_log_range(
+    path: Path, start: int, end: int, binary: bool = False
+) -> Iterator[Any]:
     """
-    Обработка лога
+    Чтение строк несжатого лога в диапазоне байт [start, end).
+    Границы диапазона должны быть выровнены по началу строки.
+    При binary=True строки возвращаются без декодирования.
     """
-    error_threshold = config.get("PARSE_ERROR_THRESHOLD")
-    total = 0
-    errors = 0
-    for line in lines:
-        total += 1
-        m = LOG_LINE_RE.search(line)
-        if not m:
-            errors += 1
-            continue
-        yield LogEntry(
-            host=m.group("host"),
-            url=m.group("url"),
-            time=(
-                datetime.strptime(m.group("time"), "%d/%b/%Y:%H:%M:%S %z")
-                if m.group("time") and m.group("time") != "-"
-                else datetime.min
-            ),
-            method=m.group("method"),
-            size=(
-                int(m.group("size"))
-                if m.group("size") and m.group("size").isdigit()
-                else 0
-            ),
-            request_time=float(m.group("request_time")),
-        )
-    if error_threshold is not None and total and errors / total > error_threshold:
-        logger.error("High parse error rate", total=total, errors=errors)
-        raise RuntimeError("Parse errors exceed threshold")
+    with path.open("rb") as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            raw = f.readline()
+            if not raw:
+                break
+            position += len(raw)
+            yield raw if binary else decode_line(raw)
 
 
-def none_if_dash(value: str):
-    return None if value == "-" else value
+def iter_mmap_lines(
+    path: Path, start: int = 0, end: Optional[int] = None
+) -> Iterator[memoryview]:
+    """
+    Строки несжатого лога в диапазоне байт [start, end) как memoryview-срезы
+    отображенного в память файла: без копирования и без объекта str/bytes
+    на строку. Границы диапазона должны быть выровнены по началу строки
+    (split_log_file).
+    """
+    with path.open("rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, "madvise"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    end = size if end is None else min(end, size)
+    view = memoryview(mapped)
+    find = mapped.find
+    position = start
+    try:
+        while position < end:
+            newline = find(b"\n", position, end)
+            stop = end if newline < 0 else newline + 1
+            yield view[position:stop]
+            position = stop
+    finally:
+        view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            # Срезы еще используются (например, в ReportLogEntry.line),
+            # отображение освободится вместе с последним из них
+            pass
 
 
-def process_entries(
-    entries: Iterator[LogEntry], config: Dict[str, Any], logger
-) -> List[Dict[str, Any]]:
+def read_log_range_lines(
+    path: Path, start: int, end: int, config: Dict[str, Any]
+) -> Iterator[Any]:
     """
-    Высчитываем статистику на основе LogEntry генератора
-    :param entries: генератор
-    :param config: Конфиг исполнения программы
-    :param logger: логгер исполнения
-    :return:
+    Строки диапазона несжатого лога в представлении для выбранного PARSE_MODE
     """
-    report_size: int = config.get("REPORT_SIZE") or 1000
-    stats: Dict[str, List[float]] = defaultdict(list)
-    for entry in entries:
-        stats[entry.url].append(entry.request_time)
-    total_count = sum(len(v) for v in stats.values())
-    total_time = sum(sum(v) for v in stats.values())
+    if config.get("PARSE_MODE") == PARSE_MODE_MMAP:
+        return iter_mmap_lines(path, start, end)
+    return read_log_range(path, start, end, is_bytes_mode(config))
+
+
+def split_log_file(path: Path, parts: int) -> List[Tuple[int, int]]:
+    """
+    Разбивает несжатый лог на диапазоны байт, выровненные по переводам строк
+    :param path: путь до лога
+    :param parts: желаемое количество диапазонов
+    :return: список непустых диапазонов (start, end)
+    """
+    size = path.stat().st_size
+    bounds = [0]
+    with path.open("rb") as f:
+        for i in range(1, parts):
+            target = max(size * i // parts, bounds[-1])
+            if target <= 0:
+                bounds.append(0)
+                continue
+            # Читаем с предыдущего байта: строка, начатая ровно в target, не теряется
+            f.seek(target - 1)
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
 
-    report = []
-    for url, times in stats.items():
-        times.sort()
-        count = len(times)
-        time_sum = sum(times)
-        report.append(
-            {
-                "url": url,
-                "count": count,
-                "count_perc": count / total_count,
-                "time_sum": time_sum,
-                "time_perc": time_sum / total_time,
-                "time_avg": time_sum / count,
-                "time_max": max(times),
-                "time_med": statistics.median(times),
-            }
-        )
-    report.sort(key=lambda x: cast(float, x["time_sum"]), reverse=True)
-    return report[:report_size]
 
+def parse_log_time(value: str) -> datetime:
+    """
+    Разбор времени запроса из лога, "-" превращается в datetime.min
+    """
+    if value and value != "-":
+        return datetime.strptime(value, LOG_TIME_FORMAT)
+    return datetime.min
 
-def render_report(report_data: List[Dict], config: Dict[str, Any], logger) -> str:
+
+@lru_cache(maxsize=1 << 12)
+def log_timestamp(raw_time: Any) -> int:
     """
-    Генерация отчета на основании шаблона и данных
+    Unix-время запроса по тексту из лога (str или bytes), 0 если время не указано
+    или некорректно. Соседние строки лога обычно имеют одинаковое время, поэтому
+    результат кэшируется.
     """
     try:
-        template_path: Path = BASE_DIR / config["TEMPLATE"]
-        logger.info("Try to render report.")
-        tpl = Template(template_path.read_text(encoding=ENCODING_UTF8))
-        table_json = json.dumps(report_data)
-        return tpl.safe_substitute(table_json=table_json)
-    except Exception as e:
-        logger.exception("Failed to render report.")
-        raise e
+        if isinstance(raw_time, bytes):
+            raw_time = raw_time.decode(ENCODING_UTF8)
+        parsed = parse_log_time(raw_time)
+    except ValueError:
+        return 0
+    return int(parsed.timestamp()) if parsed.tzinfo else 0
 
 
-def save_rendered_report(
-    rendered_report: Tuple[str, str], config: Dict[str, Any], logger
-):
+def parse_line(line: str) -> Optional[LogEntry]:
     """
-    Сохраняет сформированный отчет в директорию отчетов
-    :param rendered_report: пара из имени файла и срендеренного отчета.
-    :param config: Конфигурация исполнения программы
-    :param logger: логгер исполнения
-    :return: Ничего не возвращает
+    Разбор одной строки лога. Возвращает None, если строка не соответствует формату
+    (в том числе если время запроса не разбирается)
     """
-    filename, html = rendered_report
-    output_path: Path = BASE_DIR / config[REPORT_DIR_KEY] / filename
-    logger.info(f"Try to save file {output_path}")
-    output_path.write_text(html, encoding=ENCODING_UTF8)
+    m = LOG_LINE_RE.search(line)
+    if not m:
+        return None
+    try:
+        time = parse_log_time(m.group("time"))
+    except ValueError:
+        return None
+    return LogEntry(
+        host=m.group("host"),
+        url=m.group("url"),
+        time=time,
+        method=m.group("method"),
+        size=(
+            int(m.group("size")) if m.group("size") and m.group("size").isdigit() else 0
+        ),
+        request_time=float(m.group("request_time")),
+    )
 
 
-def main():
-    config = load_config_or_get_default()
-    logger = setup_logging(config)
-    last_log_file = find_last_log(config, logger)
+# Разделители для быстрого разбора строк str и bytes: пустая строка, кавычка,
+# дефис, скобки, методы, префикс протокола, точка и символы конца строки
+_STR_TOKENS = ("", '"', "-", "[", "]", "GET", "POST", "HTTP/", ".", "\r\n")
+_BYTES_TOKENS = (b"", b'"', b"-", b"[", b"]", b"GET", b"POST", b"HTTP/", b".", b"\r\n")
+# Кусков строки между кавычками: перед запросом, запрос и 5 полей в кавычках
+_REPORT_LINE_PARTS = 13
 
-    if not last_log_file:
-        logger.info("No logs to process")
-        return
 
-    lines = open_log(last_log_file, logger)
-    parsed = parse_log(lines, config, logger)
-    report_data = process_entries(parsed, config, logger)
-    rendered_report = render_report(report_data, config, logger)
-    save_rendered_report(
-        (f"report-{last_log_file.date.strftime('%Y.%m.%d')}.html", rendered_report),
-        config,
-        logger,
+def _parse_report_fields(
+    line: Any, tokens: Tuple[Any, ...]
+) -> Optional[ReportLogEntry]:
+    """
+    Разбор строки через split. Проверки те же, что у LOG_LINE_RE: строка,
+    которую отвергает регулярка, отвергается и здесь (обратное не обязательно,
+    такие строки разбирает регулярка).
+    """
+    empty, quote, dash, left, right, get, post, http, point, newline = tokens
+    parts = line.rstrip(newline).split(quote)
+    if len(parts) != _REPORT_LINE_PARTS:
+        return None
+    head, request, status_size, tail = parts[0], parts[1], parts[2], parts[12]
+
+    # IP, второй токен, дефис и [время] перед кавычкой запроса
+    fields = head.split(None, 3)
+    if len(fields) != 4 or head[:1].isspace() or not head[-1:].isspace():
+        return None
+    host, _, separator, raw_time = fields
+    raw_time = raw_time.rstrip()
+    if not (
+        separator == dash
+        and len(raw_time) > 2
+        and raw_time.startswith(left)
+        and raw_time.endswith(right)
+        and raw_time.count(right) == 1
+    ):
+        return None
+    octets = host.split(point)
+    if len(octets) != 4 or not all(0 < len(octet) <= 3 for octet in octets):
+        return None
+
+    # Метод, url и протокол HTTP/x.y через одиночные пробельные символы
+    fields = request.split()
+    if len(fields) != 3:
+        return None
+    raw_method, url, protocol = fields
+    if len(request) != len(raw_method) + len(url) + len(protocol) + 2:
+        return None
+    if raw_method == get:
+        method = "GET"
+    elif raw_method == post:
+        method = "POST"
+    else:
+        return None
+    version = protocol[len(http) :]
+    if not (protocol.startswith(http) and len(version) == 3 and version[1:2] == point):
+        return None
+
+    # Статус из трех цифр и размер ответа
+    fields = status_size.split()
+    if not (
+        len(fields) == 2
+        and len(fields[0]) == 3
+        and status_size[:1].isspace()
+        and status_size[-1:].isspace()
+    ):
+        return None
+    status, size = fields
+
+    # Разделители полей в кавычках: после 3-го и 4-го поля пробел необязателен
+    if not (parts[4].isspace() and parts[6].isspace()):
+        return None
+    if (parts[8] and not parts[8].isspace()) or (parts[10] and not parts[10].isspace()):
+        return None
+
+    request_time = tail.lstrip()
+    whole, dot, fraction = request_time.partition(point)
+    if not (tail[:1].isspace() and dot and whole and fraction):
+        return None
+
+    # Все числовые поля разом: \d регулярки в bytes - только ASCII-цифры,
+    # для str берем то же подмножество
+    digits = empty.join(
+        (*octets, version[:1], version[2:], status, size, whole, fraction)
+    )
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    return ReportLogEntry(url, float(request_time), method, line)
+
+
+def parse_line_fast(line: str) -> Optional[ReportLogEntry]:
+    """
+    Быстрый разбор строки через split без регулярного выражения.
+    Извлекаются только url и request_time. Возвращает None, если строка
+    не похожа на стандартный формат, тогда её нужно разобрать через LOG_LINE_RE.
+    """
+    return _parse_report_fields(line, _STR_TOKENS)
+
+
+def parse_line_for_report(line: str) -> Optional[Any]:
+    """
+    Разбор строки в режиме "только отчет": быстрый путь, регулярка как запасной вариант
+    """
+    return parse_line_fast(line) or parse_line(line)
+
+
+def parse_line_bytes(line: bytes) -> Optional[ReportLogEntry]:
+    """
+    Разбор строки в режиме bytes: без декодирования, url остается байтами.
+    Быстрый путь через split, регулярка LOG_LINE_RE_BYTES как запасной вариант.
+    """
+    entry = _parse_report_fields(line, _BYTES_TOKENS)
+    if entry is not None:
+        return entry
+    m = LOG_LINE_RE_BYTES.search(line.rstrip(b"\r\n"))
+    if not m:
+        return None
+    return ReportLogEntry(
+        m.group("url"),
+        float(m.group("request_time")),
+        m.group("method").decode(ENCODING_UTF8),
+        line,
     )
 
+
+def parse_line_view(line: Any) -> Optional[ReportLogEntry]:
+    """
+    Разбор строки в режиме mmap: строка - memoryview-срез отображенного файла
+    (или bytes для сжатых логов). Регулярка применяется прямо к буферу,
+    копируются только url и request_time; url остается байтами.
+    """
+    m = LOG_REPORT_RE_BYTES.match(line)
+    if m is None:
+        return None
+    return ReportLogEntry(
+        m.group(2), float(m.group(3)), m.group(1).decode(ENCODING_UTF8), line
+    )
+
+
+def is_bytes_mode(config: Dict[str, Any]) -> bool:
+    """
+    URL остаются байтами (PARSE_MODE bytes и mmap)
+    """
+    return config.get("PARSE_MODE") in (PARSE_MODE_BYTES, PARSE_MODE_MMAP)
+
+
+def get_line_parser(config: Dict[str, Any]) -> Callable[[Any], Optional[Any]]:
+    """
+    Выбор парсера строк по PARSE_MODE из конфига
+    """
+    mode = config.get("PARSE_MODE") or PARSE_MODE_FULL
+    if mode == PARSE_MODE_FULL:
+        return parse_line
+    if mode == PARSE_MODE_REPORT:
+        return parse_line_for_report
+    if mode == PARSE_MODE_BYTES:
+        return parse_line_bytes
+    if mode == PARSE_MODE_MMAP:
+        return parse_line_view
+    raise ValueError(f"Unknown parse mode: {mode}")
+
+
+def check_parse_errors(total: int, errors: int, config: Dict[str, Any], logger):
+    """
+    Проверка доли нераспарсенных строк после чтения всего лога
+    """
+    error_threshold = config.get("PARSE_ERROR_THRESHOLD")
+    if error_threshold is not None and total and errors / total > error_threshold:
+        logger.error("High parse error rate", total=total, errors=errors)
+        raise RuntimeError("Parse errors exceed threshold")
+
+
+class ParseErrorMonitor:
+    """
+    Досрочная проверка порога ошибок разбора. После разогрева (PARSE_ERROR_WARMUP
+    строк) разбор прерывается, как только нижняя граница доверительного
+    интервала Уилсона для доли ошибок (z = PARSE_ERROR_Z) выше
+    PARSE_ERROR_THRESHOLD: доля ошибок статистически выше порога, и дочитывать
+    многогигабайтный лог нет смысла. Граница растет только на ошибках, поэтому
+    проверка делается только для нераспарсенных строк.
+
+    Нераспарсенные строки сохраняются в выборку фиксированного размера
+    (reservoir sampling), она пишется в лог для диагностики формата.
+    """
+
+    def __init__(self, config: Dict[str, Any], logger) -> None:
+        self.config = config
+        self.logger = logger
+        self.threshold = config.get("PARSE_ERROR_THRESHOLD")
+        warmup = config.get("PARSE_ERROR_WARMUP")
+        self.warmup = PARSE_ERROR_WARMUP if warmup is None else warmup
+        sample_size = config.get("PARSE_ERROR_SAMPLE_SIZE")
+        self.sample_size = (
+            PARSE_ERROR_SAMPLE_SIZE if sample_size is None else sample_size
+        )
+        self.errors = 0
+        self.samples: List[str] = []
+        self.random = random.Random(0)
+
+    def error(self, line: Any, total: int) -> None:
+        """
+        Учитывает нераспарсенную строку
+        :param total: число прочитанных строк, включая эту
+        """
+        self.errors += 1
+        if len(self.samples) < self.sample_size:
+            self.samples.append(self._sample_line(line))
+        else:
+            index = self.random.randrange(self.errors)
+            if index < self.sample_size:
+                self.samples[index] = self._sample_line(line)
+        if (
+            self.threshold is not None
+            and total >= self.warmup
+            and self.lower_bound(total) > self.threshold
+        ):
+            self.logger.error(
+                "Parse error rate is above threshold, abort parsing",
+                total=total,
+                errors=self.errors,
+                samples=self.samples,
+            )
+            raise RuntimeError("Parse errors exceed threshold")
+
+    def lower_bound(self, total: int) -> float:
+        """
+        Нижняя граница доверительного интервала Уилсона для доли ошибок
+        """
+        z2 = PARSE_ERROR_Z * PARSE_ERROR_Z
+        rate = self.errors / total
+        center = rate + z2 / (2 * total)
+        margin = PARSE_ERROR_Z * math.sqrt(
+            rate * (1 - rate) / total + z2 / (4 * total * total)
+        )
+        return (center - margin) / (1 + z2 / total)
+
+    def merge(self, errors: int, samples: List[str]) -> None:
+        """
+        Добавляет ошибки и выборку, собранные в другом процессе
+        """
+        self.errors += errors
+        pool = self.samples + samples
+        if len(pool) > self.sample_size:
+            pool = self.random.sample(pool, self.sample_size)
+        self.samples = pool
+
+    def log_samples(self) -> None:
+        if self.samples:
+            self.logger.warning(
+                "Sample of unparsed lines", errors=self.errors, samples=self.samples
+            )
+
+    def finish(self, total: int) -> None:
+        """
+        Итоговая проверка доли ошибок после чтения всего лога
+        """
+        self.log_samples()
+        check_parse_errors(total, self.errors, self.config, self.logger)
+
+    @staticmethod
+    def _sample_line(line: Any) -> str:
+        if isinstance(line, (bytes, memoryview)):
+            line = str(line, ENCODING_UTF8, "replace")
+        return line.rstrip("\r\n")[:PARSE_ERROR_SAMPLE_LINE_LENGTH]
+
+
+def parse_log(
+    lines: Iterator[Any], config: Dict[str, Any], logger
+) -> Iterator[LogEntry]:
+    """
+    Обработка лога
+    """
+    parse = get_line_parser(config)
+    monitor = ParseErrorMonitor(config, logger)
+    total = 0
+    for line in lines:
+        total += 1
+        entry = parse(line)
+        if entry is None:
+            monitor.error(line, total)
+            continue
+        yield entry
+    monitor.finish(total)
+
+
+def none_if_dash(value: str):
+    return None if value == "-" else value
+
+
+class ExactValues:
+    """
+    Все значения request_time URL'а в компактном array('d'), медиана точная
+    """
+
+    __slots__ = ("values",)
+
+    def __init__(self) -> None:
+        self.values = array("d")
+
+    def add(self, value: float) -> None:
+        self.values.append(value)
+
+    def merge(self, other: "ExactValues") -> None:
+        self.values.extend(other.values)
+
+    def median(self) -> float:
+        return statistics.median(self.values)
+
+    def summands(self) -> Iterable[float]:
+        return self.values
+
+    def to_state(self) -> str:
+        values = self.values
+        if sys.byteorder == "big":
+            values = array("d", values)
+            values.byteswap()
+        return base64.b64encode(values.tobytes()).decode("ascii")
+
+    def load_state(self, state: str) -> None:
+        values = array("d", base64.b64decode(state))
+        if sys.byteorder == "big":
+            values.byteswap()
+        self.values = values
+
+
+class QuantileSketch:
+    """
+    Сливаемый скетч квантилей (логарифмическая гистограмма в духе DDSketch).
+    Оценка любого квантиля отличается от точной не более чем на relative_error,
+    число корзин ограничено логарифмом диапазона значений. Сумма значений
+    хранится частичными суммами (как в math.fsum), поэтому она точная и
+    не зависит от порядка сложения и слияния.
+    """
+
+    __slots__ = (
+        "relative_error",
+        "log_gamma",
+        "buckets",
+        "zero_count",
+        "count",
+        "partials",
+    )
+
+    # Значения меньше этого порога считаем нулевыми (request_time бывает 0.000)
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_error: float = DEFAULT_MEDIAN_RELATIVE_ERROR):
+        if not 0 < relative_error < 1:
+            raise ValueError(f"Relative error must be in (0, 1), got {relative_error}")
+        self.relative_error = relative_error
+        self.log_gamma = math.log((1 + relative_error) / (1 - relative_error))
+        self.buckets: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.partials: List[float] = []
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self._add_to_sum(value)
+        if value < self.MIN_VALUE:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def _add_to_sum(self, x: float) -> None:
+        # Точное суммирование Шевчука
+        partials = self.partials
+        i = 0
+        for y in partials:
+            if abs(x) < abs(y):
+                x, y = y, x
+            hi = x + y
+            lo = y - (hi - x)
+            if lo:
+                partials[i] = lo
+                i += 1
+            x = hi
+        partials[i:] = [x]
+
+    def merge(self, other: "QuantileSketch") -> None:
+        if other.relative_error != self.relative_error:
+            raise ValueError("Can not merge sketches with different relative error")
+        self.count += other.count
+        for value in other.partials:
+            self._add_to_sum(value)
+        self.zero_count += other.zero_count
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            raise ValueError("Quantile of empty sketch")
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        key = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                break
+        # Середина корзины (gamma^(k-1), gamma^k] в смысле относительной ошибки
+        gamma = math.exp(self.log_gamma)
+        return 2 * math.exp(key * self.log_gamma) / (gamma + 1)
+
+    def median(self) -> float:
+        return self.quantile(0.5)
+
+    def summands(self) -> Iterable[float]:
+        return self.partials
+
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            "relative_error": self.relative_error,
+            "count": self.count,
+            "zero_count": self.zero_count,
+            "partials": self.partials,
+            "buckets": list(self.buckets.items()),
+        }
+
+    def load_state(self, state: Dict[str, Any]) -> None:
+        if state["relative_error"] != self.relative_error:
+            raise ValueError("Sketch state has different relative error")
+        self.count = state["count"]
+        self.zero_count = state["zero_count"]
+        self.partials = list(state["partials"])
+        self.buckets = {key: count for key, count in state["buckets"]}
+
+
+class UrlAggregate:
+    """
+    Счетчики одного URL: количество, сумма и максимум считаются точно,
+    значения хранятся в подключаемом хранилище (ExactValues/QuantileSketch).
+    Сумма считается через math.fsum по слагаемым хранилища, поэтому она
+    не зависит от порядка сложения и слияния.
+    """
+
+    __slots__ = ("count", "time_max", "values")
+
+    def __init__(self, values: Any) -> None:
+        self.count = 0
+        self.time_max = 0.0
+        self.values = values
+
+    def add(self, request_time: float) -> None:
+        self.count += 1
+        if request_time > self.time_max:
+            self.time_max = request_time
+        self.values.add(request_time)
+
+    def merge(self, other: "UrlAggregate") -> None:
+        self.count += other.count
+        self.time_max = max(self.time_max, other.time_max)
+        self.values.merge(other.values)
+
+    @property
+    def time_sum(self) -> float:
+        return math.fsum(self.values.summands())
+
+
+def url_to_str(url: Any) -> str:
+    """
+    URL для отчета и сериализации. Байтовые URL декодируются без потерь:
+    невалидный UTF-8 сохраняется через surrogateescape.
+    """
+    if isinstance(url, bytes):
+        return url.decode(ENCODING_UTF8, "surrogateescape")
+    return url
+
+
+class LatencyTimeline:
+    """
+    Сетка время × URL скетчей request_time для отчета по времени: на каждую
+    корзину времени хранится скетч по всем запросам и по каждому URL.
+    Строится за тот же проход по логу, что и основной агрегат, и сливается
+    так же, как он.
+
+    Ячейки по URL хранятся только для max_urls самых тяжелых по суммарному
+    request_time URL (алгоритм space-saving): новый URL сверх лимита
+    вытесняет самый легкий, ячейки вытесненного URL сливаются в группу
+    URL_OTHER, а его вес наследует новый URL. Так размер сетки не зависит
+    от числа разных URL в логе; пока URL не больше max_urls, сетка точная.
+    Итоги по корзинам считаются по всем запросам.
+    """
+
+    def __init__(
+        self,
+        bucket_seconds: int,
+        relative_error: float = DEFAULT_MEDIAN_RELATIVE_ERROR,
+        max_urls: int = DEFAULT_TIME_GRID_URLS,
+    ) -> None:
+        self.bucket_seconds = bucket_seconds
+        self.relative_error = relative_error
+        self.max_urls = max_urls
+        self.totals: Dict[int, QuantileSketch] = {}
+        self.grid: Dict[Any, Dict[int, QuantileSketch]] = {}
+        # Веса (суммарный request_time) отслеживаемых URL и куча
+        # (вес, URL) для поиска самого легкого. Записи кучи с устаревшим
+        # весом обновляются при извлечении
+        self.weights: Dict[Any, float] = {}
+        self._heap: List[Tuple[float, Any]] = []
+
+    def _sketch(self, sketches: Dict[Any, QuantileSketch], key: Any) -> QuantileSketch:
+        sketch = sketches.get(key)
+        if sketch is None:
+            sketch = sketches[key] = QuantileSketch(self.relative_error)
+        return sketch
+
+    def _fold(self, url: Any) -> None:
+        """
+        Переносит ячейки URL в группу URL_OTHER
+        """
+        cells = self.grid.pop(url)
+        other = self.grid.setdefault(other_url(url), {})
+        for bucket, sketch in cells.items():
+            self._sketch(other, bucket).merge(sketch)
+
+    def _pop_lightest(self) -> Tuple[Any, float]:
+        while True:
+            weight, url = heapq.heappop(self._heap)
+            current = self.weights.get(url)
+            if current is None:
+                continue
+            if current != weight:
+                heapq.heappush(self._heap, (current, url))
+                continue
+            del self.weights[url]
+            return url, weight
+
+    def _track(self, url: Any, weight: float) -> Dict[int, QuantileSketch]:
+        """
+        Ячейки нового URL; при заполненной сетке вытесняет самый легкий URL
+        """
+        if url == other_url(url):
+            return self.grid.setdefault(url, {})
+        if len(self.weights) >= self.max_urls:
+            victim, victim_weight = self._pop_lightest()
+            self._fold(victim)
+            weight += victim_weight
+        self.weights[url] = weight
+        heapq.heappush(self._heap, (weight, url))
+        return self.grid.setdefault(url, {})
+
+    def _trim(self) -> None:
+        """
+        Оставляет max_urls самых тяжелых URL после слияния
+        """
+        if len(self.weights) > self.max_urls:
+            ranked = sorted(self.weights.items(), key=itemgetter(1), reverse=True)
+            for url, _ in ranked[self.max_urls :]:
+                del self.weights[url]
+                self._fold(url)
+        self._heap = [(weight, url) for url, weight in self.weights.items()]
+        heapq.heapify(self._heap)
+
+    def add(self, timestamp: int, url: Any, request_time: float) -> None:
+        bucket = timestamp - timestamp % self.bucket_seconds
+        self._sketch(self.totals, bucket).add(request_time)
+        cells = self.grid.get(url)
+        if cells is None:
+            cells = self._track(url, request_time)
+        elif url in self.weights:
+            self.weights[url] += request_time
+        self._sketch(cells, bucket).add(request_time)
+
+    def merge(
+        self, other: "LatencyTimeline", url_key: Callable[[Any], Any] = lambda url: url
+    ) -> None:
+        """
+        :param url_key: ключ URL в этой сетке по ключу URL в other
+        """
+        if other.bucket_seconds != self.bucket_seconds:
+            raise ValueError("Can not merge timelines with different buckets")
+        for bucket, sketch in other.totals.items():
+            self._sketch(self.totals, bucket).merge(sketch)
+        for url, cells in other.grid.items():
+            key = url_key(url)
+            target = self.grid.setdefault(key, {})
+            for bucket, sketch in cells.items():
+                self._sketch(target, bucket).merge(sketch)
+            if key != other_url(key):
+                self.weights[key] = self.weights.get(key, 0.0) + other.weights.get(
+                    url, 0.0
+                )
+        self._trim()
+
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            "bucket_seconds": self.bucket_seconds,
+            "totals": [
+                [bucket, sketch.to_state()] for bucket, sketch in self.totals.items()
+            ],
+            "grid": [
+                [bucket, url_to_str(url), sketch.to_state()]
+                for url, cells in self.grid.items()
+                for bucket, sketch in cells.items()
+            ],
+            "weights": [
+                [url_to_str(url), weight] for url, weight in self.weights.items()
+            ],
+        }
+
+    def load_state(self, state: Dict[str, Any], bytes_urls: bool = False) -> None:
+        if state["bucket_seconds"] != self.bucket_seconds:
+            raise ValueError("Timeline state has different bucket size")
+
+        def key(url: str) -> Any:
+            if bytes_urls:
+                return url.encode(ENCODING_UTF8, "surrogateescape")
+            return url
+
+        for bucket, sketch_state in state["totals"]:
+            self._sketch(self.totals, bucket).load_state(sketch_state)
+        for bucket, url, sketch_state in state["grid"]:
+            url = key(url)
+            cells = self.grid.setdefault(url, {})
+            self._sketch(cells, bucket).load_state(sketch_state)
+            if url != other_url(url):
+                self.weights.setdefault(url, 0.0)
+        for url, weight in state.get("weights", []):
+            self.weights[key(url)] = weight
+        self._trim()
+
+    def report(self, urls: List[str]) -> Dict[str, Any]:
+        """
+        Отчет по корзинам времени: число запросов и квантили request_time
+        по всем запросам и по каждому URL из urls
+        """
+
+        def stats(sketch: QuantileSketch) -> Dict[str, Any]:
+            row: Dict[str, Any] = {"count": sketch.count}
+            for q in TIME_REPORT_QUANTILES:
+                row[f"p{round(q * 100)}"] = sketch.quantile(q)
+            return row
+
+        by_url: Dict[int, Dict[str, Any]] = {}
+        selected = set(urls)
+        for url, cells in self.grid.items():
+            url = url_to_str(url)
+            if url in selected:
+                for bucket, sketch in cells.items():
+                    by_url.setdefault(bucket, {})[url] = stats(sketch)
+
+        buckets = []
+        for bucket in sorted(self.totals):
+            row = stats(self.totals[bucket])
+            row["time"] = datetime.fromtimestamp(bucket, timezone.utc).isoformat()
+            row["urls"] = {
+                url: by_url[bucket][url]
+                for url in urls
+                if url in by_url.get(bucket, {})
+            }
+            buckets.append(row)
+        return {"bucket_seconds": self.bucket_seconds, "urls": urls, "buckets": buckets}
+
+
+def time_report_url_count(config: Dict[str, Any]) -> int:
+    """
+    Число URL основного отчета в отчете по времени (TIME_REPORT_URLS)
+    """
+    url_count = config.get("TIME_REPORT_URLS")
+    if url_count is None:
+        return DEFAULT_TIME_REPORT_URLS
+    return url_count
+
+
+def create_timeline(config: Dict[str, Any]) -> Optional[LatencyTimeline]:
+    """
+    Сетка для отчета по времени, если задан TIME_BUCKET. Ячейки по URL
+    хранятся для TIME_GRID_URLS_FACTOR × TIME_REPORT_URLS самых тяжелых URL
+    """
+    bucket = config.get("TIME_BUCKET")
+    if not bucket:
+        return None
+    if bucket not in TIME_BUCKETS:
+        raise ValueError(f"Unknown time bucket: {bucket}")
+    relative_error = (
+        config.get("MEDIAN_RELATIVE_ERROR") or DEFAULT_MEDIAN_RELATIVE_ERROR
+    )
+    max_urls = max(1, time_report_url_count(config) * TIME_GRID_URLS_FACTOR)
+    return LatencyTimeline(TIME_BUCKETS[bucket], relative_error, max_urls)
+
+
+def other_url(url: Any) -> Any:
+    """
+    Ключ группы URL сверх MAX_URLS того же типа, что и URL
+    """
+    if isinstance(url, bytes):
+        return URL_OTHER.encode(ENCODING_UTF8)
+    return URL_OTHER
+
+
+class UrlNormalizer:
+    """
+    Нормализация URL перед агрегацией: параметры запроса сохраняются (keep),
+    отбрасываются (strip) или заменяются шаблоном с именами параметров
+    (template, ?id=1&page=2 -> ?id={}&page={}), числовые сегменты пути
+    заменяются на {id}. Работает и со строковыми, и с байтовыми URL.
+
+    Результат кэшируется по исходному URL, одинаковые ключи групп хранятся
+    в одном экземпляре. При переполнении cache_size кэш сбрасывается целиком,
+    чтобы память не росла вместе с числом уникальных исходных URL.
+    """
+
+    def __init__(
+        self,
+        query: str = URL_QUERY_KEEP,
+        collapse_ids: bool = False,
+        cache_size: int = URL_NORMALIZE_CACHE_SIZE,
+    ) -> None:
+        if query not in (URL_QUERY_KEEP, URL_QUERY_STRIP, URL_QUERY_TEMPLATE):
+            raise ValueError(f"Unknown url query mode: {query}")
+        self.query = query
+        self.collapse_ids = collapse_ids
+        self.cache_size = cache_size
+        self.cache: Dict[Any, Any] = {}
+        self.keys: Dict[Any, Any] = {}
+
+    def __call__(self, url: Any) -> Any:
+        key = self.cache.get(url)
+        if key is None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+                self.keys.clear()
+            key = self.normalize(url)
+            key = self.keys.setdefault(key, key)
+            self.cache[url] = key
+        return key
+
+    def __reduce__(self):
+        # В процессы-воркеры передаются только настройки, без кэша
+        return self.__class__, (self.query, self.collapse_ids, self.cache_size)
+
+    def normalize(self, url: Any) -> Any:
+        if isinstance(url, bytes):
+            path, sep, query = url.partition(b"?")
+            id_re, value_re = URL_ID_SEGMENT_RE_BYTES, URL_QUERY_VALUE_RE_BYTES
+            id_placeholder, value_placeholder = b"{id}", b"={}"
+        else:
+            path, sep, query = url.partition("?")
+            id_re, value_re = URL_ID_SEGMENT_RE, URL_QUERY_VALUE_RE
+            id_placeholder, value_placeholder = "{id}", "={}"
+        if self.collapse_ids:
+            path = id_re.sub(id_placeholder, path)
+        if not sep or self.query == URL_QUERY_KEEP:
+            return path + sep + query
+        if self.query == URL_QUERY_STRIP:
+            return path
+        return path + sep + value_re.sub(value_placeholder, query)
+
+
+def create_url_normalizer(config: Dict[str, Any]) -> Optional[UrlNormalizer]:
+    """
+    Нормализатор URL по конфигу (URL_QUERY, URL_COLLAPSE_IDS) или None,
+    если URL агрегируются как есть
+    """
+    query = config.get("URL_QUERY") or URL_QUERY_KEEP
+    collapse_ids = bool(config.get("URL_COLLAPSE_IDS"))
+    if query == URL_QUERY_KEEP and not collapse_ids:
+        return None
+    return _shared_url_normalizer(query, collapse_ids)
+
+
+@lru_cache(maxsize=None)
+def _shared_url_normalizer(query: str, collapse_ids: bool) -> UrlNormalizer:
+    # Один нормализатор на настройки: в режиме демона кэш URL переживает
+    # обработку лога и используется для следующих
+    return UrlNormalizer(query, collapse_ids)
+
+
+def group_urls(urls: List[Any], config: Dict[str, Any]) -> Tuple[List[Any], List[int]]:
+    """
+    Группировка словаря URL (движок numpy) по тем же правилам, что и в
+    LogAggregate: нормализация и ограничение MAX_URLS в порядке первого появления.
+    :return: ключи групп и id группы для каждого id исходного URL
+    """
+    normalizer = create_url_normalizer(config)
+    max_urls = config.get("MAX_URLS")
+    groups: Dict[Any, int] = {}
+    url_groups = []
+    for url in urls:
+        key = normalizer(url) if normalizer is not None else url
+        group = groups.get(key)
+        if group is None:
+            if max_urls is not None and len(groups) >= max_urls:
+                key = other_url(url)
+                group = groups.get(key)
+            if group is None:
+                group = groups[key] = len(groups)
+        url_groups.append(group)
+    return list(groups), url_groups
+
+
+class LogAggregate:
+    """
+    Агрегат по всем URL лога. Новые URL получают хранилище значений из фабрики,
+    агрегаты разных частей лога можно сливать через merge.
+    При bytes_urls=True ключи - байты (PARSE_MODE=bytes).
+    URL перед добавлением проходят через normalizer, если он задан; после
+    max_urls разных ключей новые URL попадают в общую группу URL_OTHER,
+    даже если потом наберут больше запросов, чем уже занявшие места.
+    Ограничение применяется и при merge, поэтому сливаемые агрегаты частей
+    лога создаются без него (partial_aggregate_config).
+    Если задан timeline, запросы с временем попадают и в сетку отчета по времени.
+    """
+
+    def __init__(
+        self,
+        values_factory: Callable[[], Any],
+        kind: str,
+        bytes_urls: bool = False,
+        normalizer: Optional[UrlNormalizer] = None,
+        max_urls: Optional[int] = None,
+        timeline: Optional[LatencyTimeline] = None,
+    ) -> None:
+        self.values_factory = values_factory
+        self.kind = kind
+        self.bytes_urls = bytes_urls
+        self.normalizer = normalizer
+        self.max_urls = max_urls
+        self.timeline = timeline
+        self.urls: Dict[Any, UrlAggregate] = {}
+
+    def add(
+        self, url: Any, request_time: float, timestamp: Optional[int] = None
+    ) -> None:
+        if self.normalizer is not None:
+            url = self.normalizer(url)
+        stats = self.urls.get(url)
+        if stats is None:
+            url, stats = self._new_url(url)
+        stats.add(request_time)
+        if self.timeline is not None and timestamp is not None:
+            self.timeline.add(timestamp, url, request_time)
+
+    def _new_url(self, url: Any) -> Tuple[Any, UrlAggregate]:
+        if self.max_urls is not None and len(self.urls) >= self.max_urls:
+            url = other_url(url)
+            stats = self.urls.get(url)
+            if stats is not None:
+                return url, stats
+        stats = self.urls[url] = UrlAggregate(self.values_factory())
+        return url, stats
+
+    def merge(self, other: "LogAggregate") -> None:
+        for url, other_stats in other.urls.items():
+            stats = self.urls.get(url)
+            if stats is not None:
+                stats.merge(other_stats)
+            elif self.max_urls is None or len(self.urls) < self.max_urls:
+                self.urls[url] = other_stats
+            else:
+                self._new_url(url)[1].merge(other_stats)
+        if self.timeline is not None and other.timeline is not None:
+            # URL, не вошедшие в агрегат, слиты в группу URL_OTHER
+            urls = self.urls
+            self.timeline.merge(
+                other.timeline, lambda url: url if url in urls else other_url(url)
+            )
+
+    @property
+    def total_count(self) -> int:
+        return sum(stats.count for stats in self.urls.values())
+
+    @property
+    def total_time(self) -> float:
+        return math.fsum(
+            chain.from_iterable(stats.values.summands() for stats in self.urls.values())
+        )
+
+    def to_state(self) -> Dict[str, Any]:
+        """
+        Сериализуемое в JSON состояние агрегата
+        """
+        state = {
+            "aggregator": self.kind,
+            "urls": {
+                url_to_str(url): [stats.count, stats.time_max, stats.values.to_state()]
+                for url, stats in self.urls.items()
+            },
+        }
+        if self.timeline is not None:
+            state["timeline"] = self.timeline.to_state()
+        return state
+
+    def load_state(self, state: Dict[str, Any]) -> None:
+        """
+        Восстановление состояния, сохраненного to_state. Агрегат должен быть пустым
+        и создан с тем же типом хранилища значений.
+        """
+        if state["aggregator"] != self.kind:
+            raise ValueError(
+                f"Aggregate state kind {state['aggregator']} does not match {self.kind}"
+            )
+        for url, (count, time_max, values_state) in state["urls"].items():
+            stats = UrlAggregate(self.values_factory())
+            stats.count = count
+            stats.time_max = time_max
+            stats.values.load_state(values_state)
+            if self.bytes_urls:
+                url = url.encode(ENCODING_UTF8, "surrogateescape")
+            self.urls[url] = stats
+        if self.timeline is not None and "timeline" in state:
+            self.timeline.load_state(state["timeline"], self.bytes_urls)
+
+
+def aggregator_kind(config: Dict[str, Any]) -> str:
+    """
+    Хранилище медианы из AGGREGATOR. По умолчанию exact, а в инкрементальном
+    режиме sketch: агрегат exact хранит все request_time и каждый запуск
+    сохранял бы и читал чекпоинт размером со всю прочитанную часть лога
+    """
+    kind = config.get("AGGREGATOR")
+    if kind:
+        return kind
+    return AGGREGATOR_SKETCH if config.get("INCREMENTAL") else AGGREGATOR_EXACT
+
+
+def create_aggregate(config: Dict[str, Any]) -> LogAggregate:
+    """
+    Создает пустой агрегат с хранилищем медианы, выбранным в конфиге (AGGREGATOR),
+    и нормализацией URL (URL_QUERY, URL_COLLAPSE_IDS, MAX_URLS); при заданном
+    TIME_BUCKET агрегат строит и сетку отчета по времени
+    """
+    kind = aggregator_kind(config)
+    bytes_urls = is_bytes_mode(config)
+    normalizer = create_url_normalizer(config)
+    max_urls = config.get("MAX_URLS")
+    if kind == AGGREGATOR_EXACT:
+        values_factory: Callable[[], Any] = ExactValues
+    elif kind == AGGREGATOR_SKETCH:
+        relative_error = (
+            config.get("MEDIAN_RELATIVE_ERROR") or DEFAULT_MEDIAN_RELATIVE_ERROR
+        )
+        values_factory = partial(QuantileSketch, relative_error)
+    else:
+        raise ValueError(f"Unknown aggregator: {kind}")
+    return LogAggregate(
+        values_factory, kind, bytes_urls, normalizer, max_urls, create_timeline(config)
+    )
+
+
+def partial_aggregate_config(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Конфиг для агрегатов частей лога, которые потом сливаются: MAX_URLS не
+    применяется, ограничение делает итоговый агрегат при слиянии. Иначе URL,
+    попавший в (other) в одной части, недосчитывается в собственной строке.
+    """
+    return {**config, "MAX_URLS": None}
+
+
+def aggregate_entries(
+    entries: Iterable[LogEntry], aggregate: LogAggregate
+) -> LogAggregate:
+    """
+    Накапливает request_time по каждому URL
+    """
+    if aggregate.timeline is not None:
+        for entry in entries:
+            aggregate.add(entry.url, entry.request_time, entry.timestamp)
+        return aggregate
+    for entry in entries:
+        aggregate.add(entry.url, entry.request_time)
+    return aggregate
+
+
+def aggregate_lines(
+    lines: Iterable[str],
+    aggregate: LogAggregate,
+    config: Dict[str, Any],
+    monitor: Optional[ParseErrorMonitor] = None,
+) -> Tuple[int, int]:
+    """
+    Разбирает строки и добавляет их в агрегат. Порог ошибок проверяется только
+    досрочно (ParseErrorMonitor), итоговую проверку делает вызывающий код.
+    :return: общее число строк и число ошибок разбора
+    """
+    parse = get_line_parser(config)
+    if monitor is None:
+        monitor = ParseErrorMonitor(config, structlog.get_logger())
+    with_time = aggregate.timeline is not None
+    total = 0
+    errors = 0
+    for line in lines:
+        total += 1
+        entry = parse(line)
+        if entry is None:
+            errors += 1
+            monitor.error(line, total)
+            continue
+        if with_time:
+            aggregate.add(entry.url, entry.request_time, entry.timestamp)
+        else:
+            aggregate.add(entry.url, entry.request_time)
+    return total, errors
+
+
+def _aggregate_log_range(
+    path: Path, start: int, end: int, config: Dict[str, Any]
+) -> Tuple[LogAggregate, int, int, List[str]]:
+    """
+    Задача воркера: разбирает свой диапазон лога и возвращает агрегат по URL,
+    общее число строк, число ошибок разбора и выборку нераспарсенных строк
+    """
+    aggregate = create_aggregate(config)
+    monitor = ParseErrorMonitor(config, structlog.get_logger())
+    lines = read_log_range_lines(path, start, end, config)
+    total, errors = aggregate_lines(lines, aggregate, config, monitor)
+    return aggregate, total, errors, monitor.samples
+
+
+def aggregate_log_parallel(
+    logfile: LogFile, config: Dict[str, Any], logger
+) -> LogAggregate:
+    """
+    Параллельный разбор несжатого лога: файл делится на диапазоны байт,
+    каждый диапазон разбирается в отдельном процессе, результаты сливаются
+    в порядке следования диапазонов, поэтому отчет совпадает с однопроцессным.
+    """
+    ranges = split_log_file(logfile.path, config["WORKERS"])
+    logger.info(f"Try to parse file {logfile.path} in {len(ranges)} processes")
+
+    aggregate = create_aggregate(config)
+    chunk_config = partial_aggregate_config(config)
+    monitor = ParseErrorMonitor(config, logger)
+    total = 0
+    with ProcessPoolExecutor(max_workers=max(len(ranges), 1)) as pool:
+        futures = [
+            pool.submit(_aggregate_log_range, logfile.path, start, end, chunk_config)
+            for start, end in ranges
+        ]
+        for future in futures:
+            chunk_aggregate, chunk_total, chunk_errors, samples = future.result()
+            aggregate.merge(chunk_aggregate)
+            total += chunk_total
+            monitor.merge(chunk_errors, samples)
+    monitor.finish(total)
+    return aggregate
+
+
+def process_entries(
+    entries: Iterator[LogEntry], config: Dict[str, Any], logger
+) -> List[Dict[str, Any]]:
+    """
+    Высчитываем статистику на основе LogEntry генератора
+    :param entries: генератор
+    :param config: Конфиг исполнения программы
+    :param logger: логгер исполнения
+    :return:
+    """
+    if is_numpy_engine(config):
+        urls, url_ids, request_times, _ = collect_columns(entries)
+        return build_report_numpy(urls, url_ids, request_times, config, logger)
+    aggregate = aggregate_entries(entries, create_aggregate(config))
+    return build_report(aggregate, config, logger)
+
+
+def is_numpy_engine(config: Dict[str, Any]) -> bool:
+    engine = config.get("ENGINE") or ENGINE_PYTHON
+    if engine not in (ENGINE_PYTHON, ENGINE_NUMPY):
+        raise ValueError(f"Unknown engine: {engine}")
+    return engine == ENGINE_NUMPY
+
+
+def collect_columns(
+    entries: Iterable[Any], with_time: bool = False
+) -> Tuple[List[Any], array, array, array]:
+    """
+    Собирает записи лога в колонки в памяти: словарь URL в порядке первого
+    появления, id URL, request_time и, при with_time, время запроса
+    """
+    url_index: Dict[Any, int] = {}
+    url_ids = array("I")
+    request_times = array("d")
+    timestamps = array("q")
+    for entry in entries:
+        url_id = url_index.get(entry.url)
+        if url_id is None:
+            url_id = url_index[entry.url] = len(url_index)
+        url_ids.append(url_id)
+        request_times.append(entry.request_time)
+        if with_time:
+            timestamps.append(entry.timestamp)
+    return list(url_index), url_ids, request_times, timestamps
+
+
+def timeline_from_columns(
+    urls: List[Any],
+    url_ids: Iterable[int],
+    request_times: Iterable[float],
+    timestamps: Iterable[int],
+    config: Dict[str, Any],
+) -> Optional[LatencyTimeline]:
+    """
+    Сетка отчета по времени по колонкам (движок numpy) с той же группировкой
+    URL, что и в LogAggregate
+    """
+    timeline = create_timeline(config)
+    if timeline is None:
+        return None
+    keys, url_groups = group_urls(urls, config)
+    url_keys = [keys[group] for group in url_groups]
+    add = timeline.add
+    for url_id, request_time, timestamp in zip(url_ids, request_times, timestamps):
+        add(timestamp, url_keys[url_id], request_time)
+    return timeline
+
+
+def build_report(
+    aggregate: LogAggregate, config: Dict[str, Any], logger
+) -> List[Dict[str, Any]]:
+    """
+    Формирует строки отчета по накопленному агрегату
+    """
+    report_size: int = config.get("REPORT_SIZE") or 1000
+    total_count = aggregate.total_count
+    total_time = aggregate.total_time
+
+    # Отбор top-K по time_sum кучей без сортировки всех URL; nlargest
+    # сохраняет порядок первого появления при равных суммах, как sorted.
+    # Медиана и остальные поля считаются только для попавших в отчет URL
+    top = heapq.nlargest(
+        report_size,
+        ((stats.time_sum, url, stats) for url, stats in aggregate.urls.items()),
+        key=itemgetter(0),
+    )
+
+    report = []
+    for time_sum, url, stats in top:
+        count = stats.count
+        report.append(
+            {
+                # Байтовые URL декодируются только для строк, попавших в отчет
+                "url": url_to_str(url),
+                "count": count,
+                "count_perc": count / total_count,
+                "time_sum": time_sum,
+                "time_perc": time_sum / total_time,
+                "time_avg": time_sum / count,
+                "time_max": stats.time_max,
+                "time_med": stats.values.median(),
+            }
+        )
+    return report
+
+
+def build_report_numpy(
+    urls: List[Any],
+    url_ids: Any,
+    request_times: Any,
+    config: Dict[str, Any],
+    logger,
+) -> List[Dict[str, Any]]:
+    """
+    Векторизованный расчет отчета (ENGINE=numpy) по колонкам id URL и request_time.
+    Строки отчета совпадают с build_report: суммы для отбора считаются через
+    np.bincount, а для URL на границе отчета и попавших в него пересчитываются
+    точно через math.fsum; медиана и максимум считаются по отсортированным
+    сегментам только для URL из отчета.
+    :param urls: URL по id в порядке первого появления в логе
+    """
+    try:
+        import numpy as np
+    except ImportError as e:
+        raise RuntimeError("Engine numpy requires numpy to be installed") from e
+
+    report_size: int = config.get("REPORT_SIZE") or 1000
+    ids = np.frombuffer(url_ids, dtype=np.uint32)
+    if create_url_normalizer(config) is not None or config.get("MAX_URLS") is not None:
+        urls, url_groups = group_urls(urls, config)
+        ids = np.asarray(url_groups, dtype=np.uint32)[ids]
+    request_time_values = np.frombuffer(request_times, dtype=np.float64)
+    if not len(ids):
+        return []
+    counts = np.bincount(ids, minlength=len(urls))
+    approx_sums = np.bincount(ids, weights=request_time_values, minlength=len(urls))
+    present = np.flatnonzero(counts)
+    total_count = int(len(ids))
+    total_time = math.fsum(request_time_values.tolist())
+
+    # Кандидаты в отчет: k наибольших приближенных сумм плюс все URL,
+    # отличающиеся от k-й суммы меньше погрешности суммирования
+    candidates = present
+    if len(present) > report_size:
+        present_sums = approx_sums[present]
+        kth = np.partition(present_sums, len(present) - report_size)[
+            len(present) - report_size
+        ]
+        tolerance = kth * 1e-9 + float(np.finfo(np.float64).tiny)
+        candidates = present[present_sums >= kth - tolerance]
+
+    selected = np.zeros(len(urls), dtype=bool)
+    selected[candidates] = True
+    rows = selected[ids]
+    candidate_ids = ids[rows]
+    candidate_times = request_time_values[rows]
+    # Эквивалент np.lexsort((candidate_times, candidate_ids)), но вторая
+    # стабильная сортировка целых id идет radix sort и заметно быстрее
+    order = np.argsort(candidate_times)
+    order = order[np.argsort(candidate_ids[order], kind="stable")]
+    sorted_ids = candidate_ids[order]
+    sorted_times = candidate_times[order]
+    starts = np.searchsorted(sorted_ids, candidates, side="left")
+    ends = np.searchsorted(sorted_ids, candidates, side="right")
+
+    ranked = []
+    for url_id, start, end in zip(candidates.tolist(), starts.tolist(), ends.tolist()):
+        ranked.append((math.fsum(sorted_times[start:end].tolist()), url_id, start, end))
+    # Как и в build_report: по убыванию суммы, при равенстве - по первому появлению
+    ranked.sort(key=lambda item: (-item[0], item[1]))
+
+    report = []
+    for time_sum, url_id, start, end in ranked[:report_size]:
+        count = end - start
+        middle = count // 2
+        if count % 2:
+            median = float(sorted_times[start + middle])
+        else:
+            median = (
+                float(sorted_times[start + middle - 1])
+                + float(sorted_times[start + middle])
+            ) / 2
+        report.append(
+            {
+                "url": url_to_str(urls[url_id]),
+                "count": count,
+                "count_perc": count / total_count,
+                "time_sum": time_sum,
+                "time_perc": time_sum / total_time,
+                "time_avg": time_sum / count,
+                "time_max": float(sorted_times[end - 1]),
+                "time_med": median,
+            }
+        )
+    return report
+
+
+@lru_cache(maxsize=8)
+def _template_parts(path: str, mtime_ns: int, size: int) -> Tuple[str, ...]:
+    """
+    Части шаблона вокруг $table_json. Кэш по mtime и размеру файла: в режиме
+    демона шаблон читается заново, только когда он изменился.
+    """
+    # Маркер подставляется через safe_substitute, чтобы остальные $-выражения
+    # шаблона обрабатывались так же, как при подстановке всего отчета
+    marker = "\0table_json\0"
+    tpl = Template(Path(path).read_text(encoding=ENCODING_UTF8))
+    return tuple(tpl.safe_substitute(table_json=marker).split(marker))
+
+
+def stream_report(
+    report_data: List[Dict[str, Any]], filename: str, config: Dict[str, Any], logger
+):
+    """
+    Потоковая запись отчета без сборки всего HTML в памяти: пишется часть шаблона
+    до $table_json, затем строки отчета JSON-фрагментами по REPORT_CHUNK_ROWS,
+    затем остаток шаблона. Результат совпадает с Template.safe_substitute
+    шаблона с table_json=json.dumps(report_data). Отчет пишется
+    во временный файл и атомарно переименовывается, поэтому недописанный отчет
+    не появится в директории отчетов.
+    """
+    template_path: Path = BASE_DIR / config["TEMPLATE"]
+    output_path: Path = BASE_DIR / config[REPORT_DIR_KEY] / filename
+    logger.info(f"Try to save file {output_path}")
+    stat = template_path.stat()
+    parts = _template_parts(str(template_path), stat.st_mtime_ns, stat.st_size)
+
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    try:
+        with tmp_path.open("w", encoding=ENCODING_UTF8) as f:
+            f.write(parts[0])
+            for part in parts[1:]:
+                f.write("[")
+                for start in range(0, len(report_data), REPORT_CHUNK_ROWS):
+                    if start:
+                        f.write(", ")
+                    chunk = json.dumps(report_data[start : start + REPORT_CHUNK_ROWS])
+                    f.write(chunk[1:-1])
+                f.write("]")
+                f.write(part)
+        os.replace(tmp_path, output_path)
+    except Exception:
+        logger.exception("Failed to render report.")
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def timeline_report_filename(logfile: LogFile) -> str:
+    return f"report-{logfile.date.strftime('%Y.%m.%d')}.timeline.json"
+
+
+def save_timeline_report(
+    timeline: LatencyTimeline,
+    report_data: List[Dict[str, Any]],
+    logfile: LogFile,
+    config: Dict[str, Any],
+    logger,
+):
+    """
+    Сохраняет отчет по времени рядом с основным отчетом (JSON): квантили
+    request_time по корзинам TIME_BUCKET в целом и для первых TIME_REPORT_URLS
+    URL основного отчета
+    """
+    urls = [row["url"] for row in report_data[: time_report_url_count(config)]]
+    output_path: Path = (
+        BASE_DIR / config[REPORT_DIR_KEY] / timeline_report_filename(logfile)
+    )
+    logger.info(f"Try to save timeline report {output_path}")
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    with tmp_path.open("w", encoding=ENCODING_UTF8) as f:
+        json.dump(timeline.report(urls), f)
+    os.replace(tmp_path, output_path)
+
+
+class Checkpoint(NamedTuple):
+    path: str
+    inode: int
+    offset: int
+    total: int
+    errors: int
+    aggregate: LogAggregate
+
+
+def checkpoint_path(config: Dict[str, Any]) -> Path:
+    return BASE_DIR / config[REPORT_DIR_KEY] / CHECKPOINT_FILENAME
+
+
+def load_checkpoint(config: Dict[str, Any], logger) -> Optional[Checkpoint]:
+    """
+    Загрузка чекпоинта инкрементального режима. Несовместимый или битый
+    чекпоинт игнорируется, тогда лог будет перечитан с начала.
+    """
+    path = checkpoint_path(config)
+    if not path.exists():
+        return None
+    try:
+        with path.open(encoding=ENCODING_UTF8) as f:
+            state = json.load(f)
+        aggregate = create_aggregate(config)
+        aggregate.load_state(state["aggregate"])
+        return Checkpoint(
+            path=state["path"],
+            inode=state["inode"],
+            offset=state["offset"],
+            total=state["total"],
+            errors=state["errors"],
+            aggregate=aggregate,
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        logger.exception(f"Failed to load checkpoint {path}, start from scratch")
+        return None
+
+
+def save_checkpoint(checkpoint: Checkpoint, config: Dict[str, Any], logger):
+    """
+    Атомарно сохраняет чекпоинт рядом с отчетами
+    """
+    path = checkpoint_path(config)
+    logger.info(f"Try to save checkpoint {path}", offset=checkpoint.offset)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w", encoding=ENCODING_UTF8) as f:
+        json.dump(
+            {
+                "path": checkpoint.path,
+                "inode": checkpoint.inode,
+                "offset": checkpoint.offset,
+                "total": checkpoint.total,
+                "errors": checkpoint.errors,
+                "aggregate": checkpoint.aggregate.to_state(),
+            },
+            f,
+        )
+    os.replace(tmp_path, path)
+
+
+def find_last_line_end(path: Path, start: int, end: int) -> int:
+    """
+    Позиция сразу после последнего перевода строки в диапазоне [start, end).
+    Недописанная последняя строка растущего лога будет прочитана в следующий запуск.
+    """
+    block_size = 1 << 16
+    with path.open("rb") as f:
+        position = end
+        while position > start:
+            block_start = max(start, position - block_size)
+            f.seek(block_start)
+            block = f.read(position - block_start)
+            index = block.rfind(b"\n")
+            if index != -1:
+                return block_start + index + 1
+            position = block_start
+    return start
+
+
+def update_incremental(
+    logfile: LogFile,
+    checkpoint: Optional[Checkpoint],
+    config: Dict[str, Any],
+    logger,
+) -> Checkpoint:
+    """
+    Дочитывает лог с позиции чекпоинта и добавляет новые строки в сохраненный агрегат.
+    Если чекпоинт относится к другому файлу (сменился inode, файл обрезан),
+    лог читается с начала. Gzip-лог не дочитывается, а перечитывается целиком.
+    """
+    stat = logfile.path.stat()
+    if (
+        checkpoint is None
+        or checkpoint.path != str(logfile.path)
+        or checkpoint.inode != stat.st_ino
+        or checkpoint.offset > stat.st_size
+    ):
+        checkpoint = Checkpoint(
+            path=str(logfile.path),
+            inode=stat.st_ino,
+            offset=0,
+            total=0,
+            errors=0,
+            aggregate=create_aggregate(config),
+        )
+
+    if logfile.ext == ".gz":
+        if checkpoint.offset == stat.st_size:
+            return checkpoint
+        # Сжатый лог нельзя дочитать с середины, перечитываем его целиком
+        checkpoint = checkpoint._replace(
+            offset=0, total=0, errors=0, aggregate=create_aggregate(config)
+        )
+        lines = open_log_lines(logfile, logger, config)
+        end = stat.st_size
+    else:
+        end = find_last_line_end(logfile.path, checkpoint.offset, stat.st_size)
+        lines = read_log_range_lines(logfile.path, checkpoint.offset, end, config)
+
+    monitor = ParseErrorMonitor(config, logger)
+    total, errors = aggregate_lines(lines, checkpoint.aggregate, config, monitor)
+    logger.info(
+        f"Log {logfile.path} processed incrementally",
+        start=checkpoint.offset,
+        end=end,
+        lines=total,
+    )
+    monitor.log_samples()
+    total += checkpoint.total
+    errors += checkpoint.errors
+    check_parse_errors(total, errors, config, logger)
+    return checkpoint._replace(offset=end, total=total, errors=errors)
+
+
+def write_report(
+    aggregate: LogAggregate, logfile: LogFile, config: Dict[str, Any], logger
+):
+    """
+    Строит, рендерит и сохраняет отчет по агрегату лога
+    """
+    report_data = build_report(aggregate, config, logger)
+    save_report(report_data, logfile, config, logger)
+    if aggregate.timeline is not None:
+        save_timeline_report(aggregate.timeline, report_data, logfile, config, logger)
+
+
+def save_report(
+    report_data: List[Dict[str, Any]], logfile: LogFile, config: Dict[str, Any], logger
+):
+    """
+    Рендерит и сохраняет отчет лога
+    """
+    stream_report(report_data, report_filename(logfile), config, logger)
+
+
+def run_incremental(config: Dict[str, Any], logger):
+    """
+    Инкрементальный режим: последний лог дочитывается с места предыдущего запуска,
+    отчет перерисовывается по накопленному агрегату
+    """
+    last_log_file = find_last_log(config, logger, skip_reported=False)
+    if not last_log_file:
+        logger.info("No logs to process")
+        return
+
+    if aggregator_kind(config) == AGGREGATOR_EXACT:
+        logger.warning(
+            "AGGREGATOR=exact keeps every request_time in the checkpoint, "
+            "each incremental run rewrites all values read so far"
+        )
+    checkpoint = load_checkpoint(config, logger)
+    if checkpoint is not None and checkpoint.path != str(last_log_file.path):
+        # Появился лог за новый день: дописываем хвост предыдущего лога в его отчет
+        previous_log_file = log_file_from_path(Path(checkpoint.path))
+        if previous_log_file is not None and previous_log_file.path.exists():
+            previous = update_incremental(previous_log_file, checkpoint, config, logger)
+            if previous.offset != checkpoint.offset:
+                write_report(previous.aggregate, previous_log_file, config, logger)
+        checkpoint = None
+
+    previous_offset = checkpoint.offset if checkpoint is not None else -1
+    checkpoint = update_incremental(last_log_file, checkpoint, config, logger)
+    report_exists = (
+        BASE_DIR / config[REPORT_DIR_KEY] / report_filename(last_log_file)
+    ).exists()
+    if checkpoint.offset == previous_offset and report_exists:
+        logger.info("No new lines in log", path=str(last_log_file.path))
+        return
+
+    write_report(checkpoint.aggregate, last_log_file, config, logger)
+    save_checkpoint(checkpoint, config, logger)
+    logger.info(
+        f"Report updated incrementally for day {last_log_file.date.strftime('%Y.%m.%d')}"
+    )
+
+
+class ColumnarLog(NamedTuple):
+    """
+    Разобранный лог в колоночном виде. Колонки - memoryview поверх mmap файлов кэша.
+    """
+
+    urls: List[str]
+    url_id: memoryview
+    request_time: memoryview
+    time: memoryview
+    total: int
+    errors: int
+
+
+class ColumnarWriter:
+    """
+    Запись колоночного кэша разобранного лога: словарь URL (urls.json),
+    id URL (uint32), request_time (float64) и время запроса (int64, unix-время).
+    Колонки пишутся блоками во временную директорию, которая после успешного
+    завершения атомарно переименовывается. request_time хранится в float64,
+    чтобы отчет по кэшу совпадал с отчетом по исходному логу.
+    """
+
+    def __init__(self, directory: Path, source: Path) -> None:
+        self.directory = directory
+        self.source = source
+        self.tmp_directory = directory.with_name(f"{directory.name}.tmp-{os.getpid()}")
+        self.url_ids: Dict[Any, int] = {}
+        self.columns = {
+            name: array(typecode) for name, typecode in COLUMNAR_COLUMNS.items()
+        }
+        self.files: Dict[str, IO[bytes]] = {}
+        self.rows = 0
+        self.lines = 0
+
+    def __enter__(self) -> "ColumnarWriter":
+        if self.tmp_directory.exists():
+            shutil.rmtree(self.tmp_directory)
+        self.tmp_directory.mkdir(parents=True)
+        self.files = {
+            name: (self.tmp_directory / name).open("wb") for name in COLUMNAR_COLUMNS
+        }
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self._flush()
+        for f in self.files.values():
+            f.close()
+        if exc_type is not None:
+            shutil.rmtree(self.tmp_directory, ignore_errors=True)
+            return
+        self._write_meta()
+        if self.directory.exists():
+            shutil.rmtree(self.directory)
+        os.replace(self.tmp_directory, self.directory)
+
+    def count_lines(self, lines: Iterable[Any]) -> Iterator[Any]:
+        """
+        Пропускает строки лога, считая их (для числа ошибок разбора в метаданных)
+        """
+        for line in lines:
+            self.lines += 1
+            yield line
+
+    def tee(self, entries: Iterable[Any]) -> Iterator[Any]:
+        """
+        Пропускает записи лога, сохраняя их в колонки
+        """
+        for entry in entries:
+            self.add(entry)
+            yield entry
+
+    def add(self, entry: Any) -> None:
+        url = entry.url
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.url_ids[url] = len(self.url_ids)
+        columns = self.columns
+        columns["url_id"].append(url_id)
+        columns["request_time"].append(entry.request_time)
+        columns["time"].append(entry.timestamp)
+        self.rows += 1
+        if len(columns["url_id"]) >= COLUMNAR_FLUSH_ROWS:
+            self._flush()
+
+    def _flush(self) -> None:
+        for name, column in self.columns.items():
+            column.tofile(self.files[name])
+            del column[:]
+
+    def _write_meta(self) -> None:
+        stat = self.source.stat()
+        urls = [url_to_str(url) for url in self.url_ids]
+        with (self.tmp_directory / "urls.json").open("w", encoding=ENCODING_UTF8) as f:
+            json.dump(urls, f)
+        meta = {
+            "format": COLUMNAR_FORMAT_VERSION,
+            "byteorder": sys.byteorder,
+            "source": str(self.source),
+            "source_size": stat.st_size,
+            "source_mtime_ns": stat.st_mtime_ns,
+            "rows": self.rows,
+            "total": self.lines,
+            "errors": self.lines - self.rows,
+        }
+        with (self.tmp_directory / "meta.json").open("w", encoding=ENCODING_UTF8) as f:
+            json.dump(meta, f)
+
+
+def columnar_cache_path(logfile: LogFile, config: Dict[str, Any]) -> Path:
+    return BASE_DIR / config["COLUMNAR_CACHE_DIR"] / logfile.date.strftime("%Y%m%d")
+
+
+def _map_column(path: Path, typecode: str) -> memoryview:
+    with path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(array(typecode))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode)
+
+
+def load_columnar_log(directory: Path) -> ColumnarLog:
+    """
+    Загрузка колоночного кэша. Колонки отображаются в память через mmap,
+    поэтому загрузка не зависит от размера лога. Удобно и для разовых запросов:
+
+        log = load_columnar_log(Path("cache/20170630"))
+        slow = sum(1 for t in log.request_time if t > 1.0)
+    """
+    with (directory / "meta.json").open(encoding=ENCODING_UTF8) as f:
+        meta = json.load(f)
+    if meta["format"] != COLUMNAR_FORMAT_VERSION or meta["byteorder"] != sys.byteorder:
+        raise ValueError(f"Unsupported columnar cache {directory}")
+    with (directory / "urls.json").open(encoding=ENCODING_UTF8) as f:
+        urls = json.load(f)
+    columns = {
+        name: _map_column(directory / name, typecode)
+        for name, typecode in COLUMNAR_COLUMNS.items()
+    }
+    if any(len(column) != meta["rows"] for column in columns.values()):
+        raise ValueError(f"Broken columnar cache {directory}")
+    return ColumnarLog(urls=urls, total=meta["total"], errors=meta["errors"], **columns)
+
+
+def find_columnar_log(
+    logfile: LogFile, config: Dict[str, Any], logger
+) -> Optional[ColumnarLog]:
+    """
+    Колоночный кэш лога, если он есть и построен по текущей версии файла
+    """
+    directory = columnar_cache_path(logfile, config)
+    meta_path = directory / "meta.json"
+    if not meta_path.exists():
+        return None
+    try:
+        with meta_path.open(encoding=ENCODING_UTF8) as f:
+            meta = json.load(f)
+        stat = logfile.path.stat()
+        if (
+            meta["source"] != str(logfile.path)
+            or meta["source_size"] != stat.st_size
+            or meta["source_mtime_ns"] != stat.st_mtime_ns
+        ):
+            logger.info(f"Columnar cache {directory} is stale")
+            return None
+        return load_columnar_log(directory)
+    except (OSError, ValueError, KeyError):
+        logger.exception(f"Failed to load columnar cache {directory}")
+        return None
+
+
+def aggregate_columnar(columns: ColumnarLog, aggregate: LogAggregate) -> LogAggregate:
+    """
+    Агрегация по колоночному кэшу без разбора строк
+    """
+    urls: List[Any] = columns.urls
+    if aggregate.bytes_urls:
+        urls = [url.encode(ENCODING_UTF8, "surrogateescape") for url in urls]
+    add = aggregate.add
+    if aggregate.timeline is not None:
+        for url_id, request_time, timestamp in zip(
+            columns.url_id, columns.request_time, columns.time
+        ):
+            add(urls[url_id], request_time, timestamp)
+        return aggregate
+    for url_id, request_time in zip(columns.url_id, columns.request_time):
+        add(urls[url_id], request_time)
+    return aggregate
+
+
+class StageStats:
+    __slots__ = ("wall", "cpu", "lines", "peak_rss_mb")
+
+    def __init__(self) -> None:
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.lines = 0
+        self.peak_rss_mb = 0.0
+
+
+class StageMetrics:
+    """
+    Метрики стадий обработки лога (STAGE_METRICS): время, процессорное время,
+    число строк и пиковый RSS процесса на конец стадии. Стадии-генераторы
+    (чтение и разбор строк) вложены друг в друга, поэтому для каждой стадии
+    считается собственное время без времени вложенных стадий.
+    """
+
+    def __init__(self) -> None:
+        self.stages: Dict[str, StageStats] = {}
+        # Время вложенных стадий для каждой открытой стадии: [wall, cpu]
+        self._stack: List[List[float]] = []
+
+    def _stats(self, name: str) -> StageStats:
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+        return stats
+
+    def _enter(self) -> Tuple[float, float]:
+        self._stack.append([0.0, 0.0])
+        return time.perf_counter(), time.process_time()
+
+    def _exit(self, name: str, started: Tuple[float, float]) -> None:
+        wall = time.perf_counter() - started[0]
+        cpu = time.process_time() - started[1]
+        child_wall, child_cpu = self._stack.pop()
+        stats = self._stats(name)
+        stats.wall += wall - child_wall
+        stats.cpu += cpu - child_cpu
+        if self._stack:
+            self._stack[-1][0] += wall
+            self._stack[-1][1] += cpu
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = self._enter()
+        try:
+            yield
+        finally:
+            self._exit(name, started)
+            self._stats(name).peak_rss_mb = peak_rss_mb()
+
+    def iterate(self, name: str, items: Iterable[Any]) -> Iterator[Any]:
+        """
+        Пропускает элементы генератора, учитывая время их получения в стадии name
+        """
+        stats = self._stats(name)
+        iterator = iter(items)
+        while True:
+            started = self._enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                self._exit(name, started)
+            stats.lines += 1
+            yield item
+        stats.peak_rss_mb = peak_rss_mb()
+
+    def emit(self, logger, **fields) -> None:
+        for name, stats in self.stages.items():
+            logger.info(
+                "Stage metrics",
+                stage=name,
+                wall_s=round(stats.wall, 6),
+                cpu_s=round(stats.cpu, 6),
+                lines=stats.lines,
+                lines_per_s=(
+                    round(stats.lines / stats.wall)
+                    if stats.lines and stats.wall
+                    else None
+                ),
+                peak_rss_mb=round(stats.peak_rss_mb, 1),
+                **fields,
+            )
+
+
+def peak_rss_mb() -> float:
+    # Модуль resource есть только в POSIX, в Windows пиковая память не измеряется
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    # ru_maxrss в Linux - КБ, в macOS - байты
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1 << 20 if sys.platform == "darwin" else 1024)
+
+
+def measured(
+    metrics: Optional[StageMetrics], name: str, items: Iterable[Any]
+) -> Iterable[Any]:
+    return items if metrics is None else metrics.iterate(name, items)
+
+
+@contextmanager
+def measured_stage(metrics: Optional[StageMetrics], name: str) -> Iterator[None]:
+    if metrics is None:
+        yield
+    else:
+        with metrics.stage(name):
+            yield
+
+
+def aggregate_log(
+    logfile: LogFile,
+    config: Dict[str, Any],
+    logger,
+    metrics: Optional[StageMetrics] = None,
+) -> LogAggregate:
+    """
+    Агрегат по логу: из колоночного кэша, параллельным или последовательным разбором.
+    При последовательном разборе и заданном COLUMNAR_CACHE_DIR кэш сохраняется.
+    """
+    use_cache = bool(config.get("COLUMNAR_CACHE_DIR"))
+    if use_cache:
+        columns = find_columnar_log(logfile, config, logger)
+        if columns is not None:
+            logger.info(
+                f"Use columnar cache for {logfile.path}", rows=len(columns.url_id)
+            )
+            check_parse_errors(columns.total, columns.errors, config, logger)
+            with measured_stage(metrics, "aggregate"):
+                return aggregate_columnar(columns, create_aggregate(config))
+
+    workers = config.get("WORKERS") or 1
+    if workers > 1 and logfile.ext != ".gz":
+        if use_cache:
+            logger.info("Columnar cache is written only by single process parsing")
+        # Разбор и агрегация идут в воркерах, учитывается их общее время
+        with measured_stage(metrics, "aggregate"):
+            return aggregate_log_parallel(logfile, config, logger)
+    if workers > 1:
+        logger.info("Gzip log can not be split, parse it in one process")
+
+    lines = measured(metrics, "open", open_log_lines(logfile, logger, config))
+    if not use_cache:
+        entries = measured(metrics, "parse", parse_log(lines, config, logger))
+        with measured_stage(metrics, "aggregate"):
+            return aggregate_entries(entries, create_aggregate(config))
+
+    directory = columnar_cache_path(logfile, config)
+    logger.info(f"Write columnar cache {directory}")
+    with ColumnarWriter(directory, logfile.path) as writer:
+        entries = measured(
+            metrics, "parse", parse_log(writer.count_lines(lines), config, logger)
+        )
+        with measured_stage(metrics, "aggregate"):
+            return aggregate_entries(writer.tee(entries), create_aggregate(config))
+
+
+def report_numpy_for_log(
+    logfile: LogFile,
+    config: Dict[str, Any],
+    logger,
+    metrics: Optional[StageMetrics] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[LatencyTimeline]]:
+    """
+    Отчет движком numpy: колонки берутся из колоночного кэша (при необходимости
+    он строится), без кэша лог разбирается в колонки в памяти
+    :return: строки отчета и сетка отчета по времени (если задан TIME_BUCKET)
+    """
+    with_time = create_timeline(config) is not None
+    if config.get("COLUMNAR_CACHE_DIR"):
+        columns = find_columnar_log(logfile, config, logger)
+        if columns is None:
+            directory = columnar_cache_path(logfile, config)
+            logger.info(f"Write columnar cache {directory}")
+            lines = measured(metrics, "open", open_log_lines(logfile, logger, config))
+            with ColumnarWriter(directory, logfile.path) as writer:
+                entries = measured(
+                    metrics,
+                    "parse",
+                    parse_log(writer.count_lines(lines), config, logger),
+                )
+                for _ in writer.tee(entries):
+                    pass
+            columns = load_columnar_log(directory)
+        check_parse_errors(columns.total, columns.errors, config, logger)
+        urls, url_ids, request_times, timestamps = columns[:4]
+    else:
+        if (config.get("WORKERS") or 1) > 1:
+            logger.info("Engine numpy parses log in one process")
+        lines = measured(metrics, "open", open_log_lines(logfile, logger, config))
+        entries = measured(metrics, "parse", parse_log(lines, config, logger))
+        with measured_stage(metrics, "aggregate"):
+            urls, url_ids, request_times, timestamps = collect_columns(
+                entries, with_time
+            )
+
+    with measured_stage(metrics, "report"):
+        report_data = build_report_numpy(urls, url_ids, request_times, config, logger)
+    timeline = None
+    if with_time:
+        timeline = timeline_from_columns(
+            urls, url_ids, request_times, timestamps, config
+        )
+    return report_data, timeline
+
+
+def process_log_file(logfile: LogFile, config: Dict[str, Any], logger):
+    """
+    Полная обработка одного лога: разбор, агрегация и сохранение отчета.
+    При STAGE_METRICS метрики стадий пишутся в лог программы.
+    """
+    metrics = StageMetrics() if config.get("STAGE_METRICS") else None
+    if is_numpy_engine(config):
+        report_data, timeline = report_numpy_for_log(logfile, config, logger, metrics)
+    else:
+        aggregate = aggregate_log(logfile, config, logger, metrics)
+        with measured_stage(metrics, "report"):
+            report_data = build_report(aggregate, config, logger)
+        timeline = aggregate.timeline
+    with measured_stage(metrics, "render"):
+        save_report(report_data, logfile, config, logger)
+        if timeline is not None:
+            save_timeline_report(timeline, report_data, logfile, config, logger)
+    if metrics is not None:
+        metrics.emit(logger, log_file=str(logfile.path))
+
+
+def _backfill_log(logfile: LogFile, config: Dict[str, Any]) -> LogFile:
+    """
+    Задача воркера пула дозаполнения: строит отчет по одному логу
+    """
+    logger = structlog.get_logger().bind(log_file=str(logfile.path))
+    logger.info("Start processing log")
+    process_log_file(logfile, config, logger)
+    return logfile
+
+
+def run_backfill(config: Dict[str, Any], logger):
+    """
+    Строит отчеты по всем логам без отчета в пуле процессов.
+    BACKFILL_CONCURRENCY ограничивает общее число процессов, поэтому каждый лог
+    разбирается в одном процессе. Ошибка по одному логу не останавливает остальные.
+    """
+    logs = find_unreported_logs(config, logger)
+    if not logs:
+        logger.info("No logs to process")
+        return
+
+    concurrency = config.get("BACKFILL_CONCURRENCY") or os.cpu_count() or 1
+    worker_config = {**config, "WORKERS": 1}
+    logger.info("Start backfill", logs=len(logs), concurrency=concurrency)
+
+    failed = 0
+    with ProcessPoolExecutor(
+        max_workers=min(concurrency, len(logs)),
+        initializer=setup_logging,
+        initargs=(config,),
+    ) as pool:
+        futures = {
+            pool.submit(_backfill_log, logfile, worker_config): logfile
+            for logfile in logs
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            logfile = futures[future]
+            day = logfile.date.strftime("%Y.%m.%d")
+            try:
+                future.result()
+            except Exception:
+                failed += 1
+                logger.exception(f"Failed to build report for day {day}")
+                continue
+            logger.info(f"Report generated for day {day}", done=done, total=len(logs))
+
+    if failed:
+        raise RuntimeError(f"Backfill failed for {failed} of {len(logs)} logs")
+    logger.info("Backfill finished", total=len(logs))
+
+
+def aggregate_filename(logfile: LogFile) -> str:
+    # Имя хоста в имени файла: агрегаты с разных хостов собираются в одну директорию
+    return (
+        f"aggregate-{logfile.date.strftime('%Y.%m.%d')}-{socket.gethostname()}.json.gz"
+    )
+
+
+def save_aggregate_file(
+    aggregate: LogAggregate, logfile: LogFile, config: Dict[str, Any], logger
+) -> Path:
+    """
+    Атомарно сохраняет агрегат лога (to_state) в сжатый JSON в директорию
+    EMIT_AGGREGATE. Такие файлы с разных хостов объединяет run_merge.
+    """
+    output_dir: Path = BASE_DIR / config["EMIT_AGGREGATE"]
+    output_dir.mkdir(parents=True, exist_ok=True)
+    path = output_dir / aggregate_filename(logfile)
+    logger.info(f"Try to save aggregate {path}", urls=len(aggregate.urls))
+    tmp_path = path.with_name(path.name + ".tmp")
+    with gzip.open(tmp_path, "wt", encoding=ENCODING_UTF8, compresslevel=6) as f:
+        json.dump(
+            {
+                "version": AGGREGATE_FORMAT_VERSION,
+                "log": logfile.path.name,
+                "date": logfile.date.strftime("%Y%m%d"),
+                "aggregate": aggregate.to_state(),
+            },
+            f,
+            separators=(",", ":"),
+        )
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_aggregate_file(
+    path: Path, config: Dict[str, Any]
+) -> Tuple[LogFile, LogAggregate]:
+    """
+    Лог и агрегат из файла save_aggregate_file. Агрегат создается по текущему
+    конфигу, поэтому AGGREGATOR и TIME_BUCKET должны совпадать с конфигом хоста.
+    """
+    with gzip.open(path, "rt", encoding=ENCODING_UTF8) as f:
+        state = json.load(f)
+    if state.get("version") != AGGREGATE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported aggregate file version in {path}")
+    logfile = LogFile(
+        path=Path(state["log"]),
+        date=datetime.strptime(state["date"], "%Y%m%d"),
+        ext=Path(state["log"]).suffix,
+    )
+    aggregate = create_aggregate(config)
+    aggregate.load_state(state["aggregate"])
+    return logfile, aggregate
+
+
+def run_emit_aggregate(config: Dict[str, Any], logger):
+    """
+    Вместо отчета по последнему логу сохраняет его агрегат (EMIT_AGGREGATE).
+    Агрегат сохраняется без ограничения MAX_URLS, его применяет run_merge.
+    """
+    last_log_file = find_last_log(config, logger, skip_reported=False)
+    if not last_log_file:
+        logger.info("No logs to process")
+        return
+
+    aggregate = aggregate_log(last_log_file, partial_aggregate_config(config), logger)
+    save_aggregate_file(aggregate, last_log_file, config, logger)
+    logger.info(f"Aggregate saved for day {last_log_file.date.strftime('%Y.%m.%d')}")
+
+
+def run_merge(config: Dict[str, Any], logger):
+    """
+    Объединяет агрегаты одного дня с разных хостов (MERGE_AGGREGATES)
+    и строит по ним общий отчет
+    """
+    paths = [BASE_DIR / path for path in config["MERGE_AGGREGATES"]]
+    merged = create_aggregate(config)
+    day: Optional[datetime] = None
+    logfile: Optional[LogFile] = None
+    for path in paths:
+        logger.info(f"Try to load aggregate {path}")
+        logfile, aggregate = load_aggregate_file(path, config)
+        if day is not None and logfile.date != day:
+            raise ValueError(
+                f"Aggregate {path} is for day {logfile.date.strftime('%Y.%m.%d')}, "
+                f"expected {day.strftime('%Y.%m.%d')}"
+            )
+        day = logfile.date
+        merged.merge(aggregate)
+    if logfile is None:
+        logger.info("No aggregates to merge")
+        return
+
+    write_report(merged, logfile, config, logger)
+    logger.info(
+        f"Report merged from {len(paths)} aggregates for day "
+        f"{logfile.date.strftime('%Y.%m.%d')}"
+    )
+
+
+class InotifyWatcher:
+    """
+    Наблюдение за директорией через inotify(7), вызовы libc через ctypes.
+    Дескриптор (fileno) готов к чтению, когда в директории создан, дописан
+    или перемещен в нее файл. Если inotify недоступен, конструктор бросает OSError.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not supported")
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+        self.fd = fd
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def read_names(self) -> List[str]:
+        """
+        Имена файлов из накопившихся событий. Пустое имя - переполнение
+        очереди событий, после него директорию нужно перечитать.
+        """
+        names = []
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                names.append(os.fsdecode(data[offset : offset + length].rstrip(b"\0")))
+                offset += length
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_log_watcher(
+    config: Dict[str, Any], log_dir: Path, logger
+) -> Optional[InotifyWatcher]:
+    """
+    Наблюдатель за директорией логов по DAEMON_WATCHER: inotify, poll (None -
+    директория опрашивается по таймеру) или auto - inotify, если он доступен
+    """
+    kind = config.get("DAEMON_WATCHER") or DAEMON_WATCHER_AUTO
+    if kind not in (DAEMON_WATCHER_AUTO, DAEMON_WATCHER_INOTIFY, DAEMON_WATCHER_POLL):
+        raise ValueError(f"Unknown daemon watcher: {kind}")
+    if kind == DAEMON_WATCHER_POLL:
+        return None
+    try:
+        return InotifyWatcher(log_dir)
+    except OSError:
+        if kind == DAEMON_WATCHER_INOTIFY:
+            raise
+        logger.info(f"inotify is not available, poll {log_dir}")
+        return None
+
+
+class LogDaemon:
+    """
+    Режим демона (DAEMON): процесс остается запущенным и строит отчеты по новым
+    логам LOG_DIR по мере их появления. Изменения директории отслеживаются через
+    inotify, без него директория опрашивается раз в DAEMON_POLL_INTERVAL секунд.
+    Конфиг, шаблон отчета и кэш нормализации URL загружаются один раз на весь
+    процесс. Лог берется в работу, когда он не менялся DAEMON_SETTLE_SECONDS
+    (ротация и сжатие завершены). Логи старше последнего на момент запуска
+    не обрабатываются, если не задан BACKFILL.
+
+    SIGTERM и SIGINT завершают работу после текущего лога, повторный сигнал
+    прерывает обработку сразу.
+    """
+
+    def __init__(self, config: Dict[str, Any], logger) -> None:
+        self.config = config
+        self.logger = logger
+        self.log_dir: Path = BASE_DIR / config["LOG_DIR"]
+        self.poll_interval = (
+            config.get("DAEMON_POLL_INTERVAL") or DEFAULT_DAEMON_POLL_INTERVAL
+        )
+        settle_seconds = config.get("DAEMON_SETTLE_SECONDS")
+        self.settle_seconds = (
+            DEFAULT_DAEMON_SETTLE_SECONDS if settle_seconds is None else settle_seconds
+        )
+        self.since: Optional[datetime] = None
+        # Логи, обработка которых упала: путь -> mtime_ns. Повторная попытка -
+        # только после изменения файла
+        self.failed: Dict[Path, int] = {}
+        self.stopping = False
+        self.log_day = datetime.now().date()
+        # Сигнал остановки будит select через pipe
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_write, False)
+        self.watcher = create_log_watcher(config, self.log_dir, logger)
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+    def _handle_signal(self, signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        self.stop()
+
+    def stop(self):
+        """
+        Остановка после текущего лога, можно вызывать из обработчика сигнала
+        и из другого потока
+        """
+        self.stopping = True
+        try:
+            os.write(self.wakeup_write, b"\0")
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+    def serve(self):
+        latest = find_last_log(self.config, self.logger, skip_reported=False)
+        if latest is not None and not self.config.get("BACKFILL"):
+            self.since = latest.date
+        self.logger.info(
+            "Daemon started",
+            log_dir=str(self.log_dir),
+            watcher="poll" if self.watcher is None else "inotify",
+        )
+        try:
+            while not self.stopping:
+                self.reopen_logging()
+                logs, recheck = self.pending_logs()
+                for logfile, mtime_ns in logs:
+                    if self.stopping:
+                        break
+                    self.process(logfile, mtime_ns)
+                if logs:
+                    # Пока шла обработка, могли появиться новые логи
+                    continue
+                if self.watcher is None:
+                    recheck = min(recheck or self.poll_interval, self.poll_interval)
+                self.wait(recheck)
+        finally:
+            self.close()
+        self.logger.info("Daemon stopped")
+
+    def reopen_logging(self):
+        # Файл лога программы (LOGGER_OUTPUT_FILE) содержит дату запуска:
+        # с началом нового дня логирование переключается на новый файл
+        today = datetime.now().date()
+        if today != self.log_day and self.config.get("LOGGER_OUTPUT_FILE"):
+            self.logger = setup_logging(self.config)
+        self.log_day = today
+
+    def pending_logs(self) -> Tuple[List[Tuple[LogFile, int]], Optional[float]]:
+        """
+        Логи без отчета, готовые к обработке (с mtime_ns), и через сколько секунд
+        проверить логи, которые еще дописываются
+        """
+        ready = []
+        recheck: Optional[float] = None
+        now = time.time()
+        for logfile in find_unreported_logs(self.config, self.logger):
+            if self.since is not None and logfile.date < self.since:
+                continue
+            try:
+                stat = logfile.path.stat()
+            except FileNotFoundError:
+                continue
+            if self.failed.get(logfile.path) == stat.st_mtime_ns:
+                continue
+            age = now - stat.st_mtime
+            if age < self.settle_seconds:
+                wait = self.settle_seconds - age
+                recheck = wait if recheck is None else min(recheck, wait)
+                continue
+            ready.append((logfile, stat.st_mtime_ns))
+        return ready, recheck
+
+    def process(self, logfile: LogFile, mtime_ns: int):
+        day = logfile.date.strftime("%Y.%m.%d")
+        logger = self.logger.bind(log_file=str(logfile.path))
+        logger.info("Start processing log")
+        try:
+            process_log_file(logfile, self.config, logger)
+        except Exception:
+            self.failed[logfile.path] = mtime_ns
+            logger.exception(f"Failed to build report for day {day}")
+            return
+        self.failed.pop(logfile.path, None)
+        logger.info(f"Report generated and saved successfully for day {day}")
+
+    def wait(self, timeout: Optional[float]):
+        """
+        Ждет появления лога в директории, остановки или таймаута.
+        События по файлам, не похожим на логи, пропускаются.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        fds: List[Any] = [self.wakeup_read]
+        if self.watcher is not None:
+            fds.append(self.watcher)
+        while not self.stopping:
+            remaining = (
+                None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            )
+            ready, _, _ = select.select(fds, [], [], remaining)
+            if not ready:
+                return
+            if self.wakeup_read in ready:
+                os.read(self.wakeup_read, 1 << 10)
+                return
+            names = self.watcher.read_names()  # type: ignore[union-attr]
+            if any(not name or LOG_NAME_RE.match(name) for name in names):
+                return
+
+
+def run_daemon(config: Dict[str, Any], logger):
+    daemon = LogDaemon(config, logger)
+    daemon.install_signal_handlers()
+    daemon.serve()
+
+
+def main():
+    config = load_config_or_get_default()
+    logger = setup_logging(config)
+    profile_output = config.get("PROFILE_OUTPUT")
+    if not profile_output:
+        run(config, logger)
+        return
+
+    # Профиль всего запуска, файл читается pstats / snakeviz
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        run(config, logger)
+    finally:
+        profiler.disable()
+        profile_path = BASE_DIR / profile_output
+        profiler.dump_stats(profile_path)
+        logger.info(f"Profile saved to {profile_path}")
+
+
+def run(config: Dict[str, Any], logger):
+    if config.get("MERGE_AGGREGATES"):
+        run_merge(config, logger)
+        return
+    if config.get("EMIT_AGGREGATE"):
+        run_emit_aggregate(config, logger)
+        return
+    if config.get("DAEMON"):
+        run_daemon(config, logger)
+        return
+    if config.get("INCREMENTAL"):
+        run_incremental(config, logger)
+        return
+    if config.get("BACKFILL"):
+        run_backfill(config, logger)
+        return
+
+    last_log_file = find_last_log(config, logger)
+
+    if not last_log_file:
+        logger.info("No logs to process")
+        return
+
+    process_log_file(last_log_file, config, logger)
+
     logger.info(
         f"Report generated and saved successfully for day {last_log_file.date.strftime('%Y.%m.%d')}"
     )
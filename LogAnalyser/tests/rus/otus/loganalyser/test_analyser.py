@@ -1,17 +1,49 @@
 import filecmp
+import gzip
+import itertools
+import json
 import logging
+import math
 import os
 import subprocess
 import sys
+import threading
+import time
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from string import Template
 from typing import Any, Dict, Iterator
 
+import pytest
+import structlog
 from assertpy import assert_that
-from ru.otus.loganalyser.log_analyser import (LogEntry, LogFile,
+
+from ru.otus.loganalyser.log_analyser import (CHECKPOINT_FILENAME,
+                                              LOG_INDEX_FILENAME,
+                                              LatencyTimeline, LogDaemon,
+                                              LogEntry, LogFile,
+                                              ParseErrorMonitor,
+                                              QuantileSketch, UrlNormalizer,
+                                              aggregate_log,
+                                              aggregate_log_parallel,
+                                              build_report, create_aggregate,
+                                              find_gzip_command, find_last_log,
+                                              find_unreported_logs,
+                                              iter_log_files, iter_mmap_lines,
+                                              list_log_files,
+                                              load_columnar_log,
                                               load_config_or_get_default,
-                                              open_log, parse_log,
-                                              setup_logging)
+                                              open_log, open_log_bytes,
+                                              parse_line, parse_line_bytes,
+                                              parse_line_fast,
+                                              parse_line_for_report,
+                                              parse_line_view, parse_log,
+                                              process_entries,
+                                              process_log_file,
+                                              read_gzip_external,
+                                              run, run_backfill,
+                                              run_incremental, setup_logging,
+                                              split_log_file, stream_report)
 
 sys.path.insert(
     0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../src"))
@@ -120,6 +152,29 @@ def test_log_analyser(tmp_path):
     ), "Сгенерированный отчёт не совпадает с эталонным"
 
 
+def test_config_cli_paths_are_relative_to_cwd(tmp_path, monkeypatch):
+    (tmp_path / "config.json").write_text(
+        json.dumps({"REPORT_DIR": "reports", "EMIT_AGGREGATE": "from-config"}),
+        encoding="utf-8",
+    )
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["script_name", "--profile", "run.prof", "--merge", "a.json.gz", "b.json.gz"],
+    )
+    config = load_config_or_get_default()
+
+    assert config["PROFILE_OUTPUT"] == str(tmp_path / "run.prof")
+    assert config["MERGE_AGGREGATES"] == [
+        str(tmp_path / "a.json.gz"),
+        str(tmp_path / "b.json.gz"),
+    ]
+    # Пути из конфига по-прежнему считаются от BASE_DIR
+    assert config["EMIT_AGGREGATE"] == "from-config"
+    assert config["REPORT_DIR"] == "reports"
+
+
 def test_setup_logging_writes_to_file(tmp_path):
     log_file = tmp_path / "test.log"
     config = {"LOGGER_OUTPUT_FILE": str(log_file)}
@@ -131,3 +186,761 @@ def test_setup_logging_writes_to_file(tmp_path):
     assert log_file.exists(), "Лог-файл не создан"
     content = log_file.read_text(encoding="utf-8")
     assert "Test log message" in content, "Сообщение не записано в лог"
+
+
+def test_setup_logging_closes_previous_handlers(tmp_path):
+    setup_logging({"LOGGER_OUTPUT_FILE": str(tmp_path / "day1.log")})
+    (old_handler,) = logging.getLogger().handlers
+
+    logger = setup_logging({"LOGGER_OUTPUT_FILE": str(tmp_path / "day2.log")})
+    logger.info("Next day message")
+    logging.shutdown()
+
+    assert old_handler not in logging.getLogger().handlers
+    assert old_handler.stream is None
+    assert "Next day message" not in (tmp_path / "day1.log").read_text(encoding="utf-8")
+    assert "Next day message" in (tmp_path / "day2.log").read_text(encoding="utf-8")
+
+
+def _write_big_log(tmp_path: Path, repeats: int = 50) -> Path:
+    sample = (Path(__file__).parent / "nginx_log.positive.txt").read_text(
+        encoding="utf-8"
+    )
+    if not sample.endswith("\n"):
+        sample += "\n"
+    log_path = tmp_path / "nginx-access-ui.log-20170630"
+    log_path.write_text((sample + "broken line\n") * repeats, encoding="utf-8")
+    return log_path
+
+
+def test_split_log_file_aligns_to_lines(tmp_path):
+    log_path = _write_big_log(tmp_path)
+    data = log_path.read_bytes()
+
+    ranges = split_log_file(log_path, 7)
+
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+        assert data[start - 1 : start] == b"\n"
+
+
+@pytest.mark.parametrize("extra", [{}, {"MAX_URLS": 2}])
+def test_parallel_report_matches_single_process(tmp_path, extra):
+    log_path = _write_big_log(tmp_path)
+    logfile = LogFile(path=log_path, ext="", date=datetime(2017, 6, 30))
+    config = {
+        "REPORT_SIZE": 1000,
+        "PARSE_ERROR_THRESHOLD": 0.5,
+        "WORKERS": 4,
+        **extra,
+    }
+    logger = structlog.get_logger()
+
+    expected = process_entries(
+        parse_log(open_log(logfile, logger), config, logger), config, logger
+    )
+    stats = aggregate_log_parallel(logfile, config, logger)
+    actual = build_report(stats, config, logger)
+
+    assert actual == expected
+
+
+def test_sketch_aggregator_median_within_error():
+    config = {"AGGREGATOR": "sketch", "MEDIAN_RELATIVE_ERROR": 0.01}
+    values = [0.001 * i for i in range(1, 2002)]
+    left, right = create_aggregate(config), create_aggregate(config)
+    for value in values[:1000]:
+        left.add("/api", value)
+    for value in values[1000:]:
+        right.add("/api", value)
+
+    left.merge(right)
+    stats = left.urls["/api"]
+
+    assert stats.count == len(values)
+    assert stats.time_max == max(values)
+    assert stats.time_sum == math.fsum(values)
+    assert abs(stats.values.median() - 1.001) <= 1.001 * 0.01
+
+
+def test_sketch_quantiles_with_zero_values():
+    sketch = QuantileSketch(0.05)
+    for value in [0.0, 0.0, 0.0, 1.0, 2.0]:
+        sketch.add(value)
+
+    assert sketch.median() == 0.0
+    assert abs(sketch.quantile(1.0) - 2.0) <= 2.0 * 0.05
+
+
+def test_sketch_merge_keeps_exact_sum():
+    left, middle, right = (QuantileSketch(0.05) for _ in range(3))
+    left.add(1e16)
+    middle.add(1.0)
+    for value in [1.0, 1.0]:
+        right.add(value)
+
+    left.merge(middle)
+    left.merge(right)
+
+    assert math.fsum(left.summands()) == math.fsum([1e16, 1.0, 1.0, 1.0])
+
+
+def test_fast_parser_matches_regex_parser():
+    log_path = Path(__file__).parent / "nginx_log.positive.txt"
+    for line in log_path.read_text(encoding="utf-8").splitlines():
+        expected = parse_line(line)
+        actual = parse_line_fast(line)
+
+        assert actual is not None
+        assert (actual.url, actual.request_time) == (
+            expected.url,
+            expected.request_time,
+        )
+        assert (actual.host, actual.time, actual.method, actual.size) == (
+            expected.host,
+            expected.time,
+            expected.method,
+            expected.size,
+        )
+
+
+def test_report_parser_falls_back_to_regex():
+    line = (
+        '1.2.3.4 -  - [29/Jun/2017:03:50:29 +0300] "GET  /api/v2/banner/1 HTTP/1.1" '
+        '200 1084 "-" "agent" "-" "-" "-" 2.580'
+    )
+
+    assert parse_line_fast(line) is None
+    entry = parse_line_for_report(line)
+    assert entry is not None
+    assert (entry.url, entry.request_time) == ("/api/v2/banner/1", 2.58)
+    assert parse_line_for_report("broken line") is None
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        'not-an-ip - - [29/Jun/2017:03:50:29 +0300] "GET /a HTTP/1.1" 200 1 '
+        '"-" "agent" "-" "-" "-" 0.390',
+        '1.2.3.4 - - [29/Jun/2017:03:50:29 +0300] "GET /a HTTP/1.1" 200 1 '
+        '"-" "agent" "-" 0.390',
+        'garbage] "POST /b HTTP/x" 1.5',
+        '1.2.3.4 - [29/Jun/2017:03:50:29 +0300] "GET /a HTTP/1.1" 200 1 '
+        '"-" "agent" "-" "-" "-" 0.390',
+        '1.2.3.4 - - [29/Jun/2017:03:50:29 +0300] "GET /a HTTP/1.1" 20 1 '
+        '"-" "agent" "-" "-" "-" 0.390',
+        '1.2.3.4 - - [29/Jun/2017:03:50:29 +0300] "GET /a HTTP/1.1" 200 - '
+        '"-" "agent" "-" "-" "-" 0.390',
+    ],
+)
+def test_report_parsers_reject_lines_rejected_by_regex(line):
+    assert parse_line(line) is None
+    assert parse_line_fast(line) is None
+    assert parse_line_for_report(line) is None
+    assert parse_line_bytes(line.encode()) is None
+    assert parse_line_view(memoryview(line.encode() + b"\n")) is None
+
+
+def test_malformed_time_is_a_parse_error_not_a_crash():
+    good = (
+        '1.2.3.4 - - [29/Jun/2017:03:50:29 +0300] "GET /api/1 HTTP/1.1" '
+        '200 1 "-" "agent" "-" "-" "-" 0.390\n'
+    )
+    # Двойной пробел в запросе уводит режим report на регулярку с разбором времени
+    bad = good.replace("29/Jun", "31/Foo").replace("GET ", "GET  ")
+    logger = structlog.get_logger()
+
+    for mode in ("full", "report"):
+        config = {"PARSE_MODE": mode, "PARSE_ERROR_THRESHOLD": 0.6}
+        entries = list(parse_log([good, bad], config, logger))
+        assert [entry.url for entry in entries] == ["/api/1"]
+    # Быстрые пути разбирают время лениво: некорректное считается неуказанным
+    entry = parse_line_bytes(bad.replace("GET  ", "GET ").encode())
+    assert entry is not None
+    assert entry.timestamp == 0
+    assert entry.time == datetime.min
+
+
+def test_incremental_run_resumes_from_checkpoint(tmp_path):
+    sample = (Path(__file__).parent / "nginx_log.positive.txt").read_bytes()
+    lines = sample.rstrip(b"\n").split(b"\n")
+    log_dir = tmp_path / "logs"
+    report_dir = tmp_path / "reports"
+    log_dir.mkdir()
+    report_dir.mkdir()
+    template = tmp_path / "report.html"
+    template.write_text("$table_json", encoding="utf-8")
+    log_path = log_dir / "nginx-access-ui.log-20170630"
+    config = {
+        "LOG_DIR": str(log_dir),
+        "REPORT_DIR": str(report_dir),
+        "TEMPLATE": str(template),
+        "REPORT_SIZE": 1000,
+        "PARSE_MODE": "report",
+    }
+    logger = structlog.get_logger()
+
+    # Последняя строка еще не дописана
+    log_path.write_bytes(b"\n".join(lines[:3]) + b"\n" + lines[3][:20])
+    run_incremental(config, logger)
+    checkpoint = json.loads((report_dir / CHECKPOINT_FILENAME).read_text())
+    assert checkpoint["offset"] == len(b"\n".join(lines[:3]) + b"\n")
+    assert checkpoint["total"] == 3
+
+    log_path.write_bytes(b"\n".join(lines) + b"\n")
+    run_incremental(config, logger)
+    checkpoint = json.loads((report_dir / CHECKPOINT_FILENAME).read_text())
+    assert checkpoint["offset"] == log_path.stat().st_size
+    assert checkpoint["total"] == len(lines)
+
+    logfile = LogFile(path=log_path, ext="", date=datetime(2017, 6, 30))
+    expected = process_entries(
+        parse_log(open_log(logfile, logger), config, logger), config, logger
+    )
+    report = json.loads((report_dir / "report-2017.06.30.html").read_text())
+    assert report == expected
+
+
+def test_incremental_mode_defaults_to_sketch_aggregator(tmp_path):
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+    _write_big_log(log_dir, repeats=5)
+    template = tmp_path / "report.html"
+    template.write_text("$table_json", encoding="utf-8")
+    config = {
+        "LOG_DIR": str(log_dir),
+        "REPORT_DIR": str(tmp_path),
+        "TEMPLATE": str(template),
+        "PARSE_ERROR_THRESHOLD": 0.5,
+        "INCREMENTAL": True,
+    }
+
+    run_incremental(config, structlog.get_logger())
+
+    checkpoint = json.loads((tmp_path / CHECKPOINT_FILENAME).read_text())
+    assert checkpoint["aggregate"]["aggregator"] == "sketch"
+    assert create_aggregate({**config, "AGGREGATOR": "exact"}).kind == "exact"
+    assert create_aggregate({}).kind == "exact"
+
+
+def test_backfill_builds_every_missing_report(tmp_path):
+    sample = (Path(__file__).parent / "nginx_log.positive.txt").read_text(
+        encoding="utf-8"
+    )
+    log_dir = tmp_path / "logs"
+    report_dir = tmp_path / "reports"
+    log_dir.mkdir()
+    report_dir.mkdir()
+    template = tmp_path / "report.html"
+    template.write_text("$table_json", encoding="utf-8")
+    for day in ("20170628", "20170629", "20170630"):
+        (log_dir / f"nginx-access-ui.log-{day}").write_text(sample, encoding="utf-8")
+    (log_dir / "nginx-access-ui.log-20170627.bz2").write_text(sample, encoding="utf-8")
+    (report_dir / "report-2017.06.29.html").write_text("old", encoding="utf-8")
+    config = {
+        "LOG_DIR": str(log_dir),
+        "REPORT_DIR": str(report_dir),
+        "TEMPLATE": str(template),
+        "BACKFILL_CONCURRENCY": 2,
+    }
+
+    run_backfill(config, structlog.get_logger())
+
+    assert sorted(path.name for path in report_dir.iterdir()) == [
+        "report-2017.06.28.html",
+        "report-2017.06.29.html",
+        "report-2017.06.30.html",
+    ]
+    assert (report_dir / "report-2017.06.29.html").read_text() == "old"
+
+
+def test_gzip_backends_return_same_lines(tmp_path):
+    log_path = Path(__file__).parent / "nginx_log.positive.txt"
+    gz_path = tmp_path / "nginx-access-ui.log-20170630.gz"
+    gz_path.write_bytes(gzip.compress(log_path.read_bytes()))
+    logger = structlog.get_logger()
+    expected = list(
+        open_log(LogFile(path=log_path, ext="", date=datetime.now()), logger)
+    )
+    gz_logfile = LogFile(path=gz_path, ext=".gz", date=datetime.now())
+
+    for backend in ("stdlib", "auto"):
+        config = {"GZIP_BACKEND": backend}
+        assert list(open_log(gz_logfile, logger, config)) == expected
+
+    command = find_gzip_command()
+    if command is not None:
+        assert list(read_gzip_external(gz_path, command)) == expected
+
+
+def test_bytes_mode_report_matches_text_mode(tmp_path):
+    log_path = _write_big_log(tmp_path)
+    with log_path.open("ab") as f:
+        f.write(
+            b'1.2.3.4 -  - [29/Jun/2017:03:50:29 +0300] "GET /\xd0\xbf\xff HTTP/1.1" '
+            b'200 1 "-" "agent" "-" "-" "-" 999.000\n'
+        )
+    logfile = LogFile(path=log_path, ext="", date=datetime(2017, 6, 30))
+    logger = structlog.get_logger()
+    text_config = {"PARSE_MODE": "report", "PARSE_ERROR_THRESHOLD": 0.5}
+    bytes_config = {"PARSE_MODE": "bytes", "PARSE_ERROR_THRESHOLD": 0.5}
+
+    with open(log_path, encoding="utf-8", errors="surrogateescape") as f:
+        expected = process_entries(
+            parse_log(f, text_config, logger), text_config, logger
+        )
+    actual = process_entries(
+        parse_log(open_log_bytes(logfile, logger), bytes_config, logger),
+        bytes_config,
+        logger,
+    )
+
+    assert actual == expected
+    assert actual[0]["url"] == "/\u043f\udcff"
+
+
+def test_bytes_parser_lazy_fields():
+    line = (Path(__file__).parent / "nginx_log.positive.txt").read_bytes()
+    entry = parse_line_bytes(line.split(b"\n")[0])
+
+    assert entry.url == b"/api/1/banners/?campaign=4198767"
+    assert entry.request_time == 0.461
+    assert entry.method == "GET"
+    assert entry.host == "1.199.168.112"
+    assert entry.size == 23765
+
+
+def test_columnar_cache_reproduces_report(tmp_path):
+    log_path = _write_big_log(tmp_path, repeats=3)
+    logfile = LogFile(path=log_path, ext="", date=datetime(2017, 6, 30))
+    config = {
+        "COLUMNAR_CACHE_DIR": str(tmp_path / "cache"),
+        "PARSE_MODE": "report",
+        "PARSE_ERROR_THRESHOLD": 0.5,
+    }
+    logger = structlog.get_logger()
+
+    expected = build_report(aggregate_log(logfile, config, logger), config, logger)
+    columns = load_columnar_log(tmp_path / "cache" / "20170630")
+
+    assert len(columns.url_id) == 15
+    assert (columns.total, columns.errors) == (18, 3)
+    assert columns.urls[columns.url_id[0]] == "/api/1/banners/?campaign=4198767"
+    assert columns.request_time[0] == 0.461
+    assert columns.time[0] == int(
+        datetime(
+            2017, 6, 29, 3, 50, 28, tzinfo=timezone(timedelta(hours=3))
+        ).timestamp()
+    )
+    # Повторный запуск берет данные из кэша, даже если исходные строки недоступны
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(
+            "ru.otus.loganalyser.log_analyser.open_log_lines",
+            lambda *args: pytest.fail("log must not be re-read"),
+        )
+        actual = build_report(aggregate_log(logfile, config, logger), config, logger)
+    assert actual == expected
+
+
+def test_numpy_engine_matches_python_engine(tmp_path):
+    pytest.importorskip("numpy")
+    log_path = _write_big_log(tmp_path)
+    logger = structlog.get_logger()
+    python_config = {"PARSE_ERROR_THRESHOLD": 0.5, "REPORT_SIZE": 3}
+    numpy_config = dict(python_config, ENGINE="numpy")
+
+    reports = []
+    for config in (python_config, numpy_config):
+        with open(log_path, encoding="utf-8") as f:
+            reports.append(
+                process_entries(parse_log(f, config, logger), config, logger)
+            )
+
+    assert reports[1] == reports[0]
+    assert len(reports[1]) == 3
+
+
+def test_report_top_k_keeps_order_of_full_sort():
+    aggregate = create_aggregate({})
+    for i in range(50):
+        aggregate.add(f"/url/{i}", float(i % 7))
+        aggregate.add(f"/url/{i}", 0.5)
+    logger = structlog.get_logger()
+
+    full = build_report(aggregate, {"REPORT_SIZE": 1000}, logger)
+    top = build_report(aggregate, {"REPORT_SIZE": 10}, logger)
+
+    assert [row["time_sum"] for row in full] == sorted(
+        (row["time_sum"] for row in full), reverse=True
+    )
+    assert top == full[:10]
+    assert [row["url"] for row in top[:3]] == ["/url/6", "/url/13", "/url/20"]
+
+
+def test_url_normalizer_groups_urls():
+    template = UrlNormalizer("template", collapse_ids=True)
+    strip = UrlNormalizer("strip")
+
+    assert template("/api/v2/banner/25019354?x=1&y=") == "/api/v2/banner/{id}?x={}&y={}"
+    assert template(b"/api/1/user/7/") == b"/api/{id}/user/{id}/"
+    assert template("/api/v2/slot4/") == "/api/v2/slot4/"
+    assert strip("/api/v2/banner/1?campaign=4198767") == "/api/v2/banner/1"
+    assert template("/a/1?b=2") is template("/a/2?b=3")
+
+
+def test_url_cap_collects_other_bucket_in_both_engines():
+    pytest.importorskip("numpy")
+    lines = [
+        f'1.2.3.4 -  - [29/Jun/2017:03:50:22 +0300] "GET /item/{i}?page={i} HTTP/1.1" '
+        f'200 1 "-" "agent" "-" "-" "-" {i % 5}.{i:03d}\n'
+        for i in range(40)
+    ]
+    logger = structlog.get_logger()
+    config = {"URL_QUERY": "strip", "MAX_URLS": 3, "PARSE_ERROR_THRESHOLD": 0.5}
+    for i in range(40):
+        if i % 4 == 0:
+            lines.append(lines[i].replace(f"/item/{i}?", "/user/1?"))
+
+    def report(extra):
+        run_config = dict(config, **extra)
+        return process_entries(parse_log(lines, run_config, logger), run_config, logger)
+
+    capped = report({})
+    collapsed = report({"URL_COLLAPSE_IDS": True})
+
+    assert {row["url"] for row in capped} == {
+        "/item/0",
+        "/item/1",
+        "/item/2",
+        "(other)",
+    }
+    assert sum(row["count"] for row in capped) == 50
+    assert [row["url"] for row in collapsed] == ["/item/{id}", "/user/{id}"]
+    assert report({"ENGINE": "numpy"}) == capped
+    assert report({"ENGINE": "numpy", "URL_COLLAPSE_IDS": True}) == collapsed
+
+
+def test_url_cap_keeps_first_seen_urls_even_if_later_ones_are_heavier():
+    aggregate = create_aggregate({"MAX_URLS": 2})
+    aggregate.add("/light/1", 0.001)
+    aggregate.add("/light/2", 0.001)
+    for _ in range(100):
+        aggregate.add("/heavy", 1.0)
+
+    # Ограничение не вытесняет занявшие места URL: тяжелый URL виден
+    # в отчете только как часть (other)
+    assert list(aggregate.urls) == ["/light/1", "/light/2", "(other)"]
+    assert aggregate.urls["(other)"].count == 100
+
+
+def test_stream_report_matches_whole_template_substitution(tmp_path, monkeypatch):
+    monkeypatch.setattr("ru.otus.loganalyser.log_analyser.REPORT_CHUNK_ROWS", 2)
+    template = tmp_path / "report.html"
+    template.write_text(
+        "<script>var table = $table_json;</script>$$ $other", encoding="utf-8"
+    )
+    config = {"TEMPLATE": str(template), "REPORT_DIR": str(tmp_path)}
+    report_data = [{"url": f"/api/{i}", "time_sum": i / 3} for i in range(5)]
+    logger = structlog.get_logger()
+
+    stream_report(report_data, "report.html.out", config, logger)
+
+    # Эталон - подстановка всего отчета в шаблон одной строкой
+    expected = Template(template.read_text(encoding="utf-8")).safe_substitute(
+        table_json=json.dumps(report_data)
+    )
+    assert (tmp_path / "report.html.out").read_text(encoding="utf-8") == expected
+    assert not (tmp_path / "report.html.out.tmp").exists()
+
+
+def test_timeline_report_is_same_for_all_pipelines(tmp_path):
+    pytest.importorskip("numpy")
+    log_path = _write_big_log(tmp_path)
+    logfile = LogFile(path=log_path, ext="", date=datetime(2017, 6, 30))
+    template = tmp_path / "report.html"
+    template.write_text("$table_json", encoding="utf-8")
+    logger = structlog.get_logger()
+
+    timelines = []
+    for extra in ({}, {"WORKERS": 3}, {"ENGINE": "numpy"}):
+        report_dir = tmp_path / f"reports-{len(timelines)}"
+        report_dir.mkdir()
+        config = {
+            "REPORT_DIR": str(report_dir),
+            "TEMPLATE": str(template),
+            "PARSE_ERROR_THRESHOLD": 0.5,
+            "TIME_BUCKET": "minute",
+            "TIME_REPORT_URLS": 2,
+            **extra,
+        }
+        process_log_file(logfile, config, logger)
+        path = report_dir / "report-2017.06.30.timeline.json"
+        timelines.append(json.loads(path.read_text(encoding="utf-8")))
+
+    assert timelines[1] == timelines[0]
+    assert timelines[2] == timelines[0]
+    timeline = timelines[0]
+    assert timeline["bucket_seconds"] == 60
+    assert len(timeline["urls"]) == 2
+    assert sum(bucket["count"] for bucket in timeline["buckets"]) == 50 * 5
+    first = timeline["buckets"][0]
+    assert first["time"] == "2017-06-29T00:50:00+00:00"
+    assert first["p50"] <= first["p95"] <= first["p99"]
+    assert set(first["urls"]) <= set(timeline["urls"])
+
+
+def test_timeline_grid_stays_bounded_as_url_count_grows():
+    timeline = LatencyTimeline(60, max_urls=5)
+    start = 1498694400
+    for i in range(20000):
+        timestamp = start + i % 3600
+        timeline.add(timestamp, f"/api/{i}", 0.01)
+        # Тяжелый URL появляется после тысяч легких
+        if i >= 10000 and i % 10 == 0:
+            timeline.add(timestamp, "/heavy", 1.0)
+
+    assert len(timeline.weights) == 5
+    assert len(timeline.grid) <= 6
+    assert "/heavy" in timeline.grid
+    assert sum(sketch.count for sketch in timeline.totals.values()) == 21000
+    cells = sum(
+        sketch.count for cells in timeline.grid.values() for sketch in cells.values()
+    )
+    assert cells == 21000
+
+    merged = LatencyTimeline(60, max_urls=5)
+    merged.merge(timeline)
+    merged.merge(timeline)
+    restored = LatencyTimeline(60, max_urls=5)
+    restored.load_state(merged.to_state())
+    assert len(restored.grid) <= 6
+    report = restored.report(["/heavy"])
+    heavy = sum(bucket["urls"]["/heavy"]["count"] for bucket in report["buckets"])
+    assert heavy == 2 * 1000
+
+
+def test_parse_log_aborts_early_on_high_error_rate():
+    sample = (Path(__file__).parent / "nginx_log.positive.txt").read_text(
+        encoding="utf-8"
+    )
+    good = sample.splitlines(keepends=True)[0]
+    consumed = 0
+
+    def lines():
+        nonlocal consumed
+        # Бесконечный лог, в котором половина строк не разбирается
+        for i in itertools.count():
+            consumed += 1
+            yield good if i % 2 else f"broken line {i}\n"
+
+    config = {
+        "PARSE_ERROR_THRESHOLD": 0.2,
+        "PARSE_ERROR_WARMUP": 1000,
+        "PARSE_ERROR_SAMPLE_SIZE": 5,
+    }
+    with pytest.raises(RuntimeError, match="Parse errors exceed threshold"):
+        for _ in parse_log(lines(), config, structlog.get_logger()):
+            pass
+
+    assert consumed == 1001
+
+
+def test_parse_error_monitor_keeps_bounded_sample():
+    config = {"PARSE_ERROR_THRESHOLD": 0.2, "PARSE_ERROR_SAMPLE_SIZE": 3}
+    monitor = ParseErrorMonitor(config, structlog.get_logger())
+    for i in range(1, 101):
+        monitor.error(f"broken {i}\n".encode(), total=i * 100)
+    monitor.merge(5, ["other 1", "other 2"])
+
+    assert monitor.errors == 105
+    assert len(monitor.samples) == 3
+    assert all(line.startswith(("broken", "other")) for line in monitor.samples)
+    assert monitor.lower_bound(10500) < 0.2
+
+
+def test_stage_metrics_are_logged(tmp_path):
+    log_path = _write_big_log(tmp_path)
+    logfile = LogFile(path=log_path, ext="", date=datetime(2017, 6, 30))
+    template = tmp_path / "report.html"
+    template.write_text("$table_json", encoding="utf-8")
+    config = {
+        "REPORT_DIR": str(tmp_path),
+        "TEMPLATE": str(template),
+        "PARSE_ERROR_THRESHOLD": 0.5,
+        "STAGE_METRICS": True,
+    }
+
+    with structlog.testing.capture_logs() as logs:
+        process_log_file(logfile, config, structlog.get_logger())
+
+    metrics = {
+        entry["stage"]: entry for entry in logs if entry["event"] == "Stage metrics"
+    }
+    assert set(metrics) == {"open", "parse", "aggregate", "report", "render"}
+    assert metrics["open"]["lines"] == 50 * 6
+    assert metrics["parse"]["lines"] == 50 * 5
+    for entry in metrics.values():
+        assert entry["wall_s"] >= 0
+        assert entry["cpu_s"] >= 0
+        # В Windows (нет модуля resource) пиковая память не измеряется
+        assert entry["peak_rss_mb"] > 0 or sys.platform == "win32"
+        assert entry["log_file"] == str(log_path)
+
+
+def test_mmap_mode_report_matches_bytes_mode(tmp_path):
+    log_path = _write_big_log(tmp_path)
+    with log_path.open("ab") as f:
+        f.write(
+            b'1.2.3.4 -  - [29/Jun/2017:03:50:29 +0300] "GET /\xd0\xbf\xff HTTP/1.1" '
+            b'200 1 "-" "agent" "-" "-" "-" 999.000'
+        )
+    logfile = LogFile(path=log_path, ext="", date=datetime(2017, 6, 30))
+    logger = structlog.get_logger()
+    base = {"PARSE_ERROR_THRESHOLD": 0.5, "TIME_BUCKET": "minute"}
+    bytes_config = dict(base, PARSE_MODE="bytes")
+    mmap_config = dict(base, PARSE_MODE="mmap")
+
+    expected = aggregate_log(logfile, bytes_config, logger)
+    single = aggregate_log(logfile, mmap_config, logger)
+    parallel = aggregate_log(logfile, dict(mmap_config, WORKERS=3), logger)
+
+    for aggregate in (single, parallel):
+        assert build_report(aggregate, mmap_config, logger) == build_report(
+            expected, bytes_config, logger
+        )
+        assert aggregate.timeline.report([]) == expected.timeline.report([])
+    lines = list(iter_mmap_lines(log_path))
+    assert all(isinstance(line, memoryview) for line in lines)
+    assert b"".join(lines) == log_path.read_bytes()
+    entry = parse_line_view(lines[0])
+    assert entry.url == b"/api/1/banners/?campaign=4198767"
+    assert entry.host == "1.199.168.112"
+
+
+def test_log_index_refreshes_only_on_directory_change(tmp_path, monkeypatch):
+    log_dir = tmp_path / "logs"
+    report_dir = tmp_path / "reports"
+    log_dir.mkdir()
+    report_dir.mkdir()
+    for name in ("nginx-access-ui.log-20170629.gz", "nginx-access-ui.log-20170630"):
+        (log_dir / name).write_text("")
+    (log_dir / "nginx-access-ui.log-20170701.bz2").write_text("")
+    (log_dir / "nginx-access-ui.log-20170702").mkdir()
+    os.utime(log_dir, ns=(10**18, 10**18))
+    config = {"LOG_DIR": str(log_dir), "REPORT_DIR": str(report_dir), "LOG_INDEX": True}
+    logger = structlog.get_logger()
+
+    assert sorted(list_log_files(config, logger)) == sorted(iter_log_files(log_dir))
+    assert (report_dir / LOG_INDEX_FILENAME).exists()
+
+    # Директория не менялась - повторный запуск ее не читает
+    with monkeypatch.context() as mp:
+        mp.setattr(os, "listdir", lambda path: pytest.fail("directory re-read"))
+        assert find_last_log(config, logger).path.name == "nginx-access-ui.log-20170630"
+
+    (log_dir / "nginx-access-ui.log-20170703").write_text("")
+    (log_dir / "nginx-access-ui.log-20170629.gz").unlink()
+    os.utime(log_dir, ns=(2 * 10**18, 2 * 10**18))
+    assert [logfile.path.name for logfile in find_unreported_logs(config, logger)] == [
+        "nginx-access-ui.log-20170630",
+        "nginx-access-ui.log-20170703",
+    ]
+
+
+@pytest.mark.parametrize("watcher", ["inotify", "poll"])
+def test_daemon_reports_new_logs_until_stopped(tmp_path, watcher):
+    if watcher == "inotify" and not sys.platform.startswith("linux"):
+        pytest.skip("inotify is Linux only")
+    sample = (Path(__file__).parent / "nginx_log.positive.txt").read_text(
+        encoding="utf-8"
+    )
+    log_dir = tmp_path / "logs"
+    report_dir = tmp_path / "reports"
+    log_dir.mkdir()
+    report_dir.mkdir()
+    template = tmp_path / "report.html"
+    template.write_text("$table_json", encoding="utf-8")
+    for day in ("20170628", "20170629"):
+        (log_dir / f"nginx-access-ui.log-{day}").write_text(sample, encoding="utf-8")
+    config = {
+        "LOG_DIR": str(log_dir),
+        "REPORT_DIR": str(report_dir),
+        "TEMPLATE": str(template),
+        "DAEMON_WATCHER": watcher,
+        "DAEMON_POLL_INTERVAL": 0.05,
+        "DAEMON_SETTLE_SECONDS": 0,
+    }
+    daemon = LogDaemon(config, structlog.get_logger())
+    thread = threading.Thread(target=daemon.serve)
+    thread.start()
+
+    def wait_report(name: str) -> bool:
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if (report_dir / name).exists():
+                return True
+            time.sleep(0.02)
+        return False
+
+    try:
+        assert wait_report("report-2017.06.29.html")
+        (log_dir / "nginx-access-ui.log-20170630").write_text(sample, encoding="utf-8")
+        assert wait_report("report-2017.06.30.html")
+    finally:
+        daemon.stop()
+        thread.join(10)
+    assert not thread.is_alive()
+    # Логи старше последнего на момент запуска без BACKFILL не обрабатываются
+    assert not (report_dir / "report-2017.06.28.html").exists()
+
+
+@pytest.mark.parametrize("extra", [{}, {"MAX_URLS": 2}])
+def test_merged_host_aggregates_match_single_log_report(tmp_path, extra):
+    full_dir = tmp_path / "full"
+    full_dir.mkdir()
+    log_path = _write_big_log(full_dir, repeats=20)
+    lines = log_path.read_text(encoding="utf-8").splitlines(keepends=True)
+    template = tmp_path / "report.html"
+    template.write_text("$table_json", encoding="utf-8")
+    logger = structlog.get_logger()
+    base_config = {
+        "TEMPLATE": str(template),
+        "PARSE_ERROR_THRESHOLD": 0.5,
+        "TIME_BUCKET": "minute",
+        **extra,
+    }
+
+    # Каждый хост пишет свою половину лога за тот же день
+    paths = []
+    for host, host_lines in enumerate((lines[:37], lines[37:])):
+        log_dir = tmp_path / f"host-{host}"
+        log_dir.mkdir()
+        (log_dir / log_path.name).write_text("".join(host_lines), encoding="utf-8")
+        config = {
+            **base_config,
+            "LOG_DIR": str(log_dir),
+            "REPORT_DIR": str(log_dir),
+            "EMIT_AGGREGATE": str(tmp_path / f"aggregates-{host}"),
+        }
+        run(config, logger)
+        paths.extend(str(path) for path in (tmp_path / f"aggregates-{host}").iterdir())
+    assert len(paths) == 2
+    assert all(path.endswith(".json.gz") for path in paths)
+
+    merged_dir = tmp_path / "merged"
+    expected_dir = tmp_path / "expected"
+    merged_dir.mkdir()
+    expected_dir.mkdir()
+    run(
+        {**base_config, "REPORT_DIR": str(merged_dir), "MERGE_AGGREGATES": paths},
+        logger,
+    )
+    logfile = LogFile(path=log_path, ext="", date=datetime(2017, 6, 30))
+    process_log_file(logfile, {**base_config, "REPORT_DIR": str(expected_dir)}, logger)
+
+    for name in ("report-2017.06.30.html", "report-2017.06.30.timeline.json"):
+        actual = json.loads((merged_dir / name).read_text(encoding="utf-8"))
+        expected = json.loads((expected_dir / name).read_text(encoding="utf-8"))
+        assert actual == expected
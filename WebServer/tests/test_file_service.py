@@ -1,4 +1,5 @@
 import logging
+import os
 import tempfile
 from pathlib import Path
 
@@ -26,3 +27,80 @@ def test_file_service_serves_file():
 
         result = service(req)
         assert result == content
+
+
+def test_file_cache_is_bounded_by_bytes_and_tracks_changes():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in ("a.html", "b.html", "c.html"):
+            (Path(tmpdir) / name).write_bytes(name.encode() * 100)
+        service = FileService(
+            tmpdir,
+            logger=logging.getLogger("test"),
+            cache_config={
+                "cache_ttl": 0,
+                "max_file_size_in_cache": 1024,
+                "max_cache_bytes": 1200,
+            },
+        )
+
+        def get(name):
+            req = HTTPRequest(
+                src="test",
+                method="GET",
+                path=f"/{name}",
+                params={},
+                version="HTTP/1.1",
+                headers={},
+                body=None,
+            )
+            return bytes(service(req))
+
+        assert get("a.html") == b"a.html" * 100
+        assert get("b.html") == b"b.html" * 100
+        assert len(service._cache) == 2
+        # c.html does not fit into 1200 bytes, the least recently used file goes
+        assert get("c.html") == b"c.html" * 100
+        assert len(service._cache) == 2
+        assert service._cache.total_bytes == 1200
+        assert service._cache.get(str(Path(tmpdir) / "a.html")) is None
+
+        # A file replaced by rename is noticed by its mtime and size
+        replacement = Path(tmpdir) / "b.tmp"
+        replacement.write_bytes(b"new")
+        replacement.replace(Path(tmpdir) / "b.html")
+        assert get("b.html") == b"new"
+
+
+def test_file_cache_notices_files_rewritten_in_place():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "page.html"
+        path.write_bytes(b"old" * 100)
+        service = FileService(
+            tmpdir,
+            logger=logging.getLogger("test"),
+            cache_config={"cache_ttl": 5, "max_file_size_in_cache": 1024},
+        )
+
+        def get():
+            req = HTTPRequest(
+                src="test",
+                method="GET",
+                path="/page.html",
+                params={},
+                version="HTTP/1.1",
+                headers={},
+                body=None,
+            )
+            return bytes(service(req))
+
+        assert get() == b"old" * 100
+        stat = path.stat()
+        # Same size, rewritten within the ttl: the mtime gives it away
+        with open(path, "r+b") as f:
+            f.write(b"new" * 100)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert get() == b"new" * 100
+        # Truncated in place: the stale mapping is not read past the new end
+        with open(path, "r+b") as f:
+            f.truncate(3)
+        assert get() == b"new"
@@ -1,10 +1,20 @@
+import errno
 import http.client
+import logging
 import multiprocessing
 import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
 import time
 from types import SimpleNamespace
 
-from handler.handler import EmptyHandler
+import pytest
+
+from handler.handler import EmptyHandler, FileService
+from server.server import Connection, HTTPServer
 from webserver_src.httpd import start_worker
 
 SERVER_PORT = 8080
@@ -12,7 +22,14 @@ SERVER_PORT = 8080
 
 def start_server():
     os.environ["DOCUMENT_ROOT"] = os.path.abspath("documents")
-    args = SimpleNamespace(upload_timeout=100, host="127.0.0.1", port=SERVER_PORT)
+    args = SimpleNamespace(
+        upload_timeout=100,
+        host="127.0.0.1",
+        port=SERVER_PORT,
+        keepalive_timeout=5,
+        max_keepalive_requests=3,
+        backlog=128,
+    )
     start_worker(EmptyHandler(b"TEST RESPONSE"), args)
 
 
@@ -35,3 +52,308 @@ def test_server_root_returns_index():
     assert resp.status == 200
     body = resp.read()
     assert b"TEST RESPONSE" in body
+
+
+def test_slow_client_does_not_block_other_requests():
+    slow = socket.create_connection(("localhost", SERVER_PORT))
+    try:
+        slow.sendall(b"GET / HTTP/1.1\r\nHost: local")
+        conn = http.client.HTTPConnection("localhost", SERVER_PORT, timeout=2)
+        conn.request("GET", "/")
+        resp = conn.getresponse()
+        assert resp.status == 200
+        assert resp.read() == b"TEST RESPONSE"
+
+        slow.sendall(b"host\r\nConnection: close\r\n\r\n")
+        slow.settimeout(2)
+        response = b""
+        while chunk := slow.recv(4096):
+            response += chunk
+        assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert response.endswith(b"TEST RESPONSE")
+    finally:
+        slow.close()
+
+
+def test_keep_alive_connection_serves_pipelined_requests():
+    request = b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    with socket.create_connection(("localhost", SERVER_PORT), timeout=2) as sock:
+        # Four requests in one packet: after max_keepalive_requests=3 the
+        # server closes the connection and the fourth one gets no response
+        sock.sendall(request * 4)
+        response = b""
+        while chunk := sock.recv(4096):
+            response += chunk
+
+    responses = response.split(b"HTTP/1.1 200 OK\r\n")[1:]
+    assert len(responses) == 3
+    assert all(part.endswith(b"TEST RESPONSE") for part in responses)
+    assert b"Connection: keep-alive" in responses[0]
+    assert b"Connection: close" in responses[2]
+
+
+def test_half_closed_client_gets_all_pipelined_responses():
+    logger = logging.getLogger("test")
+    server = HTTPServer(
+        connect_timeout_ms=100,
+        server_address=("127.0.0.1", 0),
+        base_headers={},
+        external_handler=EmptyHandler(b"TEST RESPONSE"),
+        headers_binding=lambda _: {},
+        logger=logger,
+    )
+    client, server_side = socket.socketpair()
+    try:
+        server_side.setblocking(False)
+        client.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n" * 3)
+        client.shutdown(socket.SHUT_WR)
+        # The requests and the FIN are taken by the same read
+        server._read(Connection(server_side, ("client", 0)))
+        client.settimeout(2)
+        response = b""
+        while chunk := client.recv(4096):
+            response += chunk
+    finally:
+        client.close()
+        server_side.close()
+        server.server_close()
+
+    responses = response.split(b"HTTP/1.1 200 OK\r\n")[1:]
+    assert len(responses) == 3
+    assert all(part.endswith(b"TEST RESPONSE") for part in responses)
+    assert b"Connection: keep-alive" in responses[0]
+    assert b"Connection: close" in responses[2]
+
+
+def test_http_1_0_connection_is_closed_without_keep_alive():
+    conn = http.client.HTTPConnection("localhost", SERVER_PORT, timeout=2)
+    conn._http_vsn, conn._http_vsn_str = 10, "HTTP/1.0"
+    conn.request("GET", "/")
+    resp = conn.getresponse()
+    assert resp.getheader("Connection") == "close"
+    assert resp.read() == b"TEST RESPONSE"
+
+
+def test_large_file_is_sent_with_sendfile(tmp_path, monkeypatch):
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    (tmp_path / "big.bin").write_bytes(content)
+    sendfile_calls = []
+    sendfile = os.sendfile
+
+    def counting_sendfile(*args):
+        sendfile_calls.append(args)
+        return sendfile(*args)
+
+    monkeypatch.setattr(os, "sendfile", counting_sendfile)
+    logger = logging.getLogger("test")
+    server = HTTPServer(
+        connect_timeout_ms=100,
+        server_address=("127.0.0.1", 0),
+        base_headers={},
+        external_handler=FileService(str(tmp_path), logger, None),
+        headers_binding=lambda _: {},
+        logger=logger,
+    )
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.start()
+    try:
+        conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+        conn.request("GET", "/big.bin")
+        resp = conn.getresponse()
+        assert resp.getheader("Content-Length") == str(len(content))
+        assert resp.read() == content
+
+        conn.request("HEAD", "/big.bin")
+        resp = conn.getresponse()
+        assert resp.getheader("Content-Length") == str(len(content))
+        assert resp.read() == b""
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert sendfile_calls
+
+
+def test_client_that_stops_reading_is_dropped(tmp_path):
+    (tmp_path / "big.bin").write_bytes(os.urandom(8 * 1024 * 1024))
+    logger = logging.getLogger("test")
+    server = HTTPServer(
+        connect_timeout_ms=100,
+        server_address=("127.0.0.1", 0),
+        base_headers={},
+        external_handler=FileService(str(tmp_path), logger, None),
+        headers_binding=lambda _: {},
+        logger=logger,
+    )
+    server.send_timeout = 0.3
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.start()
+    try:
+        with socket.socket() as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            sock.connect(server.server_address)
+            sock.sendall(b"GET /big.bin HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            assert _wait_for(lambda: len(server.connections) == 1, timeout=2)
+            # The response never fits into the socket buffers and the client
+            # does not read it: the connection and its file are released
+            assert _wait_for(lambda: not server.connections, timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_keep_alive_idle_time_starts_after_slow_response_is_read(tmp_path):
+    content = os.urandom(8 * 1024 * 1024)
+    (tmp_path / "big.bin").write_bytes(content)
+    logger = logging.getLogger("test")
+    server = HTTPServer(
+        connect_timeout_ms=100,
+        server_address=("127.0.0.1", 0),
+        base_headers={},
+        external_handler=FileService(str(tmp_path), logger, None),
+        headers_binding=lambda _: {},
+        logger=logger,
+        keep_alive_timeout=0.3,
+    )
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.start()
+    try:
+        with socket.socket() as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            sock.connect(server.server_address)
+            sock.settimeout(5)
+            sock.sendall(b"GET /big.bin HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            # The response takes longer than keep_alive_timeout to read
+            time.sleep(0.6)
+            received = bytearray()
+            while True:
+                chunk = sock.recv(1 << 20)
+                assert chunk, "connection closed while sending the response"
+                received += chunk
+                header_end = received.find(b"\r\n\r\n")
+                if header_end != -1 and len(received) == header_end + 4 + len(content):
+                    break
+
+            # Idle for less than keep_alive_timeout after the response
+            time.sleep(0.1)
+            sock.sendall(b"HEAD /big.bin HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            assert sock.recv(1024).startswith(b"HTTP/1.1 200")
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_accept_pauses_when_out_of_file_descriptors():
+    logger = logging.getLogger("test")
+    server = HTTPServer(
+        connect_timeout_ms=100,
+        server_address=("127.0.0.1", 0),
+        base_headers={},
+        external_handler=EmptyHandler(b"TEST RESPONSE"),
+        headers_binding=lambda _: {},
+        logger=logger,
+    )
+    server.accept_pause = 0.5
+    accept = server.get_request
+    failures = []
+
+    def get_request():
+        # Descriptors stay exhausted for a while after the first failure
+        if not failures or time.monotonic() - failures[0] < 0.3:
+            failures.append(time.monotonic())
+            raise OSError(errno.EMFILE, os.strerror(errno.EMFILE))
+        return accept()
+
+    server.get_request = get_request
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.start()
+    try:
+        conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+        conn.request("GET", "/")
+        resp = conn.getresponse()
+        assert resp.status == 200
+        # The listener is not polled while paused, the pending connection
+        # waits in the backlog until accepts resume
+        assert len(failures) == 1
+        assert time.monotonic() - failures[0] >= server.accept_pause
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _children(pid: int) -> set[int]:
+    children = set()
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+            children.add(int(entry))
+    return children
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="uses /proc")
+def test_master_restarts_crashed_worker(tmp_path):
+    (tmp_path / "index.html").write_bytes(b"prefork")
+    port = _free_port()
+    master = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join("webserver_src", "httpd.py"),
+            "-r",
+            str(tmp_path),
+            "-p",
+            str(port),
+            "-w",
+            "2",
+            "--host",
+            "127.0.0.1",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    def get_index():
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/index.html")
+            return conn.getresponse().read()
+        except OSError:
+            return None
+
+    try:
+        assert _wait_for(lambda: len(_children(master.pid)) == 2)
+        assert _wait_for(lambda: get_index() == b"prefork")
+        workers = _children(master.pid)
+        crashed = workers.pop()
+        os.kill(crashed, signal.SIGKILL)
+
+        assert _wait_for(lambda: len(_children(master.pid) - {crashed}) == 2)
+        assert workers < _children(master.pid)
+        assert get_index() == b"prefork"
+    finally:
+        master.terminate()
+        master.wait(10)
+    assert master.returncode == 0
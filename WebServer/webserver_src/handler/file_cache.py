@@ -0,0 +1,98 @@
+import mmap
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import BinaryIO, Optional
+
+
+@dataclass
+class CacheEntry:
+    view: memoryview
+    inode: int
+    mtime_ns: int
+    size: int
+    created: float
+
+
+class MmapFileCache:
+    """Cache of file contents shared by all worker processes.
+    Files are mapped read-only with mmap, so the cached data lives in the OS
+    page cache: a hot file is read from disk once and its pages are shared
+    by every worker instead of being copied into each worker's heap.
+    A worker only keeps the index: path -> mapping plus the inode, mtime
+    and size the mapping was made for. Every lookup checks them against
+    os.stat, so a file replaced by rename or rewritten in place is mapped
+    again instead of being served from a stale or truncated mapping;
+    entries older than ttl seconds are dropped as well. The total size of
+    mapped files is bounded by max_bytes, least recently used files are
+    unmapped first. Each worker has its own cache, so the limit applies per
+    worker: with N workers up to N * max_bytes of mappings may exist, even
+    though mappings of the same file share page cache pages.
+
+    A file truncated while its response is being sent makes the socket
+    send fail with EFAULT, which closes only that connection. The cache
+    never reads mapped pages itself, as touching truncated pages in user
+    space is SIGBUS.
+    """
+
+    def __init__(self, max_bytes: int, max_file_size: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.ttl = ttl
+        self.total_bytes = 0
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def accepts(self, size: int) -> bool:
+        return size < self.max_file_size and size <= self.max_bytes
+
+    def get(self, path: str) -> Optional[memoryview]:
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created > self.ttl:
+            self._drop(path)
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._drop(path)
+            return None
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != (
+            entry.inode,
+            entry.mtime_ns,
+            entry.size,
+        ):
+            self._drop(path)
+            return None
+        self._entries.move_to_end(path)
+        return entry.view
+
+    def put(self, path: str, file: BinaryIO) -> memoryview:
+        """Map the open file, remember it under path and return its contents."""
+        stat = os.fstat(file.fileno())
+        if stat.st_size:
+            view = memoryview(
+                mmap.mmap(file.fileno(), stat.st_size, access=mmap.ACCESS_READ)
+            )
+        else:
+            # mmap can not map an empty file
+            view = memoryview(b"")
+        self._drop(path)
+        while self._entries and self.total_bytes + stat.st_size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+        self._entries[path] = CacheEntry(
+            view, stat.st_ino, stat.st_mtime_ns, stat.st_size, time.monotonic()
+        )
+        self.total_bytes += stat.st_size
+        return view
+
+    def _drop(self, path: str):
+        # The mapping is not closed explicitly: a response still being sent
+        # may hold a view of it; it is unmapped when the last view is released
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
@@ -1,11 +1,16 @@
 import logging
 import os.path
-from collections import OrderedDict
-from datetime import datetime, timedelta
-from typing import Callable, Dict, Optional
+from datetime import timedelta
+from typing import Callable, Dict, Optional, Union
 from urllib.parse import unquote
 
+from handler.file_cache import MmapFileCache
 from protocol.request import HTTPRequest
+from protocol.response import FileRegion
+
+# Files not smaller than this and not cached are sent with sendfile
+SENDFILE_MIN_SIZE = 64 * 1024
+MAX_CACHE_BYTES = 64 * 1024 * 1024
 
 
 class FileService:
@@ -18,20 +23,30 @@ class FileService:
         self.root_folder = root_folder
         self.logger = logger
 
-        self._cache: OrderedDict[str, tuple[datetime, bytes]] = OrderedDict()
-
         if cache_config:
             self.cache_ttl = timedelta(minutes=int(cache_config.get("cache_ttl", 5)))
             self.max_file_size_in_cache = int(
                 cache_config.get("max_file_size_in_cache", 5 * 1024 * 1024)
             )
-            self.max_cache_size = int(cache_config.get("max_cache_size", 100))
+            self.max_cache_bytes = int(
+                cache_config.get("max_cache_bytes", MAX_CACHE_BYTES)
+            )
+            self.sendfile_min_size = int(
+                cache_config.get("sendfile_min_size", SENDFILE_MIN_SIZE)
+            )
         else:
             self.cache_ttl = timedelta(0)
             self.max_file_size_in_cache = 0
-            self.max_cache_size = 0
+            self.max_cache_bytes = 0
+            self.sendfile_min_size = SENDFILE_MIN_SIZE
 
-    def __call__(self, income: HTTPRequest) -> bytes:
+        self._cache = MmapFileCache(
+            self.max_cache_bytes,
+            self.max_file_size_in_cache,
+            self.cache_ttl.total_seconds(),
+        )
+
+    def __call__(self, income: HTTPRequest) -> Union[bytes, memoryview, FileRegion]:
         path = unquote(income.path.lstrip("/"))
         if not path or path.endswith("/"):
             path += "index.html"
@@ -43,12 +58,10 @@ class FileService:
         #     self.logger.warning(f"Blocked path traversal attempt: {full_path}")
         #     raise FileNotFoundError(f"Access denied: {path}")
 
-        now = datetime.now()
-        if full_path in self._cache:
-            cached_time, cached_data = self._cache[full_path]
-            if now - cached_time < self.cache_ttl:
-                self.logger.debug(f"Cache hit for {full_path}")
-                return cached_data
+        cached_data = self._cache.get(full_path)
+        if cached_data is not None:
+            self.logger.debug(f"Cache hit for {full_path}")
+            return cached_data
 
         self.logger.debug(f"Cache miss or expired for {full_path}")
 
@@ -65,14 +78,21 @@ class FileService:
             raise FileNotFoundError(f"File not readable {path}")
 
         try:
-            with open(full_path, "rb") as f:
+            f = open(full_path, "rb")
+            size = os.fstat(f.fileno()).st_size
+            if self._cache.accepts(size):
+                with f:
+                    cached_data = self._cache.put(full_path, f)
+                self.logger.info(f"Served file: {full_path} with len {size} (cached)")
+                return cached_data
+            if size >= self.sendfile_min_size:
+                # Large files are not read into memory, the server sends them
+                self.logger.info(f"Served file: {full_path} with len {size} (sendfile)")
+                return FileRegion(f, 0, size)
+            with f:
                 data = f.read()
                 self.logger.info(f"Served file: {full_path} with len {len(data)}")
                 self.logger.debug(f"The file: {full_path} data: {data!r}")
-                if len(data) < self.max_file_size_in_cache:
-                    self._cache[full_path] = (now, data)
-                    if len(self._cache) > self.max_cache_size:
-                        self._cache.popitem(last=False)
                 return data
         except Exception as e:
             self.logger.exception(f"Failed to read file: f{path}")
@@ -1,16 +1,22 @@
 import argparse
 import logging
 import os
+import signal
+import socket
 import sys
+import time
 from multiprocessing import Process
-from typing import Callable, Optional
+from multiprocessing.connection import wait
+from typing import Callable, Dict, Optional
 
 from dotenv import load_dotenv
 from handler.handler import FileService, HandlersFacade
 from protocol.request import HTTPRequest
-from server.server import HTTPServer
+from server.server import HTTPServer, create_server_socket
 
 logger = logging.getLogger("httpserver")
+# A worker that dies sooner than this after start is restarted with a delay
+WORKER_RESTART_DELAY = 1.0
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(process)d] [%(levelname)s] %(message)s",
@@ -38,12 +44,45 @@ def parse_args():
     parser.add_argument(
         "--host", default="0.0.0.0", help="Host to bind to (default: 0.0.0.0)"
     )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=1024,
+        help="Listen queue size of the server socket (default: 1024)",
+    )
+    parser.add_argument(
+        "--reuse_port",
+        choices=("auto", "on", "off"),
+        default="auto",
+        help="Bind a SO_REUSEPORT socket in every worker (auto: on Linux) "
+        "instead of sharing the master socket (default: auto)",
+    )
+    parser.add_argument(
+        "--keepalive_timeout",
+        type=float,
+        default=5,
+        help="Seconds an idle keep-alive connection is kept open (default: 5)",
+    )
+    parser.add_argument(
+        "--max_keepalive_requests",
+        type=int,
+        default=100,
+        help="Requests served over one connection before it is closed (default: 100)",
+    )
     parser.add_argument("--cache_ttl", default="5", help="File cache minutes ttl")
     parser.add_argument(
         "--max_file_size_in_cache", default="5242880", help="Max file size in cache"
     )
     parser.add_argument(
-        "--max_cache_size", default="100", help="Max files number in cache"
+        "--max_cache_bytes",
+        default="67108864",
+        help="Max total size of files mapped by each worker's cache; "
+        "with N workers up to N times this is mapped",
+    )
+    parser.add_argument(
+        "--sendfile_min_size",
+        default="65536",
+        help="Min size of a not cached file sent with sendfile",
     )
     return parser.parse_args()
 
@@ -56,7 +95,15 @@ def always_true(_: HTTPRequest) -> bool:
     return True
 
 
-def start_worker(handler: Callable[[HTTPRequest], Optional[bytes]], args):
+def start_worker(
+    handler: Callable[[HTTPRequest], Optional[bytes]],
+    args,
+    server_socket: Optional[socket.socket] = None,
+    reuse_port: bool = False,
+):
+    # The master stops workers with SIGTERM, finish like on Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
     server = HTTPServer(
         connect_timeout_ms=args.upload_timeout,
         server_address=(args.host, args.port),
@@ -64,10 +111,88 @@ def start_worker(handler: Callable[[HTTPRequest], Optional[bytes]], args):
         external_handler=handler,
         headers_binding=empty_headers,
         logger=logger,
+        keep_alive_timeout=args.keepalive_timeout,
+        max_keep_alive_requests=args.max_keepalive_requests,
+        server_socket=server_socket,
+        backlog=args.backlog,
+        reuse_port=reuse_port,
     )
     server.server_start()
 
 
+def use_reuse_port(mode: str) -> bool:
+    if mode == "auto":
+        # Other systems accept SO_REUSEPORT but do not balance accepts
+        return sys.platform.startswith("linux") and hasattr(socket, "SO_REUSEPORT")
+    return mode == "on"
+
+
+def run_workers(handler: Callable[[HTTPRequest], Optional[bytes]], args):
+    """Prefork master: binds the port once, starts args.workers processes
+    and restarts the ones that exit until SIGTERM/SIGINT.
+    Workers either accept from the inherited master socket or, with
+    SO_REUSEPORT, bind their own sockets and the kernel balances accepts.
+    """
+    reuse_port = use_reuse_port(args.reuse_port)
+    master_socket = create_server_socket(
+        (args.host, args.port), args.backlog, reuse_port
+    )
+    # Workers bind the port the master got, even if args.port is 0
+    args.port = master_socket.getsockname()[1]
+    shared_socket = None if reuse_port else master_socket
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    started: Dict[int, float] = {}
+
+    def spawn() -> Process:
+        process = Process(
+            target=start_worker, args=(handler, args, shared_socket, reuse_port)
+        )
+        process.start()
+        started[process.sentinel] = time.monotonic()
+        return process
+
+    workers = [spawn() for _ in range(args.workers)]
+    logger.info(
+        f"Master started {args.workers} workers on port {args.port}"
+        f" ({'SO_REUSEPORT' if reuse_port else 'shared socket'})"
+    )
+    try:
+        while not stopping:
+            wait([worker.sentinel for worker in workers], timeout=1)
+            for index, worker in enumerate(workers):
+                if worker.exitcode is None or stopping:
+                    continue
+                logger.error(
+                    f"Worker {worker.pid} exited with code {worker.exitcode}, restart"
+                )
+                if (
+                    time.monotonic() - started.pop(worker.sentinel)
+                    < WORKER_RESTART_DELAY
+                ):
+                    time.sleep(WORKER_RESTART_DELAY)
+                worker.close()
+                workers[index] = spawn()
+    finally:
+        for worker in workers:
+            if worker.exitcode is None:
+                worker.terminate()
+        for worker in workers:
+            worker.join(5)
+            if worker.exitcode is None:
+                worker.kill()
+        master_socket.close()
+        logger.info("Master stopped")
+
+
 def main():
     load_dotenv()
     args = parse_args()
@@ -80,14 +205,14 @@ def main():
     cache_cfg = {
         "cache_ttl": args.cache_ttl,
         "max_file_size_in_cache": args.max_file_size_in_cache,
-        "max_cache_size": args.max_cache_size,
+        "max_cache_bytes": args.max_cache_bytes,
+        "sendfile_min_size": args.sendfile_min_size,
     }
 
     file_service = FileService(root, logger, cache_cfg)
     handler = HandlersFacade().when(always_true, file_service)
 
-    for _ in range(args.workers):
-        Process(target=start_worker, args=(handler, args)).start()
+    run_workers(handler, args)
 
 
 if __name__ == "__main__":
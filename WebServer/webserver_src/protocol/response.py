@@ -1,15 +1,42 @@
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from typing import BinaryIO, Optional, Union
+
+
+@dataclass
+class FileRegion:
+    """Response body that stays in a file: length bytes from offset.
+    The server sends it with sendfile, so the data does not pass through
+    Python memory. The server closes the file when the body is sent.
+    """
+
+    file: BinaryIO
+    offset: int
+    length: int
+
+    def __len__(self) -> int:
+        return self.length
+
+    def read(self) -> bytes:
+        self.file.seek(self.offset)
+        return self.file.read(self.length)
+
+    def close(self):
+        self.file.close()
 
 
 @dataclass
 class HTTPResponse:
     status_code: int
     headers: dict
-    body: Optional[bytes]
+    body: Optional[Union[bytes, FileRegion]]
+    keep_alive: bool = False
 
     def to_bytes(self) -> bytes:
+        body = self.body.read() if isinstance(self.body, FileRegion) else self.body
+        return self.header_bytes() + (body or b"")
+
+    def header_bytes(self) -> bytes:
         reason = {
             200: "OK",
             403: "Forbidden",
@@ -20,7 +47,7 @@ class HTTPResponse:
         response_line = f"HTTP/1.1 {self.status_code} {reason}\r\n"
         default_headers = {
             "Date": datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT"),
-            "Connection": "close",
+            "Connection": "keep-alive" if self.keep_alive else "close",
             "Server": "OtusPythonHTTP/1.0",
         }
         merged_headers = {**default_headers, **self.headers}
@@ -30,6 +57,4 @@ class HTTPResponse:
             merged_headers["Content-Length"] = "0"
 
         header_lines = "".join(f"{k}: {v}\r\n" for k, v in merged_headers.items())
-        return (response_line + header_lines + "\r\n").encode("utf-8") + (
-            self.body or b""
-        )
+        return (response_line + header_lines + "\r\n").encode("utf-8")
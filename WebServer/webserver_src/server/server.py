@@ -1,58 +1,118 @@
 import errno
 import mimetypes
+import os
 import re
-import select
+import selectors
 import socket
 import threading
-from datetime import datetime, timedelta
+import time
+from collections import deque
 from logging import Logger
-from typing import Callable, Dict
+from typing import Callable, Deque, Dict, Optional, Union
 from urllib.parse import parse_qs, urlparse
 
 from protocol.request import HTTPRequest
-from protocol.response import HTTPResponse
+from protocol.response import FileRegion, HTTPResponse
 
 HTTP_PROTOCOL = b"HTTP/"
-
-
-def _eintr_retry(func, *args):
-    """restart a system call interrupted by EINTR"""
-    while True:
-        try:
-            return func(*args)
-        except (OSError, select.error) as e:
-            if e.args[0] != errno.EINTR:
-                raise
+CONNECTION_HEADER_RE = re.compile(rb"^Connection:[ \t]*(.*)$", re.IGNORECASE | re.M)
+
+
+def create_server_socket(
+    server_address, backlog: int, reuse_port: bool = False
+) -> socket.socket:
+    """Bound and listening socket to be shared by worker processes.
+    With reuse_port the socket only reserves the address: workers bind
+    their own listening sockets with SO_REUSEPORT next to it.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(server_address)
+        if not reuse_port:
+            sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class Connection:
+    """State of one client connection in the event loop."""
+
+    def __init__(self, request: socket.socket, client_address):
+        self.request = request
+        self.client_address = client_address
+        self.in_buffer = bytearray()
+        self.out_queue: Deque[Union[memoryview, FileRegion]] = deque()
+        self.events = selectors.EVENT_READ
+        self.requests = 0
+        self.last_active = time.monotonic()
+        # Last time queued output was queued or accepted by the socket
+        self.last_write = self.last_active
+        # Set when headers are received but the body is still incomplete
+        self.body_started: Optional[float] = None
+        self.close_after_write = False
+        # The client has shut down its side, answer what is buffered and close
+        self.eof = False
+
+    def discard_output(self):
+        for item in self.out_queue:
+            if isinstance(item, FileRegion):
+                item.close()
+        self.out_queue.clear()
 
 
 class BaseServer:
     timeout = None
+    max_accept_per_event = 64
+    # Out of file descriptors (EMFILE/ENFILE): stop accepting for this many
+    # seconds instead of spinning on a listener that stays readable
+    accept_pause = 1.0
 
     def __init__(self, server_address, server_request_handler):
         """Constructor.  May be extended, do not override."""
         self.server_address = server_address
         self.server_request_handler = server_request_handler
+        self.selector: Optional[selectors.BaseSelector] = None
+        self.connections: Dict[int, Connection] = {}
+        self._accept_resume: Optional[float] = None
         self.__is_shut_down = threading.Event()
         self.__shutdown_request = False
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
 
     def serve_forever(self, poll_interval=0.5):
-        """Handle one request at a time until shutdown.
-        Polls for shutdown every poll_interval seconds. Ignores
-        self.timeout. If you need to do periodic tasks, do them in
-        another thread.
+        """Handle requests until shutdown.
+        The listening socket and every client connection are multiplexed
+        with selectors (epoll on Linux), so a slow client does not block
+        the others. The loop wakes up at least every poll_interval seconds
+        to run service_actions(), which expires stalled connections.
         """
         self.__is_shut_down.clear()
+        self._accept_resume = None
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self, selectors.EVENT_READ)
+        self.selector.register(self.__wakeup_reader, selectors.EVENT_READ)
         try:
             while not self.__shutdown_request:
-                # XXX: Consider using another file descriptor or
-                # connecting to the socket to wake this up instead of
-                # polling. Polling reduces our responsiveness to a
-                #                 shutdown request and wastes cpu at all other times.
-                #                 r, w, e = select.select([self], [], [], poll_interval)
-                r, w, e = _eintr_retry(select.select, [self], [], [], poll_interval)
-                if self in r:
-                    self._handle_request_noblock()
+                for key, mask in self.selector.select(poll_interval):
+                    if key.fileobj is self:
+                        self._handle_request_noblock()
+                    elif key.fileobj is self.__wakeup_reader:
+                        self._drain_wakeup()
+                    else:
+                        self.handle_connection_event(key.data, mask)
+                self._resume_accept()
+                self.service_actions()
         finally:
+            for connection in list(self.connections.values()):
+                self.close_connection(connection)
+            self.selector.close()
+            self.selector = None
             self.__shutdown_request = False
             self.__is_shut_down.set()
 
@@ -63,62 +123,141 @@ class BaseServer:
         deadlock.
         """
         self.__shutdown_request = True
+        try:
+            self.__wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            pass
         self.__is_shut_down.wait()
 
+    def _drain_wakeup(self):
+        try:
+            while self.__wakeup_reader.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+
     def _handle_request_noblock(self):
-        """Handle one request, without blocking.
-        Select.select has returned that the socket is
-        readable before this function was called, so there should be
-        no risk of blocking in get_request().
+        """Accept pending connections, without blocking.
+        The selector has reported the listening socket readable; the
+        backlog is drained up to max_accept_per_event connections so
+        that accepts do not starve connections already being served.
         """
-        try:
-            request, client_address = self.get_request()
-        except socket.error:
-            return
-        if self.verify_request(request, client_address):
+        for _ in range(self.max_accept_per_event):
             try:
-                self.process_request(request, client_address)
-            except:
-                self.handle_error(request, client_address)
+                request, client_address = self.get_request()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    self._pause_accept(e)
+                else:
+                    self.logger.exception("Failed to accept connection")
+                return
+            if self.verify_request(request, client_address):
+                try:
+                    self.process_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                    self.shutdown_request(request)
+            else:
                 self.shutdown_request(request)
-        else:
-            self.shutdown_request(request)
+
+    def _pause_accept(self, error: OSError):
+        """Stop polling the listener for accept_pause seconds.
+        Pending connections stay in the backlog until descriptors are
+        released by closed connections.
+        """
+        self.logger.warning(
+            f"Failed to accept connection: {error.strerror}, "
+            f"pausing accepts for {self.accept_pause} s"
+        )
+        self.selector.unregister(self)
+        self._accept_resume = time.monotonic() + self.accept_pause
+
+    def _resume_accept(self):
+        if self._accept_resume is None or time.monotonic() < self._accept_resume:
+            return
+        self._accept_resume = None
+        self.selector.register(self, selectors.EVENT_READ)
 
     def process_request(self, request, client_address):
-        """Call finish_request."""
-        self.finish_request(request, client_address)
-        self.shutdown_request(request)
+        """Register the connection in the event loop."""
+        request.setblocking(False)
+        connection = Connection(request, client_address)
+        self.connections[request.fileno()] = connection
+        self.selector.register(request, selectors.EVENT_READ, connection)
+
+    def handle_connection_event(self, connection: Connection, mask: int):
+        """Called when a client connection is ready for IO."""
+        raise NotImplementedError
+
+    def close_connection(self, connection: Connection):
+        """Remove the connection from the event loop and close it."""
+        connection.discard_output()
+        self.connections.pop(connection.request.fileno(), None)
+        if self.selector is not None:
+            try:
+                self.selector.unregister(connection.request)
+            except (KeyError, ValueError):
+                pass
+        self.shutdown_request(connection.request)
 
-    def finish_request(self, request, client_address):
-        """Finish one request by instantiating RequestHandlerClass."""
-        self.server_request_handler(request, client_address, self)
+    def service_actions(self):
+        """Called by the serve_forever() loop after every iteration."""
+        pass
 
 
 class TCPServer(BaseServer):
     address_family = socket.AF_INET
     socket_type = socket.SOCK_STREAM
-    MAX_RECV_SIZE = 4096
+    MAX_RECV_SIZE = 65536
     max_initial_read = 8192
-    request_queue_size = 5
+    # A new connection without a complete request is closed after idle_timeout
+    # seconds of silence, a persistent one after keep_alive_timeout; a started
+    # body must arrive within connect_timeout_ms, and a client that stops
+    # reading its response is dropped after send_timeout seconds
+    idle_timeout = 60
+    keep_alive_timeout = 5
+    send_timeout = 60
+    max_keep_alive_requests = 100
+    timeout_check_interval = 0.1
+    request_queue_size = 1024
     allow_reuse_address = False
+    # Each worker binds its own socket and the kernel balances accepts
+    allow_reuse_port = False
 
-    def __init__(self, server_address, connect_timeout_ms: int, logger: Logger):
-        """Constructor. May be extended, do not override."""
+    def __init__(
+        self,
+        server_address,
+        connect_timeout_ms: int,
+        logger: Logger,
+        server_socket: Optional[socket.socket] = None,
+    ):
+        """Constructor. May be extended, do not override.
+        server_socket is an already bound and listening socket, e.g. one
+        inherited from the master process; it is used instead of a new one.
+        """
         BaseServer.__init__(self, server_address, TCPServer.handle_received_data)
-        self.socket = socket.socket(self.address_family, self.socket_type)
+        self.socket = server_socket or socket.socket(
+            self.address_family, self.socket_type
+        )
         self.logger = logger
         self.connect_timeout_ms = connect_timeout_ms
+        self._next_timeout_check = 0.0
 
     def server_bind(self):
         """Called by constructor to bind the socket."""
         if self.allow_reuse_address:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.allow_reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind(self.server_address)
         self.server_address = self.socket.getsockname()
 
     def server_activate(self):
         """Called by constructor to activate the server."""
         self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(False)
 
     def server_close(self):
         """Called to clean-up the server."""
@@ -137,80 +276,237 @@ class TCPServer(BaseServer):
         try:
             request.shutdown(socket.SHUT_WR)
         except socket.error as e:
-            self.logger.error(f"Socket error during get_request(): {e}")
+            self.logger.debug(f"Socket error during shutdown_request(): {e}")
         self.close_request(request)
 
     def close_request(self, request):
         """Called to clean up and individual request."""
         request.close()
 
-    def finish_request(self, request, client_address):
-        self.handle_received_data(request, client_address, self)
-
-    def handle_received_data(self, request: socket.socket, client_address, server):
-        """TCP Socket handle"""
+    def handle_connection_event(self, connection: Connection, mask: int):
         try:
-            buffer = b""
-            start_time = datetime.now()
-            while b"\r\n\r\n" not in buffer:
-                chunk = request.recv(self.MAX_RECV_SIZE)
-                if not chunk:
-                    break
-                buffer += chunk
-                if len(buffer) > self.max_initial_read and HTTP_PROTOCOL not in buffer:
-                    raise ValueError("Too much data without valid HTTP header")
-            if HTTP_PROTOCOL in buffer:
-                header_part, body_part = buffer.split(b"\r\n\r\n", 1)
-                content_length = 0
-                cl_re = re.search(
-                    rb"Content-Length:\s*(\d+)", header_part, re.IGNORECASE
-                )
-                if cl_re:
-                    content_length = int(cl_re.group(1))
-                while not self._timeout(start_time) and len(buffer) < content_length:
-                    chunk = request.recv(self.MAX_RECV_SIZE)
-                    if not chunk:
-                        break
-                    body_part += chunk
-                if len(body_part) != content_length:
-                    raise ValueError(
-                        f"Incomplete request body: expected {content_length}, got {len(body_part)}"
-                    )
-                buffer = header_part + b"\r\n\r\n" + body_part
-            response = server.handle_data(client_address, buffer)
-            request.sendall(response.to_bytes())
-            self.logger.info(f"Response sent to {client_address}")
+            if mask & selectors.EVENT_READ:
+                self._read(connection)
+            if mask & selectors.EVENT_WRITE:
+                self._flush(connection)
+                if not connection.out_queue:
+                    self.logger.info(f"Response sent to {connection.client_address}")
+                    self.handle_received_data(connection)
         except Exception as e:
             self.logger.exception(
-                f"Error while handling request from {client_address}: {e}"
+                f"Error while handling request from {connection.client_address}: {e}"
             )
-        # finally:
-        #     request.close()
+            self.close_connection(connection)
 
-    def _timeout(self, start_time):
-        return datetime.now() - start_time > timedelta(
-            milliseconds=self.connect_timeout_ms
-        )
+    def _read(self, connection: Connection):
+        """Read everything the socket has and handle complete requests."""
+        while True:
+            try:
+                chunk = connection.request.recv(self.MAX_RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not chunk:
+                connection.eof = True
+                break
+            connection.in_buffer += chunk
+            connection.last_active = time.monotonic()
+        self.handle_received_data(connection)
+
+    def handle_received_data(self, connection: Connection):
+        """Handle complete requests from the buffer in order (pipelining).
+        The next request is taken only after the previous response has been
+        written, so a client that does not read cannot make us buffer
+        responses without bound.
+        """
+        while not connection.out_queue and not connection.close_after_write:
+            data = self._next_request(connection)
+            if data is None:
+                break
+            connection.requests += 1
+            response = self.handle_data(connection.client_address, data)
+            response.keep_alive = self.keep_alive(connection, data)
+            connection.close_after_write = not response.keep_alive
+            connection.last_write = time.monotonic()
+            if isinstance(response.body, (FileRegion, memoryview)):
+                connection.out_queue.append(memoryview(response.header_bytes()))
+                connection.out_queue.append(response.body)
+            else:
+                connection.out_queue.append(memoryview(response.to_bytes()))
+            self._flush(connection)
+            if not connection.out_queue:
+                self.logger.info(f"Response sent to {connection.client_address}")
+        self._update_events(connection)
+
+    def _next_request(self, connection: Connection) -> Optional[bytes]:
+        """Cut the first complete request (headers and body) from the buffer"""
+        buffer = connection.in_buffer
+        header_end = buffer.find(b"\r\n\r\n")
+        if header_end < 0:
+            if len(buffer) > self.max_initial_read and HTTP_PROTOCOL not in buffer:
+                raise ValueError("Too much data without valid HTTP header")
+            return None
+        request_end = self._request_end(buffer, header_end)
+        if len(buffer) < request_end:
+            if connection.body_started is None:
+                connection.body_started = time.monotonic()
+            return None
+        connection.body_started = None
+        data = bytes(buffer[:request_end])
+        del buffer[:request_end]
+        return data
+
+    @staticmethod
+    def _request_end(buffer: bytearray, header_end: int) -> int:
+        """End offset of the request whose headers end at header_end.
+        It may lie beyond the data received so far.
+        """
+        header_part = bytes(buffer[:header_end])
+        content_length = 0
+        cl_re = re.search(rb"Content-Length:\s*(\d+)", header_part, re.IGNORECASE)
+        if cl_re:
+            content_length = int(cl_re.group(1))
+        return header_end + 4 + content_length
+
+    def _has_complete_request(self, connection: Connection) -> bool:
+        buffer = connection.in_buffer
+        header_end = buffer.find(b"\r\n\r\n")
+        return header_end >= 0 and len(buffer) >= self._request_end(buffer, header_end)
+
+    def keep_alive(self, connection: Connection, data: bytes) -> bool:
+        """Whether the connection stays open after the response to data.
+        HTTP/1.1 connections are persistent unless the client sends
+        Connection: close, HTTP/1.0 ones only with Connection: keep-alive.
+        A client that has half-closed still gets answers to every complete
+        request it sent; the connection is closed after the last of them.
+        """
+        if connection.requests >= self.max_keep_alive_requests:
+            return False
+        if connection.eof and not self._has_complete_request(connection):
+            return False
+        header_part = data[: data.find(b"\r\n\r\n")]
+        version = header_part.split(b"\r\n", 1)[0].rsplit(b" ", 1)[-1]
+        tokens = {
+            token.strip().lower()
+            for value in CONNECTION_HEADER_RE.findall(header_part)
+            for token in value.split(b",")
+        }
+        if version == b"HTTP/1.1":
+            return b"close" not in tokens
+        return b"keep-alive" in tokens
+
+    def _flush(self, connection: Connection):
+        """Write as much of the queued output as the socket takes now."""
+        queue = connection.out_queue
+        while queue:
+            item = queue[0]
+            try:
+                if isinstance(item, FileRegion):
+                    if item.length:
+                        self._send_file(connection.request, item)
+                        connection.last_write = time.monotonic()
+                    if not item.length:
+                        queue.popleft().close()
+                    continue
+                sent = connection.request.send(item)
+            except (BlockingIOError, InterruptedError):
+                return
+            connection.last_write = time.monotonic()
+            if sent == len(item):
+                queue.popleft()
+            else:
+                queue[0] = item[sent:]
+
+    def _send_file(self, request: socket.socket, region: FileRegion):
+        """Send the next part of the file region straight from the page cache."""
+        if hasattr(os, "sendfile"):
+            sent = os.sendfile(
+                request.fileno(), region.file.fileno(), region.offset, region.length
+            )
+        else:
+            region.file.seek(region.offset)
+            sent = request.send(
+                region.file.read(min(region.length, self.MAX_RECV_SIZE))
+            )
+        if not sent:
+            raise ValueError(f"File {region.file.name} was truncated while sending")
+        region.offset += sent
+        region.length -= sent
+
+    def _update_events(self, connection: Connection):
+        if connection.out_queue:
+            # Wait until the client drains its receive window
+            events = selectors.EVENT_WRITE
+        elif connection.close_after_write or connection.eof:
+            self.close_connection(connection)
+            return
+        else:
+            events = selectors.EVENT_READ
+        if events != connection.events:
+            connection.events = events
+            self.selector.modify(connection.request, events, connection)
+
+    def service_actions(self):
+        """Close stalled connections.
+        A connection expires when its client has not sent a complete
+        request in time or has stopped reading the response.
+        """
+        now = time.monotonic()
+        if now < self._next_timeout_check:
+            return
+        self._next_timeout_check = now + self.timeout_check_interval
+        upload_timeout = self.connect_timeout_ms / 1000
+        for connection in list(self.connections.values()):
+            if connection.out_queue:
+                expired = now - connection.last_write > self.send_timeout
+            elif connection.body_started is not None:
+                expired = now - connection.body_started > upload_timeout
+            elif connection.requests:
+                # A persistent connection is idle since the later of its last
+                # read and the moment its last response was fully written
+                idle_since = max(connection.last_active, connection.last_write)
+                expired = now - idle_since > self.keep_alive_timeout
+            else:
+                expired = now - connection.last_active > self.idle_timeout
+            if expired:
+                self.logger.debug(
+                    f"Closing stalled connection from {connection.client_address}"
+                )
+                self.close_connection(connection)
 
 
 class HTTPServer(TCPServer):
+    allow_reuse_address = True
+
     def __init__(
         self,
         connect_timeout_ms: int,
         server_address: tuple[str, int],
         base_headers: Dict[str, str],
-        external_handler: Callable[[HTTPRequest], bytes],
+        external_handler: Callable[[HTTPRequest], Union[bytes, FileRegion]],
         headers_binding: Callable[[Dict], Dict],
         logger: Logger,
+        keep_alive_timeout: float = TCPServer.keep_alive_timeout,
+        max_keep_alive_requests: int = TCPServer.max_keep_alive_requests,
+        server_socket: Optional[socket.socket] = None,
+        backlog: int = TCPServer.request_queue_size,
+        reuse_port: bool = False,
     ):
-        super().__init__(server_address, connect_timeout_ms, logger)
+        super().__init__(server_address, connect_timeout_ms, logger, server_socket)
+        self.request_queue_size = backlog
+        self.allow_reuse_port = reuse_port
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_keep_alive_requests = max_keep_alive_requests
         self.base_headers = base_headers | {"Server": socket.gethostname()}
         self.handler = external_handler
         self.headers_binding = headers_binding
         self.logger = logger
 
-        self.server_bind()
-        self.server_activate()
+        if server_socket is None:
+            self.server_bind()
+            self.server_activate()
+        else:
+            self.server_address = server_socket.getsockname()
+            self.socket.setblocking(False)
 
     def server_start(self):
         self.logger.info(f"HTTP server started at {self.server_address}")
@@ -293,6 +589,8 @@ class HTTPServer(TCPServer):
             headers["Content-Length"] = (
                 str(len(response_body)) if response_body else "0"
             )
+            if request.method == "HEAD" and isinstance(response_body, FileRegion):
+                response_body.close()
 
             return HTTPResponse(
                 status_code=200,